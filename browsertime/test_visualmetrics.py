@@ -1,12 +1,102 @@
+import contextlib
+import gzip
+import io
+import json
 import unittest
 import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
 
+from browsertime import visualmetrics
 from browsertime.visualmetrics import (
+    Analyzer,
     calculate_contentful_speed_index,
+    calculate_edge_count,
+    calculate_edge_count_imagemagick,
+    calculate_frame_progress,
+    calculate_frames_progress,
+    calculate_hero_times,
+    calculate_image_histogram_getcolors,
+    calculate_pixels_histogram,
     calculate_perceptual_speed_index,
+    calculate_visual_progress,
+    Capabilities,
+    check_config,
+    check_process,
+    ColorCache,
+    compare_frames_imagemagick,
+    compare_frames_numpy,
+    convert_to_jpeg,
+    crop_viewport,
+    FrameStore,
+    generate_orange_png,
+    generate_white_png,
+    get_batch_jobs,
+    get_batch_path_error,
+    get_parser,
+    get_timeline_offset,
+    is_color_frame,
+    is_color_frame_imagemagick,
+    is_white_frame,
+    is_white_frame_imagemagick,
+    JsonStreamReader,
+    load_histograms,
+    load_job_pixels,
+    run_worker,
+    save_histograms_binary,
+    StageManifest,
 )
 
 HERE = os.path.dirname(__file__)
+HAS_IMAGEMAGICK = check_process("convert -version", "ImageMagick") and check_process(
+    "compare -version", "ImageMagick"
+)
+HAS_FFMPEG = check_process("ffmpeg -version", "ffmpeg")
+try:
+    import ssim
+except ImportError:
+    ssim = None
+cache_directory = None
+saved_cache_home = None
+
+
+def make_test_video(path, seconds=1):
+    """A small video of ffmpeg's moving test pattern"""
+    subprocess.check_call(
+        [
+            "ffmpeg",
+            "-v",
+            "error",
+            "-f",
+            "lavfi",
+            "-i",
+            "testsrc=size=160x90:rate=10",
+            "-t",
+            str(seconds),
+            "-pix_fmt",
+            "yuv420p",
+            path,
+        ]
+    )
+
+
+def setUpModule():
+    # Keep the capability probes out of the developer's own cache
+    global cache_directory, saved_cache_home
+    cache_directory = tempfile.mkdtemp()
+    saved_cache_home = os.environ.get("XDG_CACHE_HOME")
+    os.environ["XDG_CACHE_HOME"] = cache_directory
+
+
+def tearDownModule():
+    if saved_cache_home is None:
+        del os.environ["XDG_CACHE_HOME"]
+    else:
+        os.environ["XDG_CACHE_HOME"] = saved_cache_home
+    shutil.rmtree(cache_directory)
 
 
 class TestVisualMetrics(unittest.TestCase):
@@ -35,3 +125,864 @@ class TestVisualMetrics(unittest.TestCase):
         progress = [_p(image) for image in images if image.startswith("ms_")]
         res = calculate_perceptual_speed_index(progress, directory)
         self.assertTrue(res[0], 5080)
+
+
+class TestFrameComparison(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _save(self, name, pixels):
+        from PIL import Image
+
+        path = os.path.join(self.directory, name)
+        Image.fromarray(pixels).save(path)
+        return path
+
+    def _frames(self):
+        import numpy as np
+
+        first = np.full((10, 10, 3), 100, dtype=np.uint8)
+        second = first.copy()
+        # 25 is within a 10% fuzz (25.5), 26 is not
+        second[0, :5, 0] = 125
+        second[8, 5:8, 2] = 126
+        return self._save("first.png", first), self._save("second.png", second)
+
+    def test_identical_frames(self):
+        frame = os.path.join(HERE, "test_data", "ms_001000.png")
+        self.assertEqual(compare_frames_numpy(frame, frame, 0, None, None), 0)
+
+    def test_fuzz(self):
+        first, second = self._frames()
+        self.assertEqual(compare_frames_numpy(first, second, 0, None, None), 8)
+        self.assertEqual(compare_frames_numpy(first, second, 10, None, None), 3)
+        self.assertEqual(compare_frames_numpy(first, second, 15, None, None), 0)
+
+    def test_crop_and_mask(self):
+        first, second = self._frames()
+        mask = {"x": 0, "y": 0, "width": 4, "height": 4}
+        self.assertEqual(compare_frames_numpy(first, second, 0, "10x5+0+0", None), 5)
+        self.assertEqual(compare_frames_numpy(first, second, 0, "20x20+0+5", None), 3)
+        self.assertEqual(compare_frames_numpy(first, second, 0, None, mask), 4)
+        self.assertEqual(compare_frames_numpy(first, second, 0, "10x5+0+0", mask), 1)
+
+    def test_different_sizes(self):
+        import numpy as np
+
+        first, second = self._frames()
+        small = self._save("small.png", np.zeros((5, 5, 3), dtype=np.uint8))
+        self.assertIsNone(compare_frames_numpy(first, small, 0, None, None))
+        self.assertEqual(compare_frames_numpy(first, small, 0, "5x5+0+0", None), 25)
+
+    @unittest.skipUnless(HAS_IMAGEMAGICK, "ImageMagick is not installed")
+    def test_imagemagick_parity(self):
+        pairs = [
+            ("ms_000000.png", "ms_000920.png"),
+            ("ms_001000.png", "ms_001080.png"),
+            ("ms_001400.png", "ms_001520.png"),
+            ("ms_002040.png", "ms_006000.png"),
+        ]
+        mask = {"x": 100, "y": 50, "width": 200, "height": 100}
+        settings = [
+            (0, None, None),
+            (1, None, None),
+            (5, "400x9+0+0", None),
+            (10, "390x183+0+10", None),
+            (10, "360x167+0+16", mask),
+            (15, None, None),
+        ]
+        for image1, image2 in pairs:
+            image1 = os.path.join(HERE, "test_data", image1)
+            image2 = os.path.join(HERE, "test_data", image2)
+            for fuzz, crop, mask_rect in settings:
+                self.assertEqual(
+                    compare_frames_numpy(image1, image2, fuzz, crop, mask_rect),
+                    compare_frames_imagemagick(image1, image2, fuzz, crop, mask_rect),
+                    "{0} / {1} fuzz={2} crop={3} mask={4}".format(
+                        image1, image2, fuzz, crop, mask_rect
+                    ),
+                )
+
+    @unittest.skipUnless(HAS_IMAGEMAGICK, "ImageMagick is not installed")
+    def test_imagemagick_parity_with_alpha(self):
+        import numpy as np
+
+        first = np.full((10, 10, 4), 200, dtype=np.uint8)
+        second = first.copy()
+        second[:, :, 3] = 0
+        second[0, 0] = (0, 0, 0, 255)
+        first[:, 5:, 3] = 0
+        first = self._save("first.png", first)
+        second = self._save("second.png", second)
+        for fuzz in (0, 10):
+            self.assertEqual(
+                compare_frames_numpy(first, second, fuzz, None, None),
+                compare_frames_imagemagick(first, second, fuzz, None, None),
+            )
+
+
+class TestFrameStore(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        for name in ["ms_000000.png", "ms_000920.png", "ms_001000.png"]:
+            shutil.copyfile(
+                os.path.join(HERE, "test_data", name),
+                os.path.join(self.directory, "video-{0}".format(name[3:])),
+            )
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_load_and_shift(self):
+        store = FrameStore.load(self.directory, "video-")
+        self.assertEqual(store.times, [0, 920, 1000])
+        store.remove(store.get(0))
+        store.shift(920, "ms_")
+        self.assertEqual(store.times, [0, 80])
+        self.assertEqual(
+            sorted(os.listdir(self.directory)), ["ms_000000.png", "ms_000080.png"]
+        )
+        self.assertEqual(store.get(80).size, (400, 203))
+
+    def test_spill_to_disk(self):
+        import numpy as np
+
+        store = FrameStore.load(self.directory, "video-", max_memory=400 * 203 * 3)
+        frames = store.list()
+        pixels = [frame.pixels for frame in frames]
+        self.assertFalse(isinstance(pixels[0], np.memmap))
+        self.assertTrue(isinstance(pixels[1], np.memmap))
+        self.assertTrue(isinstance(pixels[2], np.memmap))
+        self.assertTrue(np.array_equal(pixels[2], store.get(1000).pixels))
+
+    def test_crop_viewport(self):
+        import numpy as np
+        from PIL import Image
+
+        store = FrameStore(None, "video-")
+        original = np.asarray(
+            Image.open(os.path.join(self.directory, "video-000920.png"))
+        )
+        for time in [0, 920]:
+            store.add(time, pixels=original)
+        viewport = {"x": 10, "y": 20, "width": 300, "height": 150}
+        saved = visualmetrics.client_viewport
+        visualmetrics.client_viewport = viewport
+        try:
+            crop_viewport(store)
+        finally:
+            visualmetrics.client_viewport = saved
+        self.assertTrue(np.array_equal(store.get(920).pixels, original[20:170, 10:310]))
+        self.assertEqual(store.get(0).size, (300, 150))
+
+
+@unittest.skipUnless(HAS_FFMPEG, "ffmpeg is not installed")
+class TestFrameExtraction(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.saved_options = visualmetrics.options
+        visualmetrics.options = get_parser().parse_args([])
+
+    def tearDown(self):
+        visualmetrics.options = self.saved_options
+        shutil.rmtree(self.directory)
+
+    def test_stream_frames(self):
+        video = os.path.join(self.directory, "video.mp4")
+        make_test_video(video)
+        command = [
+            "ffmpeg",
+            "-v",
+            "debug",
+            "-i",
+            video,
+            "-vsync",
+            "0",
+            "-vf",
+            visualmetrics.get_decimate_filter() + "=0:64:640:0.001",
+        ]
+        streamed_directory = os.path.join(self.directory, "streamed")
+        files_directory = os.path.join(self.directory, "files")
+        os.mkdir(streamed_directory)
+        os.mkdir(files_directory)
+        streamed = visualmetrics.stream_frames(command, streamed_directory)
+        files = visualmetrics.extract_frame_files(command, files_directory)
+        self.assertGreater(len(files), 1)
+        self.assertEqual(
+            [frame.time for frame in streamed.list()],
+            [frame.time for frame in files.list()],
+        )
+        for streamed_frame, file_frame in zip(streamed.list(), files.list()):
+            self.assertEqual(streamed_frame.pixels.tolist(), file_frame.pixels.tolist())
+
+
+class TestVisualProgress(unittest.TestCase):
+    def test_batched_progress(self):
+        import numpy as np
+
+        rng = np.random.RandomState(42)
+        histograms = []
+        for i in range(50):
+            counts = rng.randint(0, 5000, (3, 256)) * (rng.rand(3, 256) < 0.3)
+            histograms.append(
+                dict((c, [int(v) for v in counts[k]]) for k, c in enumerate("rgb"))
+            )
+        first = histograms[0]
+        last = histograms[-1]
+        expected = [calculate_frame_progress(h, first, last) for h in histograms]
+        self.assertEqual(calculate_frames_progress(histograms, first, last), expected)
+        self.assertEqual(
+            calculate_frames_progress(histograms[:2], first, first), [100, 100]
+        )
+
+
+class TestHistograms(unittest.TestCase):
+    def test_vectorized_histogram(self):
+        import numpy as np
+
+        rng = np.random.RandomState(7)
+        pixels = rng.randint(200, 256, (37, 53, 3)).astype(np.uint8)
+        pixels[:10] = 255
+        store = FrameStore(None, "ms_")
+        frame = store.add(0, pixels=pixels)
+        expected = calculate_image_histogram_getcolors(frame)
+        self.assertEqual(calculate_pixels_histogram(pixels), expected)
+        # Counted in bands of a few rows
+        self.assertEqual(calculate_pixels_histogram(pixels, 100), expected)
+
+    def test_binary_histograms(self):
+        directory = tempfile.mkdtemp()
+        try:
+            histograms = [
+                {
+                    "time": time,
+                    "file": "ms_{0:06d}.png".format(time),
+                    "histogram": {
+                        "r": [time + i for i in range(256)],
+                        "g": [i for i in range(256)],
+                        "b": [time * 7 % 13 for i in range(256)],
+                    },
+                }
+                for time in [0, 100, 250, 400, 1000]
+            ]
+            json_file = os.path.join(directory, "histograms.json.gz")
+            with gzip.open(json_file, "wb") as f:
+                f.write(json.dumps(histograms).encode("utf-8"))
+            binary_file = os.path.join(directory, "histograms.bin")
+            save_histograms_binary(binary_file, histograms)
+            for start, end in [(0, 0), (100, 400), (120, 260), (300, 0), (50, 20)]:
+                expected = load_histograms(json_file, start, end)
+                binary = load_histograms(binary_file, start, end)
+                self.assertEqual(list(binary), expected)
+                self.assertEqual(
+                    calculate_visual_progress(binary),
+                    calculate_visual_progress(expected),
+                )
+        finally:
+            shutil.rmtree(directory)
+
+    def test_parallel_histograms(self):
+        import numpy as np
+
+        rng = np.random.RandomState(11)
+        directory = tempfile.mkdtemp()
+        store = FrameStore(directory, "ms_")
+        for index in range(visualmetrics.MIN_PARALLEL_FRAMES * 2):
+            store.add(index * 100, pixels=rng.randint(0, 256, (24, 32, 3), np.uint8))
+        saved_options = visualmetrics.options
+        try:
+            results = {}
+            for workers in ["1", "2"]:
+                visualmetrics.options = get_parser().parse_args(["--workers", workers])
+                histograms_file = os.path.join(directory, workers + ".json.gz")
+                visualmetrics.calculate_histograms(
+                    directory, histograms_file, False, store
+                )
+                results[workers] = load_histograms(histograms_file, 0, 0)
+                if workers == "2":
+                    # The next stage runs on the same workers
+                    pool = visualmetrics.worker_pool
+                    self.assertIsNotNone(pool)
+                    visualmetrics.map_frames(
+                        abs, list(range(visualmetrics.MIN_PARALLEL_FRAMES))
+                    )
+                    self.assertIs(visualmetrics.worker_pool, pool)
+            self.assertEqual(len(results["1"]), visualmetrics.MIN_PARALLEL_FRAMES * 2)
+            self.assertEqual(results["2"], results["1"])
+        finally:
+            visualmetrics.close_worker_pool()
+            visualmetrics.options = saved_options
+            shutil.rmtree(directory)
+
+
+class TestContentfulness(unittest.TestCase):
+    def test_edge_count(self):
+        import numpy as np
+
+        pixels = np.full((60, 80, 3), 255, dtype=np.uint8)
+        pixels[20:40, 30:50] = 0
+        edges = calculate_edge_count(pixels)
+        self.assertTrue(0 < edges < 60 * 80 / 4)
+
+    @unittest.skipUnless(HAS_IMAGEMAGICK, "ImageMagick is not installed")
+    def test_imagemagick_parity(self):
+        directory = os.path.join(HERE, "test_data")
+        files = sorted(
+            os.path.join(directory, f)
+            for f in os.listdir(directory)
+            if f.startswith("ms_")
+        )[1:]
+        native = [calculate_edge_count(load_job_pixels(f)) for f in files]
+        imagemagick = [calculate_edge_count_imagemagick(f) for f in files]
+        for a, b in zip(native, imagemagick):
+            self.assertAlmostEqual(
+                float(a) / max(native), float(b) / max(imagemagick), delta=0.05
+            )
+
+
+@unittest.skipIf(ssim is None, "pyssim is not installed")
+class TestPerceptual(unittest.TestCase):
+    def test_ssim_matches_compute_ssim(self):
+        import numpy as np
+        from PIL import Image
+
+        directory = os.path.join(HERE, "test_data")
+        files = [
+            os.path.join(directory, name) for name in sorted(os.listdir(directory))
+        ]
+        target = files[-1]
+        expected = [
+            ssim.compute_ssim(Image.open(target), Image.open(name))
+            for name in files[0:-1]
+        ]
+        pixels = [np.array(Image.open(name).convert("RGB")) for name in files]
+        self.assertGreaterEqual(len(files) - 1, visualmetrics.MIN_PARALLEL_FRAMES)
+        saved_options = visualmetrics.options
+        try:
+            for workers in ["1", "2"]:
+                visualmetrics.options = get_parser().parse_args(["--workers", workers])
+                # Frames decoded by the workers and frames already in memory
+                for jobs, target_job in [(files, target), (pixels, pixels[-1])]:
+                    scores = visualmetrics.map_frames(
+                        visualmetrics.calculate_ssim_job,
+                        jobs[0:-1],
+                        visualmetrics.init_ssim_target,
+                        (target_job,),
+                    )
+                    for score, reference in zip(scores, expected):
+                        self.assertAlmostEqual(score, reference, places=9)
+                    self.assertEqual(len(scores), len(expected))
+                self.assertEqual(visualmetrics.worker_pool is not None, workers == "2")
+        finally:
+            visualmetrics.close_worker_pool()
+            visualmetrics.options = saved_options
+
+
+class TestHeroTimes(unittest.TestCase):
+    def test_hero_times(self):
+        import numpy as np
+
+        store = FrameStore(None, "ms_")
+        pixels = np.full((100, 200, 3), 255, dtype=np.uint8)
+        store.add(0, pixels=pixels.copy())
+        # The logo renders at 100ms (with 1 of its 231 pixels still off) and
+        # the image at 300ms. A hero outside of the frame matches right away.
+        pixels[10:20, 10:30] = 0
+        pixels[10, 30] = 200
+        store.add(100, pixels=pixels.copy())
+        pixels[40:80, 50:150] = 30
+        store.add(200, pixels=pixels.copy())
+        pixels[40:80, 50:150] = 60
+        store.add(300, pixels=pixels.copy())
+        pixels[10, 30] = 0
+        pixels[95, 0:200] = 0
+        store.add(400, pixels=pixels.copy())
+        progress = [{"time": time} for time in store.times]
+        heroes = [
+            {"name": "logo", "x": 20, "y": 20, "width": 40, "height": 20},
+            {"name": "image", "x": 100, "y": 80, "width": 198, "height": 78},
+            {"name": "missing", "x": 1000, "y": 1000, "width": 10, "height": 10},
+        ]
+        times = calculate_hero_times(
+            progress, None, heroes, {"width": 400, "height": 200}, store
+        )
+        self.assertEqual(times, [100, 300, 0])
+
+
+class TestTimeline(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.events = [
+            {"cat": "devtools.timeline", "name": "Paint", "ts": 1000, "dur": 500},
+            {"cat": "toplevel", "name": "RunTask", "ts": 1200, "args": {"n": -1.5e3}},
+            {"cat": "devtools.timeline", "name": "Paint", "ts": 2000, "dur": 500},
+            {"cat": "devtools.timeline", "name": "ResourceSendRequest", "ts": 9500},
+            {"cat": "devtools.timeline", "name": "Paint", "ts": 9000},
+        ]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_stream(self):
+        trace = json.dumps({"metadata": {"v": [1, "]"]}, "traceEvents": self.events})
+        reader = JsonStreamReader(io.BytesIO(trace.encode("utf-8")), chunk_size=7)
+        reader.expect("{")
+        self.assertEqual(reader.value(), "metadata")
+        reader.expect(":")
+        self.assertEqual(reader.value(), {"v": [1, "]"]})
+        reader.expect(",")
+        self.assertEqual(reader.value(), "traceEvents")
+        reader.expect(":")
+        self.assertEqual(list(reader.array()), self.events)
+
+    def test_get_timeline_offset(self):
+        trace = os.path.join(self.directory, "trace.json.gz")
+        with gzip.open(trace, "wb") as f:
+            f.write(json.dumps({"traceEvents": self.events}).encode("utf-8"))
+        timeline = os.path.join(self.directory, "timeline.json")
+        # Everything after the first navigation is never parsed
+        with open(timeline, "w") as f:
+            f.write(json.dumps(self.events)[:-20])
+        self.assertEqual(get_timeline_offset(trace), 7)
+        self.assertEqual(get_timeline_offset(timeline), 7)
+
+
+class TestStageManifest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_checkpoints(self):
+        path = os.path.join(self.directory, "manifest.json")
+        manifest = StageManifest(path)
+        inputs = {"video": "abc", "orange": True, "trimend": 0}
+        self.assertIsNone(manifest.check("frames", inputs))
+        manifest.record("frames", inputs)
+        manifest.record("perceptual", {"start": 0}, {"result": (947, "0=0")})
+
+        # A later run reads the recorded stages back
+        manifest = StageManifest(path)
+        self.assertTrue(manifest.check("frames", dict(inputs)))
+        self.assertFalse(manifest.check("frames", dict(inputs, orange=False)))
+        self.assertEqual(
+            manifest.outputs("perceptual", {"start": 0}), {"result": [947, "0=0"]}
+        )
+        self.assertIsNone(manifest.outputs("perceptual", {"start": 100}))
+        self.assertIsNotNone(manifest.digest("frames"))
+        self.assertIsNone(manifest.digest("histograms"))
+
+
+class TestCapabilities(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_cache(self):
+        path = os.path.join(self.directory, "cache", "capabilities.json")
+        probes = []
+
+        def probe():
+            probes.append(1)
+            return "mpdecimate"
+
+        key = ["/usr/bin/ffmpeg", 1500000000.5]
+        self.assertEqual(Capabilities(path).get("decimate", key, probe), "mpdecimate")
+        # A later process reads the probe back until the binary changes
+        self.assertEqual(Capabilities(path).get("decimate", key, probe), "mpdecimate")
+        self.assertEqual(len(probes), 1)
+        changed = ["/usr/bin/ffmpeg", 1600000000.5]
+        Capabilities(path).get("decimate", changed, probe)
+        self.assertEqual(len(probes), 2)
+        # Missing tools and failed probes are never persisted
+        Capabilities(path).get("hwaccels", None, lambda: [])
+        Capabilities(path).get("hwaccels", key, lambda: None)
+        self.assertNotIn("hwaccels", Capabilities(path).entries)
+
+    def test_check_config_without_ffmpeg(self):
+        saved_options = visualmetrics.options
+        saved_path = os.environ.get("PATH")
+        visualmetrics.options = get_parser().parse_args(
+            ["--capabilities", os.path.join(self.directory, "capabilities.json")]
+        )
+        os.environ["PATH"] = self.directory
+        out = io.StringIO()
+        try:
+            with contextlib.redirect_stdout(out):
+                ok = check_config()
+        finally:
+            os.environ["PATH"] = saved_path
+            visualmetrics.options = saved_options
+        self.assertFalse(ok)
+        lines = out.getvalue().split("\n")
+        self.assertEqual(lines[0:4], ["ffmpeg:  ", "FAIL", "hwaccel: ", "none"])
+        # The remaining checks still run
+        self.assertIn("convert: ", lines)
+        self.assertIn("SSIM:    ", lines)
+
+    def check_config_lines(self, modules):
+        saved = (
+            visualmetrics.options,
+            visualmetrics.has_module,
+            dict(visualmetrics.image_magick),
+        )
+        visualmetrics.options = get_parser().parse_args(
+            ["--capabilities", os.path.join(self.directory, "capabilities.json")]
+        )
+        visualmetrics.has_module = lambda name: name in modules
+        missing = os.path.join(self.directory, "missing")
+        visualmetrics.image_magick.update({"convert": missing, "compare": missing})
+        out = io.StringIO()
+        try:
+            with contextlib.redirect_stdout(out):
+                ok = check_config()
+        finally:
+            visualmetrics.options, visualmetrics.has_module = saved[0:2]
+            visualmetrics.image_magick.update(saved[2])
+        lines = out.getvalue().split("\n")
+        return ok, dict(zip(lines[0::2], lines[1::2]))
+
+    def test_check_config_engines(self):
+        # NumPy replaces ImageMagick for the frame comparisons
+        ok, status = self.check_config_lines(["numpy", "PIL", "ssim"])
+        self.assertEqual(status["convert: "], "not found (using NumPy)")
+        self.assertEqual(status["compare: "], "not found (using NumPy)")
+        self.assertEqual(status["NumPy:   "], "OK")
+        self.assertEqual(ok, HAS_FFMPEG)
+        # One of them is needed
+        ok, status = self.check_config_lines(["PIL", "ssim"])
+        self.assertFalse(ok)
+        self.assertEqual(status["convert: "], "FAIL")
+        self.assertEqual(status["NumPy:   "], "FAIL")
+        self.assertEqual(status["Pillow:  "], "OK")
+
+
+class TestJpegExport(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_convert_to_jpeg(self):
+        import numpy as np
+
+        store = FrameStore(self.directory, "ms_")
+        for time in [0, 100]:
+            store.add(time, pixels=np.full((90, 160, 3), time, dtype=np.uint8))
+        store.save(store.get(100))
+        convert_to_jpeg(self.directory, 75, store)
+        self.assertEqual(
+            sorted(os.listdir(self.directory)), ["ms_000000.jpg", "ms_000100.jpg"],
+        )
+        first = os.path.join(self.directory, "ms_000000.jpg")
+        second = os.path.join(self.directory, "ms_000100.jpg")
+        for path in [first, second]:
+            os.utime(path, (1, 1))
+
+        # A rerun loads the exported JPEGs, they are not encoded again
+        store = FrameStore.load(self.directory, "ms_")
+        self.assertEqual([frame.file for frame in store.list()], [first, second])
+        convert_to_jpeg(self.directory, 75, store)
+        self.assertEqual(os.path.getmtime(first), 1)
+        self.assertEqual(os.path.getmtime(second), 1)
+
+
+class TestRenderList(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_render_list(self):
+        import numpy as np
+
+        directory = os.path.join(self.directory, "it's frames")
+        os.mkdir(directory)
+        store = FrameStore(directory, "ms_")
+        for time in [0, 100, 350]:
+            store.add(time, pixels=np.full((16, 16, 3), time % 256, np.uint8))
+        frames = store.list()
+        script = visualmetrics.get_render_list(frames)
+        paths = [
+            os.path.realpath(store.path(time)).replace("'", "'\\''")
+            for time in [0, 100, 350]
+        ]
+        self.assertIn("it'\\''s frames", paths[0])
+        self.assertEqual(
+            script.splitlines(),
+            [
+                "ffconcat version 1.0",
+                "file '{0}'".format(paths[0]),
+                "duration 0.100",
+                "file '{0}'".format(paths[1]),
+                "duration 0.250",
+                "file '{0}'".format(paths[2]),
+                "duration 1.000",
+                "file '{0}'".format(paths[2]),
+            ],
+        )
+        if HAS_FFMPEG:
+            render_list = os.path.join(directory, "render.txt")
+            with open(render_list, "w") as f:
+                f.write(script)
+            subprocess.check_call(
+                ["ffmpeg", "-v", "error", "-f", "concat", "-safe", "0"]
+                + ["-i", render_list, "-f", "null", "-"]
+            )
+
+
+class TestColorCache(unittest.TestCase):
+    def test_lru(self):
+        cache = ColorCache(max_entries=2)
+        cache.put(("a", (222, 100, 13)), True)
+        cache.put(("b", (222, 100, 13)), False)
+        self.assertTrue(cache.get(("a", (222, 100, 13))))
+        # "b" is now the least recently used entry
+        cache.put(("c", (222, 100, 13)), True)
+        self.assertIsNone(cache.get(("b", (222, 100, 13))))
+        self.assertIsNone(cache.get(("a", (128, 128, 128))))
+        self.assertTrue(cache.get(("c", (222, 100, 13))))
+        self.assertEqual(len(cache), 2)
+        self.assertEqual((cache.hits, cache.misses), (2, 2))
+
+
+class TestColorFrames(unittest.TestCase):
+    def setUp(self):
+        import numpy as np
+
+        self.directory = tempfile.mkdtemp()
+        self.orange_file = os.path.join(self.directory, "orange.png")
+        self.white_file = os.path.join(self.directory, "white.png")
+        generate_orange_png(self.orange_file)
+        generate_white_png(self.white_file)
+        self.store = FrameStore(None, "ms_")
+        orange = np.zeros((300, 400, 3), dtype=np.uint8)
+        orange[:, :] = (222, 100, 13)
+        # Page content over the middle and the bottom of the orange frame
+        orange[100:, :] = 255
+        self.orange = self.store.add(0, pixels=orange)
+        white = np.full((300, 400, 3), 255, dtype=np.uint8)
+        white[140:160, 190:210] = (230, 240, 250)
+        self.white = self.store.add(100, pixels=white)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_is_color_frame(self):
+        self.assertTrue(is_color_frame(self.orange, self.orange_file))
+        self.assertTrue(is_color_frame(self.orange, self.orange_file, fuzz_percent=0.0))
+        self.assertFalse(is_color_frame(self.white, self.orange_file))
+        self.assertFalse(is_color_frame(self.white, self.orange_file, fuzz_percent=0.0))
+        # Close to the reference orange, only the fuzz makes it match
+        near_orange = self.orange.pixels.copy()
+        near_orange[:100] = (232, 112, 25)
+        near_orange = self.store.add(200, pixels=near_orange)
+        self.assertTrue(is_color_frame(near_orange, self.orange_file))
+        self.assertFalse(
+            is_color_frame(near_orange, self.orange_file, fuzz_percent=0.0)
+        )
+
+    def test_is_white_frame(self):
+        self.assertTrue(is_white_frame(self.white, self.white_file))
+        self.assertFalse(is_white_frame(self.white, self.white_file, fuzz_percent=1))
+        # Only the top of the orange frame is orange
+        self.assertTrue(is_white_frame(self.orange, self.white_file))
+        self.store.update(self.orange, self.orange.pixels[:100])
+        self.assertFalse(is_white_frame(self.orange, self.white_file))
+
+    @unittest.skipIf(platform.system() == "Windows", "Uses POSIX shell quoting")
+    def test_imagemagick_fallbacks(self):
+        from PIL import Image
+
+        # Stand-ins for convert and compare that report a fixed pixel count
+        compare_script = os.path.join(self.directory, "compare.py")
+        with open(compare_script, "w") as f:
+            f.write(
+                "import os, sys\n"
+                "sys.stdin.read()\n"
+                'sys.stderr.write(os.environ["VISUALMETRICS_TEST_AE"])\n'
+            )
+        frame = os.path.join(self.directory, "frame.png")
+        Image.fromarray(self.white.pixels).save(frame)
+        saved_tools = dict(visualmetrics.image_magick)
+        saved_options = visualmetrics.options
+        saved_environment = os.environ.get("VISUALMETRICS_TEST_AE")
+        visualmetrics.image_magick["convert"] = '"{0}" -c pass'.format(sys.executable)
+        visualmetrics.image_magick["compare"] = '"{0}" "{1}"'.format(
+            sys.executable, compare_script
+        )
+        visualmetrics.options = get_parser().parse_args([])
+        try:
+            os.environ["VISUALMETRICS_TEST_AE"] = "12"
+            self.assertTrue(
+                is_color_frame_imagemagick(frame, self.orange_file, 15, 0.25)
+            )
+            self.assertTrue(
+                is_white_frame_imagemagick(frame, self.white_file, 10, 0.0125)
+            )
+            os.environ["VISUALMETRICS_TEST_AE"] = "20000"
+            self.assertFalse(
+                is_color_frame_imagemagick(frame, self.orange_file, 15, 0.25)
+            )
+            self.assertFalse(
+                is_white_frame_imagemagick(frame, self.white_file, 10, 0.0125)
+            )
+        finally:
+            visualmetrics.image_magick.update(saved_tools)
+            visualmetrics.options = saved_options
+            if saved_environment is None:
+                del os.environ["VISUALMETRICS_TEST_AE"]
+            else:
+                os.environ["VISUALMETRICS_TEST_AE"] = saved_environment
+
+
+class TestAnalyzer(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _histograms(self):
+        blank = {"r": [0] * 256, "g": [0] * 256, "b": [0] * 256}
+        half = {"r": [0] * 256, "g": [0] * 256, "b": [0] * 256}
+        full = {"r": [0] * 256, "g": [0] * 256, "b": [0] * 256}
+        for channel in ["r", "g", "b"]:
+            half[channel][10] = 50
+            full[channel][10] = 100
+        path = os.path.join(self.directory, "histograms.json.gz")
+        with gzip.open(path, "wb") as f:
+            histograms = [
+                {"time": 0, "file": "ms_000000.png", "histogram": blank},
+                {"time": 100, "file": "ms_000100.png", "histogram": half},
+                {"time": 300, "file": "ms_000300.png", "histogram": full},
+            ]
+            f.write(json.dumps(histograms).encode("utf-8"))
+        return path
+
+    def test_analyze(self):
+        analyzer = Analyzer(histogram=self._histograms())
+        metrics = analyzer.analyze()
+        self.assertEqual(metrics["SpeedIndex"], 200)
+        self.assertEqual(metrics["VisualProgress"], "0=0, 100=50, 300=100")
+        self.assertEqual(analyzer.analyze(end=100)["SpeedIndex"], 100)
+        self.assertRaises(ValueError, analyzer.analyze, nope=True)
+
+    def test_worker(self):
+        jobs = [
+            {"id": 1, "options": {"histogram": self._histograms()}},
+            {"id": 2, "options": {"nope": True}},
+            {"id": 3, "options": {"histogram": self._histograms(), "end": 100}},
+        ]
+        output = io.StringIO()
+        run_worker(
+            Analyzer(),
+            io.StringIO(u"\n".join(json.dumps(job) for job in jobs) + u"\n"),
+            output,
+        )
+        results = [json.loads(line) for line in output.getvalue().splitlines()]
+        self.assertEqual([result["id"] for result in results], [1, 2, 3])
+        self.assertEqual(results[0]["metrics"]["SpeedIndex"], 200)
+        self.assertIn("error", results[1])
+        self.assertEqual(results[2]["metrics"]["LastVisualChange"], 100)
+
+    def test_batch_jobs(self):
+        for name in ["b.mp4", "a.mp4", "c.webm"]:
+            open(os.path.join(self.directory, name), "w").close()
+        settings = get_parser().parse_args(
+            [
+                "--batch",
+                os.path.join(self.directory, "*.mp4"),
+                "missing.mp4",
+                "--dir",
+                os.path.join(self.directory, "{name}-{index}"),
+                "--perceptual",
+                "--workers",
+                "8",
+            ]
+        )
+        jobs = get_batch_jobs(settings)
+        self.assertEqual(
+            [os.path.basename(job.video) for job in jobs],
+            ["a.mp4", "b.mp4", "missing.mp4"],
+        )
+        self.assertEqual(jobs[1].dir, os.path.join(self.directory, "b-1"))
+        self.assertEqual(jobs[1].output, os.path.join(self.directory, "b.json"))
+        self.assertTrue(all(job.perceptual and job.workers == 1 for job in jobs))
+
+    def test_batch_path_error(self):
+        def error(*arguments):
+            return get_batch_path_error(get_parser().parse_args(list(arguments)))
+
+        self.assertIsNone(error("--batch", "*.mp4"))
+        self.assertIsNone(error("--batch", "*.mp4", "--dir", "{dir}/{name}"))
+        self.assertIsNone(error("--batch", "a.mp4", "b.mp4", "--dir", "{index:03d}"))
+        # Every video in a directory would write to the same place
+        self.assertEqual(
+            error("--batch", "*.mp4", "--dir", "{dir}/frames"),
+            "--dir needs a {name} or {index} field in --batch mode",
+        )
+        self.assertIn(
+            "--output", error("--batch", "a.mp4", "b.mp4", "--output", "{dir}.json")
+        )
+        self.assertIn("--progress", error("--batch", "*.mp4", "--progress", "p.json"))
+        # A single video can't collide with anything
+        self.assertIsNone(error("--batch", "a.mp4", "--dir", "{dir}/frames"))
+
+    @unittest.skipUnless(HAS_FFMPEG, "ffmpeg is not installed")
+    def test_run_batch(self):
+        for name in ["a.mp4", "b.mp4"]:
+            make_test_video(os.path.join(self.directory, name))
+        missing = os.path.join(self.directory, "missing.mp4")
+        settings = get_parser().parse_args(
+            ["--batch", os.path.join(self.directory, "*.mp4"), missing]
+            + ["--workers", "2"]
+        )
+        saved_options = visualmetrics.options
+        visualmetrics.options = settings
+        output = io.StringIO()
+        try:
+            ok = visualmetrics.run_batch(get_batch_jobs(settings), output)
+        finally:
+            visualmetrics.options = saved_options
+        self.assertFalse(ok)
+        results = [json.loads(line) for line in output.getvalue().splitlines()]
+        self.assertEqual(
+            [os.path.basename(result["video"]) for result in results],
+            ["a.mp4", "b.mp4", "missing.mp4"],
+        )
+        for result in results[0:2]:
+            self.assertNotIn("error", result)
+            with open(result["output"]) as f:
+                metrics = json.load(f)
+            self.assertEqual(metrics["LastVisualChange"], 900)
+            self.assertGreater(metrics["SpeedIndex"], 0)
+        self.assertIn("error", results[2])
+        self.assertFalse(os.path.exists(results[2]["output"]))
+
+    @unittest.skipUnless(HAS_FFMPEG and ssim is not None, "ffmpeg or pyssim missing")
+    def test_rerun_with_new_stage(self):
+        make_test_video(os.path.join(self.directory, "video.mp4"))
+        saved_directory = os.getcwd()
+        # A relative --dir, the second run reuses the frames extracted into it
+        os.chdir(self.directory)
+        try:
+            analyzer = Analyzer()
+            first = analyzer.analyze("video.mp4", dir="frames")
+            second = analyzer.analyze(
+                "video.mp4", dir="frames", perceptual=True, contentful=True
+            )
+        finally:
+            os.chdir(saved_directory)
+        self.assertNotIn("PerceptualSpeedIndex", first)
+        self.assertEqual(second["SpeedIndex"], first["SpeedIndex"])
+        self.assertGreater(second["PerceptualSpeedIndex"], 0)
+        self.assertGreater(second["ContentfulSpeedIndex"], 0)
@@ -30,24 +30,397 @@ SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE."""
 # The original script from Google was heavily modified for the Browsertime
 # project.
 #
+import bisect
+import codecs
+import collections
+import copy
 import gc
 import glob
 import gzip
+import hashlib
+import io
 import json
 import logging
 import math
+import multiprocessing
 import os
 import platform
 import re
 import shutil
+import struct
 import subprocess
 import tempfile
+import threading
 
 # Globals
 options = None
 client_viewport = None
 image_magick = {"convert": "convert", "compare": "compare", "mogrify": "mogrify"}
-frame_cache = {}
+compare_engine = None
+color_cache = None
+ssim_target = None
+manifest = None
+worker_pool = None
+worker_pool_size = 0
+worker_stage = None
+map_count = 0
+videoRecordingStart = None
+capabilities = None
+
+# #################################################################################################
+# Frame store
+# #################################################################################################
+
+
+class VideoFrame(object):
+    """Handle to one frame of a FrameStore"""
+
+    def __init__(self, store, time, file=None):
+        self.store = store
+        self.time = time
+        self.file = file
+        self.data = None
+
+    @property
+    def pixels(self):
+        """The decoded (height, width, 3) RGB array"""
+        return self.store.get_pixels(self)
+
+    @property
+    def size(self):
+        height, width = self.pixels.shape[:2]
+        return width, height
+
+    def image(self):
+        from PIL import Image
+
+        return Image.fromarray(self.pixels)
+
+    def __str__(self):
+        if self.file is not None:
+            return self.file
+        return "{0}{1:06d}".format(self.store.prefix, self.time)
+
+
+class FrameStore(object):
+    """The frames of one video directory, ordered by their time (in ms).
+
+    Every frame is decoded at most once. Decoded frames are kept in memory
+    until max_memory bytes are used and are then spilled to a memory-mapped
+    raw file. The stages remove, move and re-time frames through the store,
+    which keeps the files on disk (if any) in sync.
+    """
+
+    def __init__(self, directory, prefix, extension=".png", max_memory=None):
+        self.directory = directory
+        self.prefix = prefix
+        self.extension = extension
+        self.max_memory = max_memory
+        self.memory = 0
+        self.spill_file = None
+        self.spill_size = 0
+        self.times = []
+        self.frames = {}
+
+    @classmethod
+    def load(cls, directory, prefix, max_memory=None):
+        """Index the existing png (or jpg) frames of a directory"""
+        store = cls(directory, prefix, max_memory=max_memory)
+        for extension in [".png", ".jpg"]:
+            files = glob.glob(os.path.join(directory, prefix + "*" + extension))
+            if len(files):
+                store.extension = extension
+                match = re.compile(re.escape(prefix) + r"(?P<ms>[0-9]+)\.")
+                for file in files:
+                    m = re.search(match, os.path.basename(file))
+                    if m is not None:
+                        store.add(int(m.groupdict().get("ms")), file=file)
+                break
+        return store
+
+    def __len__(self):
+        return len(self.times)
+
+    def list(self):
+        """Snapshot of the frame handles, sorted by time"""
+        return [self.frames[time] for time in self.times]
+
+    def get(self, time):
+        return self.frames.get(time)
+
+    def path(self, time):
+        return os.path.join(
+            self.directory, "{0}{1:06d}{2}".format(self.prefix, time, self.extension)
+        )
+
+    def add(self, time, pixels=None, file=None):
+        """Add a frame, replacing any frame that already has the same time"""
+        if time in self.frames:
+            self.remove(self.frames[time])
+        frame = VideoFrame(self, time, file)
+        if pixels is not None:
+            self.set_pixels(frame, pixels)
+        self.frames[time] = frame
+        bisect.insort(self.times, time)
+        return frame
+
+    def remove(self, frame):
+        self.detach(frame)
+        if frame.file is not None and os.path.isfile(frame.file):
+            os.remove(frame.file)
+
+    def detach(self, frame):
+        del self.frames[frame.time]
+        del self.times[bisect.bisect_left(self.times, frame.time)]
+        if frame.data is not None and not self.is_spilled(frame.data):
+            self.memory -= frame.data.nbytes
+
+    def move(self, frame, store):
+        """Move a frame (and its file) into another store"""
+        self.detach(frame)
+        file = frame.file
+        if file is not None:
+            file = os.path.join(store.directory, os.path.basename(file))
+            os.rename(frame.file, file)
+        moved = store.add(frame.time, file=file)
+        if frame.data is not None:
+            store.set_pixels(moved, frame.data)
+        return moved
+
+    def copy(self, frame, store):
+        file = frame.file
+        if file is not None:
+            file = os.path.join(store.directory, os.path.basename(file))
+            shutil.copyfile(frame.file, file)
+        copied = store.add(frame.time, file=file)
+        if frame.data is not None:
+            store.set_pixels(copied, frame.data)
+        return copied
+
+    def shift(self, offset, prefix=None):
+        """Move every frame offset ms earlier (stopping at 0), optionally renaming
+        the files to a new prefix. Frames that end up at the same time replace
+        the earlier ones."""
+        if prefix is not None:
+            self.prefix = prefix
+        for frame in self.list():
+            self.detach(frame)
+            time = max(frame.time - offset, 0)
+            file = frame.file
+            if file is not None:
+                file = self.path(time)
+                if frame.file != file:
+                    if os.path.isfile(file):
+                        os.remove(file)
+                    os.rename(frame.file, file)
+            if time in self.frames:
+                self.detach(self.frames[time])
+            frame.time = time
+            frame.file = file
+            self.frames[time] = frame
+            bisect.insort(self.times, time)
+            if frame.data is not None and not self.is_spilled(frame.data):
+                self.memory += frame.data.nbytes
+
+    def save(self, frame):
+        """Write a frame that only lives in memory to its file"""
+        if frame.file is None:
+            file = self.path(frame.time)
+            frame.image().save(file)
+            frame.file = file
+        return frame.file
+
+    def update(self, frame, pixels):
+        """Replace the pixels of a frame (and rewrite its file)"""
+        if frame.data is not None and not self.is_spilled(frame.data):
+            self.memory -= frame.data.nbytes
+        frame.data = None
+        self.set_pixels(frame, pixels)
+        if frame.file is not None:
+            frame.image().save(frame.file)
+
+    def invalidate(self, frame):
+        """Forget the decoded pixels after the file was changed on disk"""
+        if frame.data is not None and not self.is_spilled(frame.data):
+            self.memory -= frame.data.nbytes
+        frame.data = None
+
+    def get_pixels(self, frame):
+        if frame.data is None:
+            import numpy as np
+            from PIL import Image
+
+            logging.debug("Decoding frame %s", frame.file)
+            with Image.open(frame.file) as im:
+                self.set_pixels(frame, np.asarray(im.convert("RGB")))
+        return frame.data
+
+    def set_pixels(self, frame, pixels):
+        if self.is_spilled(pixels):
+            frame.data = pixels
+        elif (
+            self.max_memory is not None
+            and self.memory + pixels.nbytes > self.max_memory
+        ):
+            frame.data = self.spill(pixels)
+        else:
+            frame.data = pixels
+            self.memory += pixels.nbytes
+
+    def spill(self, pixels):
+        import numpy as np
+
+        if self.spill_file is None:
+            self.spill_file = tempfile.TemporaryFile(prefix="vis-frames-")
+        offset = self.spill_size
+        self.spill_file.seek(offset)
+        self.spill_file.write(np.ascontiguousarray(pixels, dtype=np.uint8).tobytes())
+        self.spill_file.flush()
+        self.spill_size += pixels.nbytes
+        return np.memmap(
+            self.spill_file, dtype=np.uint8, mode="r", offset=offset, shape=pixels.shape
+        )
+
+    def is_spilled(self, pixels):
+        import numpy as np
+
+        return isinstance(pixels, np.memmap)
+
+
+# #################################################################################################
+# Stage manifest
+# #################################################################################################
+
+
+class StageManifest(object):
+    """Inputs and outputs of the processing stages that ran in a directory.
+
+    A stage whose recorded inputs match the current ones reuses its outputs
+    instead of running again. The manifest file is rewritten every time a
+    stage completes, so an interrupted run keeps the stages it finished.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.stages = {}
+        if path is not None and os.path.isfile(path):
+            try:
+                with open(path) as f:
+                    self.stages = json.load(f).get("stages", {})
+            except Exception:
+                logging.exception("Ignoring the invalid stage manifest " + path)
+
+    def has(self, stage):
+        return stage in self.stages
+
+    def check(self, stage, inputs):
+        """True when the stage ran with these inputs, False when it ran with
+        different ones and None when it has not run"""
+        if stage not in self.stages:
+            return None
+        return self.stages[stage]["inputs"] == json.loads(json.dumps(inputs))
+
+    def outputs(self, stage, inputs):
+        if self.check(stage, inputs):
+            return self.stages[stage]["outputs"]
+        return None
+
+    def digest(self, stage):
+        """Hash of the recorded inputs of a stage, for the stages that use its
+        outputs"""
+        if stage not in self.stages:
+            return None
+        inputs = json.dumps(self.stages[stage]["inputs"], sort_keys=True)
+        return hashlib.sha1(inputs.encode("utf-8")).hexdigest()
+
+    def record(self, stage, inputs, outputs=None):
+        self.stages[stage] = {"inputs": inputs, "outputs": outputs}
+        self.save()
+
+    def reset(self):
+        self.stages = {}
+
+    def save(self):
+        if self.path is None or not os.path.isdir(os.path.dirname(self.path)):
+            return
+        try:
+            temp_file = self.path + ".tmp"
+            with open(temp_file, "w") as f:
+                json.dump({"version": 1, "stages": self.stages}, f, sort_keys=True)
+            if platform.system() == "Windows" and os.path.isfile(self.path):
+                os.remove(self.path)
+            os.rename(temp_file, self.path)
+        except Exception:
+            logging.exception("Error writing the stage manifest " + self.path)
+
+
+def get_file_hash(path):
+    """sha1 of a file's content (None if there is no file)"""
+    if path is None or not os.path.isfile(path):
+        return None
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def write_file_atomic(path, data):
+    """Write the bytes to a temporary file next to path and rename it into
+    place, so readers never see a partially written file"""
+    temp_file = "{0}.{1:d}.tmp".format(path, os.getpid())
+    try:
+        with open(temp_file, "wb") as f:
+            f.write(data)
+        if platform.system() == "Windows" and os.path.isfile(path):
+            os.remove(path)
+        os.rename(temp_file, path)
+    finally:
+        if os.path.isfile(temp_file):
+            os.remove(temp_file)
+
+
+def get_frames_inputs(video, timeline_file):
+    """The inputs of the frame extraction stage: the video and every option
+    that the extraction and clean-up stages look at"""
+    inputs = {"video": get_file_hash(video), "timeline": get_file_hash(timeline_file)}
+    for name in [
+        "endwhite",
+        "findstart",
+        "forceblank",
+        "full",
+        "gray",
+        "hwdecode",
+        "maxframes",
+        "multiple",
+        "notification",
+        "orange",
+        "renderignore",
+        "startwhite",
+        "thumbsize",
+        "trimend",
+        "viewport",
+        "viewporttime",
+        "white",
+    ]:
+        inputs[name] = getattr(options, name, None)
+    inputs["engine"] = get_compare_engine()
+    return inputs
+
+
+def run_stage(stage, inputs, function, *args):
+    """Run a metrics stage, or reuse its result when its inputs did not change"""
+    if manifest is None or inputs is None:
+        return function(*args)
+    outputs = manifest.outputs(stage, inputs)
+    if outputs is not None:
+        logging.debug("Reusing the results of the %s stage", stage)
+        return outputs["result"]
+    result = function(*args)
+    if result is not None and not (isinstance(result, tuple) and None in result):
+        manifest.record(stage, inputs, {"result": result})
+    return result
+
 
 # #################################################################################################
 # Frame Extraction and de-duplication
@@ -68,13 +441,25 @@ def video_to_frames(
     timeline_file,
     trim_end,
 ):
-    """ Extract the video frames"""
+    """ Extract the video frames.
+
+    Returns the FrameStore of the extracted frames (None when multiple videos
+    were split or nothing was extracted)."""
     global client_viewport
+    frames = None
+    inputs = None
+    extracted = False
+    if manifest is not None:
+        inputs = get_frames_inputs(video, timeline_file)
     first_frame = os.path.join(directory, "ms_000000")
     if (
-        not os.path.isfile(first_frame + ".png")
-        and not os.path.isfile(first_frame + ".jpg")
-    ) or force:
+        (
+            not os.path.isfile(first_frame + ".png")
+            and not os.path.isfile(first_frame + ".jpg")
+        )
+        or force
+        or (manifest is not None and manifest.check("frames", inputs) is False)
+    ):
         if os.path.isfile(video):
             video = os.path.realpath(video)
             logging.info("Processing frames from video " + video + " to " + directory)
@@ -88,36 +473,48 @@ def video_to_frames(
                     video, directory, find_viewport, viewport_time
                 )
                 gc.collect()
-                if extract_frames(video, directory, full_resolution, viewport):
+                video_frames = extract_frames(
+                    video, directory, full_resolution, viewport
+                )
+                if video_frames is not None and len(video_frames):
                     client_viewport = None
                     if find_viewport and options.notification:
-                        client_viewport = find_image_viewport(
-                            os.path.join(directory, "video-000000.png")
-                        )
+                        client_viewport = find_image_viewport(video_frames.list()[0])
                     if multiple and orange_file is not None:
-                        directories = split_videos(directory, orange_file)
+                        stores = split_videos(video_frames, orange_file)
                     else:
-                        directories = [directory]
-                    for dir in directories:
-                        trim_video_end(dir, trim_end)
+                        stores = [video_frames]
+                    for store in stores:
+                        trim_video_end(store, trim_end)
                         if orange_file is not None:
-                            remove_frames_before_orange(dir, orange_file)
-                            remove_orange_frames(dir, orange_file)
-                        find_first_frame(dir, white_file)
-                        blank_first_frame(dir)
-                        find_render_start(dir, orange_file, gray_file)
-                        find_last_frame(dir, white_file)
-                        adjust_frame_times(dir)
+                            remove_frames_before_orange(store, orange_file)
+                            remove_orange_frames(store, orange_file)
+                        find_first_frame(store, white_file)
+                        blank_first_frame(store)
+                        find_render_start(store, orange_file, gray_file)
+                        find_last_frame(store, white_file)
+                        adjust_frame_times(store)
                         if timeline_file is not None and not multiple:
-                            synchronize_to_timeline(dir, timeline_file)
-                        eliminate_duplicate_frames(dir)
-                        eliminate_similar_frames(dir)
+                            synchronize_to_timeline(store, timeline_file)
+                        eliminate_duplicate_frames(store)
+                        eliminate_similar_frames(store)
                         # See if we are limiting the number of frames to keep
                         # (before processing them to save processing time)
                         if options.maxframes > 0:
-                            cap_frame_count(dir, options.maxframes)
-                        crop_viewport(dir)
+                            cap_frame_count(store, options.maxframes)
+                        crop_viewport(store)
+                        # Only the frames that survived are written out, and
+                        # only when they are needed on disk after this run
+                        # (JPEGs are exported from memory at the end).
+                        if multiple or (
+                            options.dir is not None and options.quality is None
+                        ):
+                            for frame in store.list():
+                                store.save(frame)
                         gc.collect()
+                    extracted = True
+                    if not multiple:
+                        frames = stores[0]
                 else:
                     logging.critical("Error extracting the video frames from %s", video)
             else:
@@ -126,11 +523,100 @@ def video_to_frames(
             logging.critical("Input video file %s does not exist", video)
     else:
         logging.info("Extracted video already exists in %s", directory)
+    if manifest is not None and extracted:
+        # Everything that was computed from the previous frames is stale
+        manifest.reset()
+        manifest.record("frames", inputs)
+    return frames
+
+
+def get_frame_memory():
+    """Bytes of decoded frames to keep in memory before spilling them to disk"""
+    if options is not None and options.framememory is not None:
+        return options.framememory * 1024 * 1024
+    return None
+
+
+def get_workers():
+    """Number of processes to spread the per-frame work across"""
+    if options is not None and getattr(options, "workers", None):
+        return max(1, options.workers)
+    return 1
+
+
+# Below this many frames starting the worker processes costs more than the
+# work they would take over
+MIN_PARALLEL_FRAMES = 16
+
+
+def map_frames(function, jobs, initializer=None, initargs=()):
+    """Run function over the jobs on a pool of worker processes.
+
+    The results come back in the order of the jobs. The initializer runs once
+    in every worker before its first job for this call, which is where state
+    shared by all of the jobs is set up. The pool is kept for the next stage
+    of the analysis (see close_worker_pool()) and short runs of fewer than
+    MIN_PARALLEL_FRAMES jobs are done in this process, where they finish
+    before the workers would have been started."""
+    global map_count
+    workers = min(get_workers(), len(jobs))
+    if workers <= 1 or len(jobs) < MIN_PARALLEL_FRAMES:
+        if initializer is not None:
+            initializer(*initargs)
+        return [function(job) for job in jobs]
+    logging.debug(
+        "Processing {0:d} frames with {1:d} workers".format(len(jobs), workers)
+    )
+    map_count += 1
+    size = max(1, int(len(jobs) / (workers * 4)))
+    tasks = []
+    for start in range(0, len(jobs), size):
+        end = start + size
+        tasks.append((map_count, initializer, initargs, function, jobs[start:end]))
+    results = []
+    for chunk in get_worker_pool(workers).map(run_frame_jobs, tasks, 1):
+        results.extend(chunk)
+    return results
+
+
+def run_frame_jobs(task):
+    """Run a chunk of map_frames() jobs in a pool worker"""
+    global worker_stage
+    stage, initializer, initargs, function, jobs = task
+    if initializer is not None and worker_stage != stage:
+        initializer(*initargs)
+        worker_stage = stage
+    return [function(job) for job in jobs]
+
+
+def get_worker_pool(workers):
+    """The pool shared by the stages of an analysis, started on first use"""
+    global worker_pool, worker_pool_size
+    if worker_pool is not None and worker_pool_size != workers:
+        close_worker_pool()
+    if worker_pool is None:
+        worker_pool = multiprocessing.Pool(workers)
+        worker_pool_size = workers
+    return worker_pool
+
+
+def close_worker_pool():
+    """Stop the worker processes started by map_frames()"""
+    global worker_pool, worker_pool_size
+    if worker_pool is not None:
+        worker_pool.close()
+        worker_pool.join()
+        worker_pool = None
+        worker_pool_size = 0
 
 
 def extract_frames(video, directory, full_resolution, viewport):
-    """Extract and number the video frames"""
-    ret = False
+    """Extract and number the video frames.
+
+    Returns a FrameStore of the frames (None on failure). With NumPy the
+    frames are streamed from ffmpeg as raw RGB and stay in memory, otherwise
+    they are written to the directory as png files."""
+    frames = None
     logging.info("Extracting frames from " + video + " to " + directory)
     decimate = get_decimate_filter()
     if decimate is not None:
@@ -144,9 +630,6 @@ def extract_frames(video, directory, full_resolution, viewport):
         )
         if full_resolution:
             scale = ""
-        # escape directory name
-        # see https://en.wikibooks.org/wiki/FFMPEG_An_Intermediate_Guide/image_sequence#Percent_in_filename
-        dir_escaped = directory.replace("%", "%%")
         command = [
             "ffmpeg",
             "-v",
@@ -157,78 +640,160 @@ def extract_frames(video, directory, full_resolution, viewport):
             "0",
             "-vf",
             crop + scale + decimate + "=0:64:640:0.001",
-            os.path.join(dir_escaped, "img-%d.png"),
         ]
-        logging.debug(" ".join(command))
-        lines = []
-        proc = subprocess.Popen(command, stderr=subprocess.PIPE)
-        while proc.poll() is None:
-            lines.extend(iter(proc.stderr.readline, ""))
-
-        pattern = re.compile(r"keep pts:[0-9]+ pts_time:(?P<timecode>[0-9\.]+)")
-        frame_count = 0
-        for line in lines:
-            match = re.search(pattern, line)
+        if options.hwdecode and get_hwaccels():
+            command[3:3] = ["-hwaccel", "auto"]
+        if has_module("numpy"):
+            frames = stream_frames(command, directory)
+        else:
+            frames = extract_frame_files(command, directory)
+    return frames
+
+
+def stream_frames(command, directory):
+    """Read the frames from ffmpeg's rawvideo output straight into a FrameStore"""
+    import numpy as np
+
+    command = command + ["-f", "rawvideo", "-pix_fmt", "rgb24", "-"]
+    logging.debug(" ".join(command))
+    frames = FrameStore(directory, "video-", max_memory=get_frame_memory())
+    proc = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE,)
+    # ffmpeg logs the frame size and the time of every frame it keeps on
+    # stderr, which has to be drained while the frames are read from stdout.
+    size_ready = threading.Event()
+    size = {}
+    times = []
+    times_ready = threading.Condition()
+    keep_pattern = re.compile(r"keep pts:[0-9]+ pts_time:(?P<timecode>[0-9\.]+)")
+    size_pattern = re.compile(r"Video: rawvideo.*?, (?P<width>\d+)x(?P<height>\d+)")
+
+    def read_log():
+        output_started = False
+        for line in iter(proc.stderr.readline, b""):
+            line = line.decode("utf-8", "replace")
+            match = re.search(keep_pattern, line)
             if match:
-                frame_count += 1
-                frame_time = int(
-                    math.floor(float(match.groupdict().get("timecode")) * 1000)
-                )
-                src = os.path.join(directory, "img-{0:d}.png".format(frame_count))
-                dest = os.path.join(directory, "video-{0:06d}.png".format(frame_time))
-                logging.debug("Renaming " + src + " to " + dest)
-                os.rename(src, dest)
-                ret = True
-    return ret
+                with times_ready:
+                    times.append(
+                        int(math.floor(float(match.groupdict().get("timecode")) * 1000))
+                    )
+                    times_ready.notify()
+            elif line.startswith("Output #0"):
+                output_started = True
+            elif output_started and not size_ready.is_set():
+                match = re.search(size_pattern, line)
+                if match:
+                    size["width"] = int(match.group("width"))
+                    size["height"] = int(match.group("height"))
+                    size_ready.set()
+        size_ready.set()
+        with times_ready:
+            times.append(None)
+            times_ready.notify()
+
+    reader = threading.Thread(target=read_log)
+    reader.daemon = True
+    reader.start()
+    size_ready.wait()
+    if "width" in size:
+        width = size["width"]
+        height = size["height"]
+        frame_size = width * height * 3
+        frame_count = 0
+        while True:
+            data = proc.stdout.read(frame_size)
+            if len(data) < frame_size:
+                break
+            with times_ready:
+                while len(times) <= frame_count:
+                    times_ready.wait()
+                frame_time = times[frame_count]
+            if frame_time is None:
+                logging.debug("Video frame without a matching decimate time")
+                break
+            frame_count += 1
+            pixels = np.frombuffer(data, dtype=np.uint8).reshape(height, width, 3)
+            frames.add(frame_time, pixels=pixels)
+    proc.stdout.close()
+    proc.wait()
+    reader.join()
+    logging.debug("Extracted {0:d} video frames".format(len(frames)))
+    return frames
+
+
+def extract_frame_files(command, directory):
+    """Write the frames as numbered png files and rename them to their times"""
+    # escape directory name
+    # see https://en.wikibooks.org/wiki/FFMPEG_An_Intermediate_Guide/image_sequence#Percent_in_filename
+    dir_escaped = directory.replace("%", "%%")
+    command = command + [os.path.join(dir_escaped, "img-%d.png")]
+    logging.debug(" ".join(command))
+    proc = subprocess.Popen(command, stderr=subprocess.PIPE, universal_newlines=True)
+    lines = proc.stderr.readlines()
+    proc.wait()
+
+    pattern = re.compile(r"keep pts:[0-9]+ pts_time:(?P<timecode>[0-9\.]+)")
+    frame_count = 0
+    for line in lines:
+        match = re.search(pattern, line)
+        if match:
+            frame_count += 1
+            frame_time = int(
+                math.floor(float(match.groupdict().get("timecode")) * 1000)
+            )
+            src = os.path.join(directory, "img-{0:d}.png".format(frame_count))
+            dest = os.path.join(directory, "video-{0:06d}.png".format(frame_time))
+            logging.debug("Renaming " + src + " to " + dest)
+            os.rename(src, dest)
+    return FrameStore.load(directory, "video-", get_frame_memory())
 
 
-def split_videos(directory, orange_file):
+def split_videos(frames, orange_file):
     """Split multiple videos on orange frame separators"""
     logging.debug("Splitting video on orange frames (this may take a while)...")
-    directories = []
+    stores = []
     current = 0
     found_orange = False
-    video_dir = None
-    frames = sorted(glob.glob(os.path.join(directory, "video-*.png")))
-    if len(frames):
-        for frame in frames:
-            if is_color_frame(frame, orange_file):
-                if not found_orange:
-                    found_orange = True
-                    # Make a copy of the orange frame for the end of the
-                    # current video
-                    if video_dir is not None:
-                        dest = os.path.join(video_dir, os.path.basename(frame))
-                        shutil.copyfile(frame, dest)
-                    current += 1
-                    video_dir = os.path.join(directory, str(current))
-                    logging.debug(
-                        "Orange frame found: %s, starting video directory %s",
-                        frame,
-                        video_dir,
+    video_frames = None
+    for frame in frames.list():
+        if is_color_frame(frame, orange_file):
+            if not found_orange:
+                found_orange = True
+                # Make a copy of the orange frame for the end of the
+                # current video
+                if video_frames is not None:
+                    frames.copy(frame, video_frames)
+                current += 1
+                video_dir = os.path.join(frames.directory, str(current))
+                logging.debug(
+                    "Orange frame found: %s, starting video directory %s",
+                    frame,
+                    video_dir,
+                )
+                if not os.path.isdir(video_dir):
+                    os.mkdir(video_dir, 0o755)
+                if os.path.isdir(video_dir):
+                    video_dir = os.path.realpath(video_dir)
+                    clean_directory(video_dir)
+                    video_frames = FrameStore(
+                        video_dir, frames.prefix, frames.extension, frames.max_memory
                     )
-                    if not os.path.isdir(video_dir):
-                        os.mkdir(video_dir, 0o755)
-                    if os.path.isdir(video_dir):
-                        video_dir = os.path.realpath(video_dir)
-                        clean_directory(video_dir)
-                        directories.append(video_dir)
-                    else:
-                        video_dir = None
-            else:
-                found_orange = False
-            if video_dir is not None:
-                dest = os.path.join(video_dir, os.path.basename(frame))
-                os.rename(frame, dest)
-            else:
-                logging.debug("Removing spurious frame %s at the beginning", frame)
-                os.remove(frame)
-    return directories
+                    stores.append(video_frames)
+                else:
+                    video_frames = None
+        else:
+            found_orange = False
+        if video_frames is not None:
+            frames.move(frame, video_frames)
+        else:
+            logging.debug("Removing spurious frame %s at the beginning", frame)
+            frames.remove(frame)
+    return stores
 
 
-def remove_frames_before_orange(directory, orange_file):
+def remove_frames_before_orange(store, orange_file):
     """Remove stray frames from the start of the video"""
-    frames = sorted(glob.glob(os.path.join(directory, "video-*.png")))
+    frames = store.list()
     if len(frames):
         # go through the first 20 frames and remove any that come before the first orange frame.
         # iOS video capture starts with a blank white frame and then flips to
@@ -249,24 +814,26 @@ def remove_frames_before_orange(directory, orange_file):
         if found_orange and len(remove_frames):
             for frame in remove_frames:
                 logging.debug("Removing pre-orange frame %s", frame)
-                os.remove(frame)
+                store.remove(frame)
 
 
-def remove_orange_frames(directory, orange_file):
+def remove_orange_frames(store, orange_file):
     """Remove orange frames from the beginning of the video"""
-    frames = sorted(glob.glob(os.path.join(directory, "video-*.png")))
+    frames = store.list()
     if len(frames):
         logging.debug("Scanning for orange frames...")
         for frame in frames:
             if is_color_frame(frame, orange_file):
                 logging.debug("Removing Orange frame: %s", frame)
-                os.remove(frame)
+                store.remove(frame)
             else:
                 break
         for frame in reversed(frames):
+            if store.get(frame.time) is not frame:
+                break
             if is_color_frame(frame, orange_file):
                 logging.debug("Removing orange frame %s from the end", frame)
-                os.remove(frame)
+                store.remove(frame)
             else:
                 break
 
@@ -274,9 +841,7 @@ def remove_orange_frames(directory, orange_file):
 def find_image_viewport(file):
     logging.debug("Finding the viewport for %s", file)
     try:
-        from PIL import Image
-
-        im = Image.open(file)
+        im = open_frame_image(file)
         width, height = im.size
         x = int(math.floor(width / 2))
         y = int(math.floor(height / 2))
@@ -407,61 +972,42 @@ def find_video_viewport(video, directory, find_viewport, viewport_time):
     return viewport
 
 
-def trim_video_end(directory, trim_time):
+def trim_video_end(store, trim_time):
     if trim_time > 0:
         logging.debug(
             "Trimming "
             + str(trim_time)
             + "ms from the end of the video in "
-            + directory
+            + store.directory
         )
-        frames = sorted(glob.glob(os.path.join(directory, "video-*.png")))
+        frames = store.list()
         if len(frames):
-            match = re.compile(r"video-(?P<ms>[0-9]+)\.png")
-            m = re.search(match, frames[-1])
-            if m is not None:
-                frame_time = int(m.groupdict().get("ms"))
-                end_time = frame_time - trim_time
-                logging.debug("Trimming frames before " + str(end_time) + "ms")
-                for frame in frames:
-                    m = re.search(match, frame)
-                    if m is not None:
-                        frame_time = int(m.groupdict().get("ms"))
-                        if frame_time > end_time:
-                            logging.debug("Trimming frame " + frame)
-                            os.remove(frame)
+            end_time = frames[-1].time - trim_time
+            logging.debug("Trimming frames before " + str(end_time) + "ms")
+            for frame in frames:
+                if frame.time > end_time:
+                    logging.debug("Trimming frame " + str(frame))
+                    store.remove(frame)
 
 
-def adjust_frame_times(directory):
-    offset = None
-    frames = sorted(glob.glob(os.path.join(directory, "video-*.png")))
+def adjust_frame_times(store):
     # Special hack to the the video start
     # Let us tune this in the future to skip using a global
     global videoRecordingStart
-    match = re.compile(r"video-(?P<ms>[0-9]+)\.png")
-    if len(frames):
-        for frame in frames:
-            m = re.search(match, frame)
-            if m is not None:
-                frame_time = int(m.groupdict().get("ms"))
-                if offset is None:
-                    # This is the first frame.
-                    videoRecordingStart = frame_time
-                    offset = frame_time
-                new_time = frame_time - offset
-                dest = os.path.join(directory, "ms_{0:06d}.png".format(new_time))
-                os.rename(frame, dest)
+    if len(store):
+        # The first frame is the start of the video
+        offset = store.times[0]
+        videoRecordingStart = offset
+        store.shift(offset, "ms_")
 
 
-def find_first_frame(directory, white_file):
+def find_first_frame(store, white_file):
     logging.debug("Finding First Frame...")
     try:
         if options.startwhite:
-            files = sorted(glob.glob(os.path.join(directory, "video-*.png")))
+            files = store.list()
             count = len(files)
             if count > 1:
-                from PIL import Image
-
                 for i in range(count):
                     if is_white_frame(files[i], white_file):
                         break
@@ -471,16 +1017,13 @@ def find_first_frame(directory, white_file):
                                 files[i]
                             )
                         )
-                        os.remove(files[i])
+                        store.remove(files[i])
         elif options.findstart > 0 and options.findstart <= 100:
-            files = sorted(glob.glob(os.path.join(directory, "video-*.png")))
+            files = store.list()
             count = len(files)
             if count > 1:
-                from PIL import Image
-
                 blank = files[0]
-                with Image.open(blank) as im:
-                    width, height = im.size
+                width, height = blank.size
                 match_height = int(math.ceil(height * options.findstart / 100.0))
                 crop = "{0:d}x{1:d}+{2:d}+{3:d}".format(width, match_height, 0, 0)
                 found_first_change = False
@@ -497,7 +1040,7 @@ def find_first_frame(directory, white_file):
                         logging.debug(
                             "Removing early frame %s from the beginning", files[i]
                         )
-                        os.remove(files[i])
+                        store.remove(files[i])
                         if different:
                             first_frame = files[i + 1]
                             found_first_change = True
@@ -511,7 +1054,7 @@ def find_first_frame(directory, white_file):
                                             files[i]
                                         )
                                     )
-                                    os.remove(files[i])
+                                    store.remove(files[i])
                             else:
                                 found_non_white_frame = not is_white_frame(
                                     files[i], white_file
@@ -521,18 +1064,18 @@ def find_first_frame(directory, white_file):
                                         files[i]
                                     )
                                 )
-                                os.remove(files[i])
+                                store.remove(files[i])
                     if found_first_change and found_white_frame:
                         break
     except BaseException:
         logging.exception("Error finding first frame")
 
 
-def find_last_frame(directory, white_file):
+def find_last_frame(store, white_file):
     logging.debug("Finding Last Frame...")
     try:
         if options.endwhite:
-            files = sorted(glob.glob(os.path.join(directory, "video-*.png")))
+            files = store.list()
             count = len(files)
             if count > 2:
                 found_end = False
@@ -542,18 +1085,18 @@ def find_last_frame(directory, white_file):
                         logging.debug(
                             "Removing frame {0} from the end".format(files[i])
                         )
-                        os.remove(files[i])
-                    if is_white_frame(files[i], white_file):
+                        store.remove(files[i])
+                    elif is_white_frame(files[i], white_file):
                         found_end = True
                         logging.debug(
                             "Removing ending white frame {0}".format(files[i])
                         )
-                        os.remove(files[i])
+                        store.remove(files[i])
     except BaseException:
         logging.exception("Error finding last frame")
 
 
-def find_render_start(directory, orange_file, gray_file):
+def find_render_start(store, orange_file, gray_file):
     logging.debug("Finding Render Start...")
     try:
         if (
@@ -561,14 +1104,11 @@ def find_render_start(directory, orange_file, gray_file):
             or options.viewport is not None
             or (options.renderignore > 0 and options.renderignore <= 100)
         ):
-            files = sorted(glob.glob(os.path.join(directory, "video-*.png")))
+            files = store.list()
             count = len(files)
             if count > 1:
-                from PIL import Image
-
                 first = files[0]
-                with Image.open(first) as im:
-                    width, height = im.size
+                width, height = first.size
                 if options.renderignore > 0 and options.renderignore <= 100:
                     mask = {}
                     mask["width"] = int(math.floor(width * options.renderignore / 100))
@@ -602,32 +1142,29 @@ def find_render_start(directory, orange_file, gray_file):
                 for i in range(1, count):
                     if frames_match(first, files[i], 10, 0, crop, mask):
                         logging.debug("Removing pre-render frame %s", files[i])
-                        os.remove(files[i])
+                        store.remove(files[i])
                     elif orange_file is not None and is_color_frame(
                         files[i], orange_file
                     ):
                         logging.debug("Removing orange frame %s", files[i])
-                        os.remove(files[i])
+                        store.remove(files[i])
                     elif gray_file is not None and is_color_frame(files[i], gray_file):
                         logging.debug("Removing gray frame %s", files[i])
-                        os.remove(files[i])
+                        store.remove(files[i])
                     else:
                         break
     except BaseException:
         logging.exception("Error getting render start")
 
 
-def eliminate_duplicate_frames(directory):
+def eliminate_duplicate_frames(store):
     logging.debug("Eliminating Duplicate Frames...")
     global client_viewport
     try:
-        files = sorted(glob.glob(os.path.join(directory, "ms_*.png")))
+        files = store.list()
         if len(files) > 1:
-            from PIL import Image
-
             blank = files[0]
-            with Image.open(blank) as im:
-                width, height = im.size
+            width, height = blank.size
             if options.viewport and options.notification:
                 if (
                     client_viewport["width"] == width
@@ -667,14 +1204,14 @@ def eliminate_duplicate_frames(directory):
                             files[i]
                         )
                     )
-                    os.remove(files[i])
+                    store.remove(files[i])
                 else:
                     break
 
             # Do another pass looking for the last frame but with an allowance for up
             # to a 15% difference in individual pixels to deal with noise
             # around text.
-            files = sorted(glob.glob(os.path.join(directory, "ms_*.png")))
+            files = store.list()
             count = len(files)
             duplicates = []
             if count > 2:
@@ -691,7 +1228,7 @@ def eliminate_duplicate_frames(directory):
                                     previous_frame
                                 )
                             )
-                            os.remove(previous_frame)
+                            store.remove(previous_frame)
                         previous_frame = files[i]
                     else:
                         break
@@ -699,19 +1236,19 @@ def eliminate_duplicate_frames(directory):
                 logging.debug(
                     "Removing duplicate frame {0} from the end".format(duplicate)
                 )
-                os.remove(duplicate)
+                store.remove(duplicate)
 
     except BaseException:
         logging.exception("Error processing frames for duplicates")
 
 
-def eliminate_similar_frames(directory):
+def eliminate_similar_frames(store):
     logging.debug("Removing Similar Frames...")
     try:
         # only do this when decimate couldn't be used to eliminate similar
         # frames
         if options.notification:
-            files = sorted(glob.glob(os.path.join(directory, "ms_*.png")))
+            files = store.list()
             count = len(files)
             if count > 3:
                 crop = None
@@ -726,35 +1263,38 @@ def eliminate_similar_frames(directory):
                 for i in range(2, count - 1):
                     if frames_match(baseline, files[i], 1, 0, crop, None):
                         logging.debug("Removing similar frame {0}".format(files[i]))
-                        os.remove(files[i])
+                        store.remove(files[i])
                     else:
                         baseline = files[i]
     except BaseException:
         logging.exception("Error removing similar frames")
 
 
-def blank_first_frame(directory):
+def blank_first_frame(store):
     try:
         if options.forceblank:
-            files = sorted(glob.glob(os.path.join(directory, "video-*.png")))
+            files = store.list()
             count = len(files)
             if count > 1:
-                from PIL import Image
+                if get_compare_engine() == "numpy":
+                    import numpy as np
 
-                with Image.open(files[0]) as im:
-                    width, height = im.size
-                command = '{0} -size {1}x{2} xc:white PNG24:"{3}"'.format(
-                    image_magick["convert"], width, height, files[0]
-                )
-                subprocess.call(command, shell=True)
+                    store.update(files[0], np.full_like(files[0].pixels, 255))
+                else:
+                    width, height = files[0].size
+                    command = '{0} -size {1}x{2} xc:white PNG24:"{3}"'.format(
+                        image_magick["convert"], width, height, frame_file(files[0])
+                    )
+                    subprocess.call(command, shell=True)
+                    store.invalidate(files[0])
     except BaseException:
         logging.exception("Error blanking first frame")
 
 
-def crop_viewport(directory):
+def crop_viewport(store):
     if client_viewport is not None:
         try:
-            files = sorted(glob.glob(os.path.join(directory, "ms_*.png")))
+            files = store.list()
             count = len(files)
             if count > 0:
                 crop = "{0:d}x{1:d}+{2:d}+{3:d}".format(
@@ -763,21 +1303,36 @@ def crop_viewport(directory):
                     client_viewport["x"],
                     client_viewport["y"],
                 )
-                for i in range(count):
-                    command = '{0} "{1}" -crop {2} "{1}"'.format(
-                        image_magick["convert"], files[i], crop
-                    )
-                    subprocess.call(command, shell=True)
+                if get_compare_engine() == "numpy":
+                    import numpy as np
+
+                    # A copy of the slice, so the full frame can be freed
+                    for i in range(count):
+                        cropped = crop_pixels(files[i].pixels, crop)
+                        store.update(files[i], np.array(cropped))
+                else:
+                    for i in range(count):
+                        command = '{0} "{1}" -crop {2} "{1}"'.format(
+                            image_magick["convert"], frame_file(files[i]), crop
+                        )
+                        subprocess.call(command, shell=True)
+                        store.invalidate(files[i])
 
         except BaseException:
             logging.exception("Error cropping to viewport")
 
 
 def get_decimate_filter():
+    return get_capabilities().get(
+        "decimate", get_tool_key("ffmpeg"), probe_decimate_filter
+    )
+
+
+def probe_decimate_filter():
     decimate = None
     try:
         filters = subprocess.check_output(
-            ["ffmpeg", "-filters"], stderr=subprocess.STDOUT
+            ["ffmpeg", "-filters"], stderr=subprocess.STDOUT, universal_newlines=True
         )
         lines = filters.split("\n")
         match = re.compile(
@@ -806,99 +1361,258 @@ def clean_directory(directory):
         os.remove(file)
 
 
-def is_color_frame(file, color_file):
-    """Check a section from the middle, top and bottom of the viewport to see if it matches"""
-    global frame_cache
-    if file in frame_cache and color_file in frame_cache[file]:
-        return bool(frame_cache[file][color_file])
+class ColorCache(object):
+    """Bounded LRU cache of the colour classifications of frames.
+
+    The entries are keyed by the content of the frame and the reference
+    colour, so they stay valid when frames are renamed or moved between
+    stores and can be shared by every video a process analyzes."""
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        if key not in self.entries:
+            self.misses += 1
+            return None
+        self.hits += 1
+        value = self.entries.pop(key)
+        self.entries[key] = value
+        return value
+
+    def put(self, key, value):
+        self.entries.pop(key, None)
+        self.entries[key] = value
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+def get_color_cache():
+    global color_cache
+    if color_cache is None:
+        color_cache = ColorCache()
+    return color_cache
+
+
+def get_frame_digest(file):
+    """sha1 of the decoded pixels of a frame (or of the bytes of an image file)"""
+    if isinstance(file, VideoFrame):
+        try:
+            pixels = file.pixels
+            digest = hashlib.sha1(pixels.tobytes())
+            digest.update(str(pixels.shape).encode("utf-8"))
+            return digest.hexdigest()
+        except ImportError:
+            file = frame_file(file)
+    return get_file_hash(file)
+
+
+def get_reference_color(color_file):
+    """The RGB colour of a generated reference png"""
+    from PIL import Image
+
+    with Image.open(color_file) as im:
+        return tuple(im.convert("RGB").getpixel((0, 0)))
+
+
+def is_color_frame(file, color_file, fuzz_percent=15, max_different=0.25):
+    """Check a section from the middle, top and bottom of the viewport to see if it matches.
+
+    A section matches when less than max_different of its pixels are further
+    than fuzz_percent from the reference colour."""
+    try:
+        color = get_reference_color(color_file)
+        key = (get_frame_digest(file), color, fuzz_percent, max_different)
+    except BaseException:
+        color = None
+        key = None
+    if key is not None:
+        cached = get_color_cache().get(key)
+        if cached is not None:
+            return cached
     match = False
     if os.path.isfile(color_file):
         try:
-            from PIL import Image
-
-            with Image.open(file) as img:
-                width, height = img.size
-            crops = []
-            # Middle
-            crops.append(
-                "{0:d}x{1:d}+{2:d}+{3:d}".format(
-                    int(width / 2), int(height / 3), int(width / 4), int(height / 3)
-                )
-            )
-            # Top
-            crops.append(
-                "{0:d}x{1:d}+{2:d}+{3:d}".format(
-                    int(width / 2), int(height / 5), int(width / 4), 50
-                )
-            )
-            # Bottom
-            crops.append(
-                "{0:d}x{1:d}+{2:d}+{3:d}".format(
-                    int(width / 2),
-                    int(height / 5),
-                    int(width / 4),
-                    height - int(height / 5),
-                )
-            )
-            for crop in crops:
-                command = (
-                    '{0} "{1}" "(" "{2}" -crop {3} -resize 200x200! ")"'
-                    " miff:- | {4} -metric AE - -fuzz 15% null:"
-                ).format(
-                    image_magick["convert"],
-                    color_file,
-                    file,
-                    crop,
-                    image_magick["compare"],
+            if color is not None and get_compare_engine() == "numpy":
+                match = is_color_frame_numpy(file, color, fuzz_percent, max_different)
+            else:
+                match = is_color_frame_imagemagick(
+                    file, color_file, fuzz_percent, max_different
                 )
-                compare = subprocess.Popen(command, stderr=subprocess.PIPE, shell=True)
-                out, err = compare.communicate()
-                if re.match("^[0-9]+$", err):
-                    different_pixels = int(err)
-                    if different_pixels < 10000:
-                        match = True
-                        break
         except Exception:
-            pass
-    if file not in frame_cache:
-        frame_cache[file] = {}
-    frame_cache[file][color_file] = bool(match)
+            logging.exception("Error checking for a color frame")
+    if key is not None:
+        get_color_cache().put(key, bool(match))
     return match
 
 
-def is_white_frame(file, white_file):
+def get_color_frame_crops(width, height):
+    """The middle, top and bottom sections that is_color_frame looks at"""
+    return [
+        # Middle
+        "{0:d}x{1:d}+{2:d}+{3:d}".format(
+            int(width / 2), int(height / 3), int(width / 4), int(height / 3)
+        ),
+        # Top
+        "{0:d}x{1:d}+{2:d}+{3:d}".format(
+            int(width / 2), int(height / 5), int(width / 4), 50
+        ),
+        # Bottom
+        "{0:d}x{1:d}+{2:d}+{3:d}".format(
+            int(width / 2), int(height / 5), int(width / 4), height - int(height / 5),
+        ),
+    ]
+
+
+def is_color_frame_numpy(file, color, fuzz_percent, max_different):
+    pixels = load_frame_pixels(file)
+    height, width = pixels.shape[:2]
+    for crop in get_color_frame_crops(width, height):
+        different = get_color_difference(crop_pixels(pixels, crop), color, fuzz_percent)
+        if different < max_different:
+            return True
+    return False
+
+
+def is_color_frame_imagemagick(file, color_file, fuzz_percent, max_different):
+    width, height = open_frame_image(file).size
+    for crop in get_color_frame_crops(width, height):
+        command = (
+            '{0} "{1}" "(" "{2}" -crop {3} -resize 200x200! ")"'
+            " miff:- | {4} -metric AE - -fuzz {5}% null:"
+        ).format(
+            image_magick["convert"],
+            color_file,
+            frame_file(file),
+            crop,
+            image_magick["compare"],
+            fuzz_percent,
+        )
+        compare = subprocess.Popen(
+            command, stderr=subprocess.PIPE, shell=True, universal_newlines=True
+        )
+        out, err = compare.communicate()
+        if re.match("^[0-9]+$", err):
+            different_pixels = int(err)
+            if different_pixels < max_different * 40000:
+                return True
+    return False
+
+
+def get_color_difference(pixels, color, fuzz_percent):
+    """Fraction of the pixels that are further than the fuzz from a colour.
+
+    Uses the per-channel fuzz distance of compare_frames_numpy, measured on
+    the pixels themselves instead of a 200x200 resize of them."""
+    import numpy as np
+
+    if pixels.size == 0:
+        return 1.0
+    dtype = np.int16 if pixels.dtype == np.uint8 else np.float32
+    delta = np.abs(pixels.astype(dtype) - np.array(color, dtype=dtype))
+    different = (delta > get_fuzz_threshold(fuzz_percent)).any(axis=2)
+    return np.count_nonzero(different) / float(different.size)
+
+
+def is_white_frame(file, white_file, fuzz_percent=10, max_different=0.0125):
     white = False
     if os.path.isfile(white_file):
-        if options.viewport:
-            command = (
-                '{0} "{1}" "(" "{2}" -resize 200x200! ")" miff:- | '
-                "{3} -metric AE - -fuzz 10% null:"
-            ).format(image_magick["convert"], white_file, file, image_magick["compare"])
+        if get_compare_engine() == "numpy":
+            try:
+                white = is_white_frame_numpy(
+                    file, get_reference_color(white_file), fuzz_percent, max_different
+                )
+            except Exception:
+                logging.exception("Error checking for a white frame")
         else:
-            command = (
-                '{0} "{1}" "(" "{2}" -gravity Center -crop 50%x33%+0+0 -resize 200x200! ")" miff:- | '
-                "{3} -metric AE - -fuzz 10% null:"
-            ).format(image_magick["convert"], white_file, file, image_magick["compare"])
-        if client_viewport is not None:
-            crop = "{0:d}x{1:d}+{2:d}+{3:d}".format(
-                client_viewport["width"],
-                client_viewport["height"],
-                client_viewport["x"],
-                client_viewport["y"],
+            white = is_white_frame_imagemagick(
+                file, white_file, fuzz_percent, max_different
             )
-            command = (
-                '{0} "{1}" "(" "{2}" -crop {3} -resize 200x200! ")" miff:- | '
-                "{4} -metric AE - -fuzz 10% null:"
-            ).format(
-                image_magick["convert"], white_file, file, crop, image_magick["compare"]
-            )
-        compare = subprocess.Popen(command, stderr=subprocess.PIPE, shell=True)
-        out, err = compare.communicate()
-        if re.match("^[0-9]+$", err):
-            different_pixels = int(err)
-            if different_pixels < 500:
-                white = True
+    return white
+
+
+def is_white_frame_numpy(file, color, fuzz_percent, max_different):
+    pixels = load_frame_pixels(file)
+    height, width = pixels.shape[:2]
+    if client_viewport is not None:
+        crop = "{0:d}x{1:d}+{2:d}+{3:d}".format(
+            client_viewport["width"],
+            client_viewport["height"],
+            client_viewport["x"],
+            client_viewport["y"],
+        )
+        pixels = crop_pixels(pixels, crop)
+    elif options is None or not options.viewport:
+        # -gravity Center -crop 50%x33%+0+0
+        crop_width = int(round(width * 0.5))
+        crop_height = int(round(height * 0.33))
+        crop = "{0:d}x{1:d}+{2:d}+{3:d}".format(
+            crop_width,
+            crop_height,
+            (width - crop_width) // 2,
+            (height - crop_height) // 2,
+        )
+        pixels = crop_pixels(pixels, crop)
+    return bool(get_color_difference(pixels, color, fuzz_percent) < max_different)
 
+
+def is_white_frame_imagemagick(file, white_file, fuzz_percent, max_different):
+    white = False
+    file = frame_file(file)
+    if options.viewport:
+        command = (
+            '{0} "{1}" "(" "{2}" -resize 200x200! ")" miff:- | '
+            "{3} -metric AE - -fuzz {4}% null:"
+        ).format(
+            image_magick["convert"],
+            white_file,
+            file,
+            image_magick["compare"],
+            fuzz_percent,
+        )
+    else:
+        command = (
+            '{0} "{1}" "(" "{2}" -gravity Center -crop 50%x33%+0+0 -resize 200x200! ")" miff:- | '
+            "{3} -metric AE - -fuzz {4}% null:"
+        ).format(
+            image_magick["convert"],
+            white_file,
+            file,
+            image_magick["compare"],
+            fuzz_percent,
+        )
+    if client_viewport is not None:
+        crop = "{0:d}x{1:d}+{2:d}+{3:d}".format(
+            client_viewport["width"],
+            client_viewport["height"],
+            client_viewport["x"],
+            client_viewport["y"],
+        )
+        command = (
+            '{0} "{1}" "(" "{2}" -crop {3} -resize 200x200! ")" miff:- | '
+            "{4} -metric AE - -fuzz {5}% null:"
+        ).format(
+            image_magick["convert"],
+            white_file,
+            file,
+            crop,
+            image_magick["compare"],
+            fuzz_percent,
+        )
+    compare = subprocess.Popen(
+        command, stderr=subprocess.PIPE, shell=True, universal_newlines=True
+    )
+    out, err = compare.communicate()
+    if re.match("^[0-9]+$", err):
+        different_pixels = int(err)
+        if different_pixels < max_different * 40000:
+            white = True
     return white
 
 
@@ -917,13 +1631,47 @@ def colors_are_similar(a, b, threshold=15):
 
 
 def frames_match(image1, image2, fuzz_percent, max_differences, crop_region, mask_rect):
-    match = False
+    different_pixels = compare_frames(
+        image1, image2, fuzz_percent, crop_region, mask_rect
+    )
+    return different_pixels is not None and different_pixels <= max_differences
+
+
+def compare_frames(image1, image2, fuzz_percent, crop_region, mask_rect):
+    """Count the pixels that differ between two frames (None if they can't be compared)"""
+    if get_compare_engine() == "numpy":
+        return compare_frames_numpy(
+            image1, image2, fuzz_percent, crop_region, mask_rect
+        )
+    return compare_frames_imagemagick(
+        image1, image2, fuzz_percent, crop_region, mask_rect
+    )
+
+
+def get_compare_engine():
+    """Use the in-process NumPy engine when it is available, ImageMagick otherwise"""
+    global compare_engine
+    if compare_engine is None:
+        if has_module("numpy") and has_module("PIL"):
+            compare_engine = "numpy"
+        else:
+            compare_engine = "imagemagick"
+            if not has_image_magick():
+                logging.critical("Neither NumPy nor ImageMagick is available")
+        logging.debug("Using the %s engine for frame comparisons", compare_engine)
+    return compare_engine
+
+
+def compare_frames_imagemagick(image1, image2, fuzz_percent, crop_region, mask_rect):
+    different_pixels = None
     fuzz = ""
     if fuzz_percent > 0:
         fuzz = "-fuzz {0:d}% ".format(fuzz_percent)
     crop = ""
     if crop_region is not None:
         crop = "-crop {0} ".format(crop_region)
+    image1 = frame_file(image1)
+    image2 = frame_file(image2)
     if mask_rect is None:
         img1 = '"{0}"'.format(image1)
         img2 = '"{0}"'.format(image2)
@@ -947,18 +1695,120 @@ def frames_match(image1, image2, fuzz_percent, max_differences, crop_region, mas
     )
     if platform.system() != "Windows":
         command = command.replace("(", "\\(").replace(")", "\\)")
-    compare = subprocess.Popen(command, stderr=subprocess.PIPE, shell=True)
+    compare = subprocess.Popen(
+        command, stderr=subprocess.PIPE, shell=True, universal_newlines=True
+    )
     out, err = compare.communicate()
     if re.match("^[0-9]+$", err):
         different_pixels = int(err)
-        if different_pixels <= max_differences:
-            match = True
     else:
         logging.debug(
             'Unexpected compare result: out: "{0}", err: "{1}"'.format(out, err)
         )
 
-    return match
+    return different_pixels
+
+
+def compare_frames_numpy(image1, image2, fuzz_percent, crop_region, mask_rect):
+    """In-process equivalent of compare_frames_imagemagick.
+
+    The mask is painted white on both frames before cropping and a pixel
+    counts as different when any of its channels differs by more than the
+    fuzz distance, the same way 'compare -metric AE -fuzz' counts them.
+    """
+    import numpy as np
+
+    pixels1 = load_frame_pixels(image1)
+    pixels2 = load_frame_pixels(image2)
+    if mask_rect is not None:
+        pixels1 = mask_pixels(pixels1, mask_rect)
+        pixels2 = mask_pixels(pixels2, mask_rect)
+    if crop_region is not None:
+        pixels1 = crop_pixels(pixels1, crop_region)
+        pixels2 = crop_pixels(pixels2, crop_region)
+    if pixels1.shape != pixels2.shape:
+        logging.debug(
+            "Frames can not be compared: {0} is {1} and {2} is {3}".format(
+                image1, pixels1.shape, image2, pixels2.shape
+            )
+        )
+        return None
+    threshold = get_fuzz_threshold(fuzz_percent)
+    dtype = np.int16
+    if pixels1.dtype != np.uint8 or pixels2.dtype != np.uint8:
+        dtype = np.float32
+    delta = np.abs(pixels1.astype(dtype) - pixels2.astype(dtype))
+    different = (delta > threshold).any(axis=2)
+    return int(np.count_nonzero(different))
+
+
+def get_fuzz_threshold(fuzz_percent):
+    """The 8-bit channel difference that a compare fuzz percentage allows"""
+    # ImageMagick never uses a fuzz below sqrt(1/2) of a 16-bit quantum, so
+    # even a 0% fuzz needs a full 8-bit step to count as a difference.
+    return max(fuzz_percent * 65535.0 / 100.0, math.sqrt(0.5)) / 257.0
+
+
+def load_frame_pixels(file):
+    """Decode a frame into a (height, width, 3) RGB array.
+
+    Frames with transparency are premultiplied by their alpha, which is how
+    ImageMagick weighs the channels when it compares them.
+    """
+    import numpy as np
+    from PIL import Image
+
+    if isinstance(file, VideoFrame):
+        return file.pixels
+    with Image.open(file) as im:
+        if "A" in im.getbands() or "transparency" in im.info:
+            rgba = np.asarray(im.convert("RGBA"), dtype=np.float32)
+            return rgba[:, :, :3] * (rgba[:, :, 3:] / 255.0)
+        return np.asarray(im.convert("RGB"))
+
+
+def frame_file(file):
+    """Path of a frame handle (written out if needed) or of an image file"""
+    if isinstance(file, VideoFrame):
+        return file.store.save(file)
+    return file
+
+
+def open_frame_image(file):
+    """PIL image of a frame handle or of an image file"""
+    if isinstance(file, VideoFrame):
+        return file.image()
+    from PIL import Image
+
+    return Image.open(file)
+
+
+def parse_crop_region(crop_region):
+    """Split an ImageMagick WxH+X+Y geometry into (x, y, width, height)"""
+    m = re.match(r"^(\d+)x(\d+)\+(\d+)\+(\d+)$", crop_region)
+    if m is None:
+        raise ValueError("Invalid crop region " + crop_region)
+    width, height, x, y = [int(value) for value in m.groups()]
+    return x, y, width, height
+
+
+def crop_pixels(pixels, crop_region):
+    """Crop a frame the way '-crop WxH+X+Y' does, clipped to the frame bounds"""
+    x, y, width, height = parse_crop_region(crop_region)
+    right = x + width
+    bottom = y + height
+    return pixels[y:bottom, x:right]
+
+
+def mask_pixels(pixels, mask_rect):
+    """Paint the mask rectangle white, like compositing an xc:white canvas over it"""
+    x = max(int(mask_rect["x"]), 0)
+    y = max(int(mask_rect["y"]), 0)
+    right = int(mask_rect["x"]) + int(mask_rect["width"])
+    bottom = int(mask_rect["y"]) + int(mask_rect["height"])
+    masked = pixels.copy()
+    masked[y:bottom, x:right] = 255
+    return masked
 
 
 def generate_orange_png(orange_file):
@@ -1000,21 +1850,108 @@ def generate_white_png(white_file):
         logging.exception("Error generating white png " + white_file)
 
 
-def synchronize_to_timeline(directory, timeline_file):
+def synchronize_to_timeline(store, timeline_file):
     offset = get_timeline_offset(timeline_file)
     if offset > 0:
-        frames = sorted(glob.glob(os.path.join(directory, "ms_*.png")))
-        match = re.compile(r"ms_(?P<ms>[0-9]+)\.png")
-        for frame in frames:
-            m = re.search(match, frame)
-            if m is not None:
-                frame_time = int(m.groupdict().get("ms"))
-                new_time = max(frame_time - offset, 0)
-                dest = os.path.join(directory, "ms_{0:06d}.png".format(new_time))
-                if frame != dest:
-                    if os.path.isfile(dest):
-                        os.remove(dest)
-                    os.rename(frame, dest)
+        store.shift(offset)
+
+
+class JsonStreamReader(object):
+    """Incremental reader of a JSON document, one value at a time.
+
+    Only the values that are asked for are decoded and only a chunk of the
+    file is buffered, so large arrays can be walked without loading them."""
+
+    whitespace = re.compile(r"[ \t\n\r]*")
+
+    def __init__(self, f, chunk_size=1024 * 1024):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.text_decoder = codecs.getincrementaldecoder("utf-8")()
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def read(self):
+        """Append the next chunk of the file (False at the end of the file)"""
+        if self.eof:
+            return False
+        consumed = self.pos
+        self.buffer = self.buffer[consumed:]
+        self.pos = 0
+        data = self.f.read(self.chunk_size)
+        if not data:
+            self.eof = True
+            self.buffer += self.text_decoder.decode(b"", True)
+            return False
+        self.buffer += self.text_decoder.decode(data)
+        return True
+
+    def peek(self):
+        """The next character that is not whitespace ('' at the end)"""
+        while True:
+            self.pos = self.whitespace.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.read():
+                return ""
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError("Expected '{0}' in the JSON stream".format(char))
+        self.pos += 1
+
+    def value(self):
+        """Decode the value at the current position"""
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                # A number at the end of the buffer may continue in the file
+                if end < len(self.buffer) or self.eof:
+                    self.pos = end
+                    return value
+            except ValueError:
+                if self.eof:
+                    raise
+            self.read()
+
+    def array(self):
+        """Yield the elements of the array at the current position"""
+        self.expect("[")
+        if self.peek() == "]":
+            self.pos += 1
+            return
+        while True:
+            yield self.value()
+            char = self.peek()
+            self.pos += 1
+            if char == "]":
+                return
+            if char != ",":
+                raise ValueError("Invalid array in the JSON stream")
+
+
+def iter_timeline_events(f):
+    """Yield the events of a timeline (an array of events) or of a trace
+    (an object with a traceEvents array) as they are read"""
+    reader = JsonStreamReader(f)
+    if reader.peek() == "[":
+        for timeline_event in reader.array():
+            yield timeline_event
+        return
+    reader.expect("{")
+    while reader.peek() not in ["}", ""]:
+        key = reader.value()
+        reader.expect(":")
+        if key == "traceEvents":
+            for timeline_event in reader.array():
+                yield timeline_event
+            return
+        reader.value()
+        if reader.peek() == ",":
+            reader.pos += 1
 
 
 def get_timeline_offset(timeline_file):
@@ -1024,24 +1961,22 @@ def get_timeline_offset(timeline_file):
         if ext.lower() == ".gz":
             f = gzip.open(timeline_file, "rb")
         else:
-            f = open(timeline_file, "r")
-        timeline = json.load(f)
-        f.close()
+            f = open(timeline_file, "rb")
         last_paint = None
         first_navigate = None
 
-        # In the case of a trace instead of a timeline we want the list of
-        # events
-        if "traceEvents" in timeline:
-            timeline = timeline["traceEvents"]
-
-        for timeline_event in timeline:
-            paint_time = get_timeline_event_paint_time(timeline_event)
-            if paint_time is not None:
-                last_paint = paint_time
-            first_navigate = get_timeline_event_navigate_time(timeline_event)
-            if first_navigate is not None:
-                break
+        # The events are streamed from the file and the rest of the file is
+        # not read once the first navigation was found
+        try:
+            for timeline_event in iter_timeline_events(f):
+                paint_time = get_timeline_event_paint_time(timeline_event)
+                if paint_time is not None:
+                    last_paint = paint_time
+                first_navigate = get_timeline_event_navigate_time(timeline_event)
+                if first_navigate is not None:
+                    break
+        finally:
+            f.close()
 
         if (
             last_paint is not None
@@ -1151,40 +2086,53 @@ def get_timeline_event_navigate_time(timeline_event):
 ##########################################################################
 
 
-def calculate_histograms(directory, histograms_file, force):
+def calculate_histograms(directory, histograms_file, force, frames=None):
     logging.debug("Calculating image histograms")
-    if not os.path.isfile(histograms_file) or force:
+    inputs = None
+    current = True
+    if manifest is not None and manifest.has("frames"):
+        inputs = {"frames": manifest.digest("frames")}
+        outputs = manifest.outputs("histograms", inputs)
+        current = outputs is not None and outputs["file"] == os.path.realpath(
+            histograms_file
+        )
+    if not os.path.isfile(histograms_file) or force or not current:
         try:
-            extension = None
             directory = os.path.realpath(directory)
-            first_frame = os.path.join(directory, "ms_000000")
-            if os.path.isfile(first_frame + ".png"):
-                extension = ".png"
-            elif os.path.isfile(first_frame + ".jpg"):
-                extension = ".jpg"
-            if extension is not None:
+            if frames is None:
+                frames = FrameStore.load(directory, "ms_", get_frame_memory())
+            if frames.get(0) is not None:
                 histograms = []
-                frames = sorted(glob.glob(os.path.join(directory, "ms_*" + extension)))
-                match = re.compile(r"ms_(?P<ms>[0-9]+)\.")
-                for frame in frames:
-                    m = re.search(match, frame)
-                    if m is not None:
-                        frame_time = int(m.groupdict().get("ms"))
-                        histogram = calculate_image_histogram(frame)
-                        gc.collect()
-                        if histogram is not None:
-                            histograms.append(
-                                {
-                                    "time": frame_time,
-                                    "file": os.path.basename(frame),
-                                    "histogram": histogram,
-                                }
-                            )
+                frame_list = frames.list()
+                # Workers get the decoded pixels, or decode the file themselves
+                jobs = [
+                    frame.data if frame.data is not None else frame.file
+                    for frame in frame_list
+                ]
+                results = map_frames(calculate_histogram_job, jobs)
+                for frame, histogram in zip(frame_list, results):
+                    if histogram is not None:
+                        histograms.append(
+                            {
+                                "time": frame.time,
+                                "file": os.path.basename(frames.path(frame.time)),
+                                "histogram": histogram,
+                            }
+                        )
                 if os.path.isfile(histograms_file):
                     os.remove(histograms_file)
-                f = gzip.open(histograms_file, "wb")
-                json.dump(histograms, f)
-                f.close()
+                if is_binary_histograms_file(histograms_file):
+                    save_histograms_binary(histograms_file, histograms)
+                else:
+                    f = gzip.open(histograms_file, "wb")
+                    f.write(json.dumps(histograms).encode("utf-8"))
+                    f.close()
+                if inputs is not None:
+                    manifest.record(
+                        "histograms",
+                        inputs,
+                        {"file": os.path.realpath(histograms_file)},
+                    )
             else:
                 logging.critical("No video frames found in " + directory)
         except BaseException:
@@ -1194,12 +2142,66 @@ def calculate_histograms(directory, histograms_file, force):
     logging.debug("Done calculating histograms")
 
 
+def calculate_histogram_job(job):
+    """Histogram of an image file or of decoded pixels (run in the workers)"""
+    if hasattr(job, "shape"):
+        try:
+            return calculate_pixels_histogram(job)
+        except Exception:
+            logging.exception("Error calculating histogram")
+            return None
+    return calculate_image_histogram(job)
+
+
 def calculate_image_histogram(file):
-    logging.debug("Calculating histogram for " + file)
+    logging.debug("Calculating histogram for " + str(file))
     try:
-        from PIL import Image
+        import numpy as np
+    except ImportError:
+        return calculate_image_histogram_getcolors(file)
+    try:
+        if isinstance(file, VideoFrame):
+            pixels = file.pixels
+        else:
+            with open_frame_image(file) as im:
+                pixels = np.asarray(im.convert("RGB"))
+        histogram = calculate_pixels_histogram(pixels)
+    except Exception:
+        histogram = None
+        logging.exception("Error calculating histogram for " + str(file))
+    return histogram
 
-        im = Image.open(file)
+
+def calculate_pixels_histogram(pixels, chunk_pixels=1024 * 1024):
+    """Per-channel counts of the pixels that are not (nearly) white.
+
+    The frame is counted a band of rows at a time so the temporary arrays
+    stay bounded at full resolution."""
+    import numpy as np
+    from PIL import Image
+
+    height, width = pixels.shape[:2]
+    rows = max(1, int(chunk_pixels / max(width, 1)))
+    counts = np.zeros(768, dtype=np.int64)
+    for top in range(0, height, rows):
+        bottom = top + rows
+        chunk = np.ascontiguousarray(pixels[top:bottom], dtype=np.uint8)
+        # Don't include White pixels (with a tiny bit of slop for
+        # compression artifacts)
+        darkest = np.minimum(np.minimum(chunk[:, :, 0], chunk[:, :, 1]), chunk[:, :, 2])
+        mask = Image.fromarray(darkest < 250)
+        counts += Image.fromarray(chunk).histogram(mask)
+    return {
+        "r": counts[0:256].tolist(),
+        "g": counts[256:512].tolist(),
+        "b": counts[512:768].tolist(),
+    }
+
+
+def calculate_image_histogram_getcolors(file):
+    """Pure Python histogram, used when NumPy is not available"""
+    try:
+        im = open_frame_image(file)
         width, height = im.size
         colors = im.getcolors(width * height)
         histogram = {
@@ -1222,27 +2224,129 @@ def calculate_image_histogram(file):
         colors = None
     except Exception:
         histogram = None
-        logging.exception("Error calculating histogram for " + file)
+        logging.exception("Error calculating histogram for " + str(file))
     return histogram
 
 
-##########################################################################
-#   Screen Shots
-##########################################################################
+class Histograms(object):
+    """The histograms of a run as one (frames, 3, 256) array of r, g and b
+    counts, with the time and file of every frame.
 
+    Indexing returns the same dicts as the JSON histograms file."""
 
-def save_screenshot(directory, dest, quality):
-    directory = os.path.realpath(directory)
-    files = sorted(glob.glob(os.path.join(directory, "ms_*.png")))
-    if files is not None and len(files) >= 1:
-        src = files[-1]
-        if dest[-4:] == ".jpg":
-            command = '{0} "{1}" -set colorspace sRGB -quality {2:d} "{3}"'.format(
-                image_magick["convert"], src, quality, dest
-            )
-            subprocess.call(command, shell=True)
-        else:
-            shutil.copy(src, dest)
+    def __init__(self, times, files, counts):
+        self.times = times
+        self.files = files
+        self.counts = counts
+
+    def __len__(self):
+        return len(self.times)
+
+    def __getitem__(self, index):
+        counts = self.counts[index]
+        return {
+            "time": self.times[index],
+            "file": self.files[index],
+            "histogram": {
+                "r": counts[0].tolist(),
+                "g": counts[1].tolist(),
+                "b": counts[2].tolist(),
+            },
+        }
+
+    def window(self, start, end):
+        """The frames between start and end, the way load_histograms picks
+        them: the last frame at or before start (moved to start) and the
+        frames after it up to end"""
+        first = bisect.bisect_right(self.times, start) - 1
+        begin = max(first, 0)
+        last = max(bisect.bisect_right(self.times, end), first + 1)
+        times = self.times[begin:last]
+        if first >= 0:
+            times[0] = start
+        return Histograms(times, self.files[begin:last], self.counts[begin:last])
+
+
+HISTOGRAMS_MAGIC = b"VMHIST01"
+
+
+def is_binary_histograms_file(histograms_file):
+    """Histograms files ending in .bin use the binary format"""
+    return os.path.splitext(histograms_file)[1].lower() == ".bin"
+
+
+def save_histograms_binary(histograms_file, histograms):
+    """Write the histograms as a JSON index of the frame times and files
+    followed by a little-endian uint32 (frames, 3, 256) array"""
+    import numpy as np
+
+    counts = np.array(
+        [
+            [histogram["histogram"][channel] for channel in ["r", "g", "b"]]
+            for histogram in histograms
+        ],
+        dtype="<u4",
+    ).reshape(len(histograms), 3, 256)
+    header = json.dumps(
+        {
+            "frames": len(histograms),
+            "times": [histogram["time"] for histogram in histograms],
+            "files": [histogram["file"] for histogram in histograms],
+        }
+    ).encode("utf-8")
+    # Pad the index so that the array starts on a 64 byte boundary
+    prefix = len(HISTOGRAMS_MAGIC) + 4
+    header += b" " * (-(prefix + len(header)) % 64)
+    write_file_atomic(
+        histograms_file,
+        HISTOGRAMS_MAGIC + struct.pack("<I", len(header)) + header + counts.tobytes(),
+    )
+
+
+def load_histograms_binary(histograms_file):
+    """Memory-map a binary histograms file (None if it isn't one)"""
+    import numpy as np
+
+    with open(histograms_file, "rb") as f:
+        if f.read(len(HISTOGRAMS_MAGIC)) != HISTOGRAMS_MAGIC:
+            return None
+        header_size = struct.unpack("<I", f.read(4))[0]
+        header = json.loads(f.read(header_size).decode("utf-8"))
+    frames = header["frames"]
+    if not frames:
+        return Histograms([], [], np.zeros((0, 3, 256), dtype="<u4"))
+    counts = np.memmap(
+        histograms_file,
+        dtype="<u4",
+        mode="r",
+        offset=len(HISTOGRAMS_MAGIC) + 4 + header_size,
+        shape=(frames, 3, 256),
+    )
+    return Histograms(header["times"], header["files"], counts)
+
+
+##########################################################################
+#   Screen Shots
+##########################################################################
+
+
+def save_screenshot(directory, dest, quality, frames=None):
+    if frames is None:
+        frames = FrameStore.load(os.path.realpath(directory), "ms_")
+    if len(frames) >= 1:
+        frame = frames.get(frames.times[-1])
+        if dest[-4:] == ".jpg":
+            if has_module("PIL"):
+                write_file_atomic(dest, get_jpeg_data(frame, quality))
+            else:
+                command = '{0} "{1}" -set colorspace sRGB -quality {2:d} "{3}"'.format(
+                    image_magick["convert"], frame_file(frame), quality, dest
+                )
+                subprocess.call(command, shell=True)
+        elif frame.file is not None:
+            shutil.copy(frame.file, dest)
+        else:
+            write_file_atomic(dest, get_png_data(frame))
 
 
 ##########################################################################
@@ -1250,9 +2354,65 @@ def save_screenshot(directory, dest, quality):
 ##########################################################################
 
 
-def convert_to_jpeg(directory, quality):
+def convert_to_jpeg(directory, quality, frames=None):
+    """Replace the ms_*.png frames with JPEGs of the given quality.
+
+    The frames are encoded in parallel from memory when Pillow is available.
+    Frames loaded from an earlier export are already JPEGs and are left
+    alone."""
     logging.debug("Converting video frames to JPEG")
     directory = os.path.realpath(directory)
+    if not has_module("PIL"):
+        convert_to_jpeg_imagemagick(directory, quality)
+        return
+    if frames is None:
+        frames = FrameStore.load(directory, "ms_")
+    jobs = []
+    for frame in frames.list():
+        dest = os.path.splitext(frames.path(frame.time))[0] + ".jpg"
+        if frame.file == dest:
+            # Loaded from an earlier export, never re-encode a JPEG
+            continue
+        source = frame.data if frame.data is not None else frame.file
+        jobs.append((source, dest, quality))
+    logging.debug(
+        "Encoding {0:d} of {1:d} frames as JPEG".format(len(jobs), len(frames))
+    )
+    map_frames(export_jpeg_job, jobs)
+    for frame in frames.list():
+        base = os.path.splitext(frames.path(frame.time))[0]
+        if os.path.isfile(base + ".jpg") and os.path.isfile(base + ".png"):
+            os.remove(base + ".png")
+    logging.debug("Done Converting video frames to JPEG")
+
+
+def export_jpeg_job(job):
+    """Encode decoded pixels or an image file as a JPEG (run in the workers)"""
+    source, dest, quality = job
+    try:
+        from PIL import Image
+
+        if hasattr(source, "shape"):
+            image = Image.fromarray(source)
+        else:
+            image = Image.open(source).convert("RGB")
+        buf = io.BytesIO()
+        image.save(buf, "JPEG", quality=quality)
+        write_file_atomic(dest, buf.getvalue())
+        return True
+    except Exception:
+        logging.exception("Error exporting JPEG " + dest)
+        return False
+
+
+def get_jpeg_data(frame, quality):
+    """The JPEG encoded bytes of a frame"""
+    buf = io.BytesIO()
+    open_frame_image(frame).convert("RGB").save(buf, "JPEG", quality=quality)
+    return buf.getvalue()
+
+
+def convert_to_jpeg_imagemagick(directory, quality):
     pattern = os.path.join(directory, "ms_*.png")
     command = '{0} -format jpg -set colorspace sRGB -quality {1:d} "{2}"'.format(
         image_magick["mogrify"], quality, pattern
@@ -1275,25 +2435,29 @@ def convert_to_jpeg(directory, quality):
 ##########################################################################
 
 
-def render_video(directory, video_file):
-    """Render the frames to the given mp4 file"""
-    directory = os.path.realpath(directory)
-    files = sorted(glob.glob(os.path.join(directory, "ms_*.png")))
+def render_video(directory, video_file, frames=None):
+    """Render the frames to the given mp4 file.
+
+    Every frame is handed to ffmpeg once, through a concat list with the
+    time it stays on screen, and ffmpeg repeats it at 30 fps."""
+    if frames is None:
+        frames = FrameStore.load(os.path.realpath(directory), "ms_")
+    files = frames.list()
     if len(files) > 1:
-        current_image = None
-        with open(os.path.join(directory, files[0]), "rb") as f_in:
-            current_image = f_in.read()
-        if current_image is not None:
+        handle, list_file = tempfile.mkstemp(suffix=".txt", prefix="render-")
+        try:
+            with os.fdopen(handle, "w") as f:
+                f.write(get_render_list(files))
             command = [
                 "ffmpeg",
                 "-f",
-                "image2pipe",
-                "-vcodec",
-                "png",
-                "-r",
-                "30",
+                "concat",
+                "-safe",
+                "0",
                 "-i",
-                "-",
+                list_file,
+                "-vf",
+                "fps=30",
                 "-vcodec",
                 "libx264",
                 "-r",
@@ -1307,51 +2471,46 @@ def render_video(directory, video_file):
                 "-y",
                 video_file,
             ]
-            try:
-                proc = subprocess.Popen(command, stdin=subprocess.PIPE)
-                if proc:
-                    match = re.compile(r"ms_([0-9]+)\.")
-                    m = re.search(match, files[1])
-                    file_index = 0
-                    last_index = len(files) - 1
-                    if m is not None:
-                        next_image_time = int(m.group(1))
-                    done = False
-                    current_frame = 0
-                    while not done:
-                        current_frame_time = int(
-                            round(float(current_frame) * 1000.0 / 30.0)
-                        )
-                        if current_frame_time >= next_image_time:
-                            file_index += 1
-                            with open(
-                                os.path.join(directory, files[file_index]), "rb"
-                            ) as f_in:
-                                current_image = f_in.read()
-                            if file_index < last_index:
-                                m = re.search(match, files[file_index + 1])
-                                if m:
-                                    next_image_time = int(m.group(1))
-                            else:
-                                done = True
-                        proc.stdin.write(current_image)
-                        current_frame += 1
-                    # hold the end frame for one second so it's actually
-                    # visible
-                    for i in range(30):
-                        proc.stdin.write(current_image)
-                    proc.stdin.close()
-                    proc.communicate()
-            except Exception:
-                pass
+            logging.debug(" ".join(command))
+            subprocess.call(command)
+        except Exception:
+            logging.exception("Error rendering the video")
+        finally:
+            os.remove(list_file)
+
+
+def get_render_list(files):
+    """ffconcat script that shows every frame until the next one starts and
+    holds the end frame for one second so it's actually visible"""
+    lines = ["ffconcat version 1.0"]
+    for i in range(len(files)):
+        if i + 1 < len(files):
+            duration = (files[i + 1].time - files[i].time) / 1000.0
+        else:
+            duration = 1.0
+        path = os.path.realpath(frame_file(files[i])).replace("'", "'\\''")
+        lines.append("file '{0}'".format(path))
+        lines.append("duration {0:.3f}".format(duration))
+    # The duration of the last entry only counts when it is followed by another
+    lines.append(lines[-2])
+    return "\n".join(lines) + "\n"
+
+
+def get_png_data(frame):
+    """The png encoded bytes of a frame"""
+    if frame.file is not None and frame.file.endswith(".png"):
+        with open(frame.file, "rb") as f_in:
+            return f_in.read()
+    buf = io.BytesIO()
+    frame.image().save(buf, "PNG")
+    return buf.getvalue()
 
 
 ##########################################################################
 #   Reduce the number of saved video frames if necessary
 ##########################################################################
-def cap_frame_count(directory, maxframes):
-    directory = os.path.realpath(directory)
-    frames = sorted(glob.glob(os.path.join(directory, "ms_*.png")))
+def cap_frame_count(store, maxframes):
+    frames = store.list()
     frame_count = len(frames)
     if frame_count > maxframes:
         # First pass, sample all video frames at 10fps instead of 60fps,
@@ -1362,9 +2521,9 @@ def cap_frame_count(directory, maxframes):
             )
         )
         skip_frames = int(maxframes * 0.2)
-        sample_frames(frames, 100, 0, skip_frames)
+        sample_frames(store, frames, 100, 0, skip_frames)
 
-        frames = sorted(glob.glob(os.path.join(directory, "ms_*.png")))
+        frames = store.list()
         frame_count = len(frames)
         if frame_count > maxframes:
             # Second pass, sample all video frames after the first 5 seconds at
@@ -1375,9 +2534,9 @@ def cap_frame_count(directory, maxframes):
                 )
             )
             skip_frames = int(maxframes * 0.4)
-            sample_frames(frames, 500, 5000, skip_frames)
+            sample_frames(store, frames, 500, 5000, skip_frames)
 
-            frames = sorted(glob.glob(os.path.join(directory, "ms_*.png")))
+            frames = store.list()
             frame_count = len(frames)
             if frame_count > maxframes:
                 # Third pass, sample all video frames after the first 10
@@ -1388,7 +2547,7 @@ def cap_frame_count(directory, maxframes):
                     )
                 )
                 skip_frames = int(maxframes * 0.6)
-                sample_frames(frames, 1000, 10000, skip_frames)
+                sample_frames(store, frames, 1000, 10000, skip_frames)
 
     logging.debug(
         "{0:d} frames final count with a target max of {1:d} frames...".format(
@@ -1397,18 +2556,14 @@ def cap_frame_count(directory, maxframes):
     )
 
 
-def sample_frames(frames, interval, start_ms, skip_frames):
+def sample_frames(store, frames, interval, start_ms, skip_frames):
     frame_count = len(frames)
     if frame_count > 3:
         # Always keep the first and last frames, only sample in the middle
         first_frame = frames[0]
         first_change = frames[1]
         last_frame = frames[-1]
-        match = re.compile(r"ms_(?P<ms>[0-9]+)\.")
-        m = re.search(match, first_change)
-        first_change_time = 0
-        if m is not None:
-            first_change_time = int(m.groupdict().get("ms"))
+        first_change_time = first_change.time
         last_bucket = None
         logging.debug(
             "Sapling frames in {0:d}ms intervals after {1:d} ms, skipping {2:d} frames...".format(
@@ -1417,22 +2572,19 @@ def sample_frames(frames, interval, start_ms, skip_frames):
         )
         frame_count = 0
         for frame in frames:
-            m = re.search(match, frame)
-            if m is not None:
-                frame_count += 1
-                frame_time = int(m.groupdict().get("ms"))
-                frame_bucket = int(math.floor(frame_time / interval))
-                if (
-                    frame_time > first_change_time + start_ms
-                    and frame_bucket == last_bucket
-                    and frame != first_frame
-                    and frame != first_change
-                    and frame != last_frame
-                    and frame_count > skip_frames
-                ):
-                    logging.debug("Removing sampled frame " + frame)
-                    os.remove(frame)
-                last_bucket = frame_bucket
+            frame_count += 1
+            frame_bucket = int(math.floor(frame.time / interval))
+            if (
+                frame.time > first_change_time + start_ms
+                and frame_bucket == last_bucket
+                and frame != first_frame
+                and frame != first_change
+                and frame != last_frame
+                and frame_count > skip_frames
+            ):
+                logging.debug("Removing sampled frame " + str(frame))
+                store.remove(frame)
+            last_bucket = frame_bucket
 
 
 ##########################################################################
@@ -1449,6 +2601,7 @@ def calculate_visual_metrics(
     dirs,
     progress_file,
     hero_elements_file,
+    frames=None,
 ):
     metrics = None
     histograms = load_histograms(histograms_file, start, end)
@@ -1462,6 +2615,15 @@ def calculate_visual_metrics(
                 f = open(progress_file, "wb")
             json.dump(progress, f)
             f.close()
+        # The metrics below are reused when neither the frames nor the time
+        # range changed since they were calculated
+        metric_inputs = None
+        if manifest is not None and manifest.digest("histograms") is not None:
+            metric_inputs = {
+                "histograms": manifest.digest("histograms"),
+                "start": start,
+                "end": end,
+            }
         if len(histograms) > 1:
             metrics = [
                 {"name": "First Visual Change", "value": histograms[1]["time"]},
@@ -1469,7 +2631,14 @@ def calculate_visual_metrics(
                 {"name": "Speed Index", "value": calculate_speed_index(progress)},
             ]
             if perceptual:
-                value, value_progress = calculate_perceptual_speed_index(progress, dirs)
+                value, value_progress = run_stage(
+                    "perceptual",
+                    metric_inputs,
+                    calculate_perceptual_speed_index,
+                    progress,
+                    dirs,
+                    frames,
+                )
                 metrics.extend(
                     (
                         {"name": "Perceptual Speed Index", "value": value},
@@ -1480,7 +2649,14 @@ def calculate_visual_metrics(
                     )
                 )
             if contentful:
-                value, value_progress = calculate_contentful_speed_index(progress, dirs)
+                value, value_progress = run_stage(
+                    "contentful",
+                    metric_inputs,
+                    calculate_contentful_speed_index,
+                    progress,
+                    dirs,
+                    frames,
+                )
 
                 metrics.extend(
                     (
@@ -1509,16 +2685,25 @@ def calculate_visual_metrics(
                     and len(hero_data["heroes"]) > 0
                 ):
                     viewport = hero_data["viewport"]
-                    hero_timings = []
-                    for hero in hero_data["heroes"]:
-                        hero_timings.append(
-                            {
-                                "name": hero["name"],
-                                "value": calculate_hero_time(
-                                    progress, dirs, hero, viewport
-                                ),
-                            }
+                    heroes = hero_data["heroes"]
+                    hero_inputs = None
+                    if metric_inputs is not None:
+                        hero_inputs = dict(
+                            metric_inputs, heroes=heroes, viewport=viewport
                         )
+                    times = run_stage(
+                        "heroes",
+                        hero_inputs,
+                        calculate_hero_times,
+                        progress,
+                        dirs,
+                        heroes,
+                        viewport,
+                        frames,
+                    )
+                    hero_timings = []
+                    for hero, time in zip(heroes, times):
+                        hero_timings.append({"name": hero["name"], "value": time})
                     hero_timings_sorted = sorted(
                         hero_timings, key=lambda timing: timing["value"]
                     )
@@ -1564,6 +2749,13 @@ def calculate_visual_metrics(
 def load_histograms(histograms_file, start, end):
     histograms = None
     if os.path.isfile(histograms_file):
+        with open(histograms_file, "rb") as f:
+            binary = f.read(len(HISTOGRAMS_MAGIC)) == HISTOGRAMS_MAGIC
+        if binary:
+            histograms = load_histograms_binary(histograms_file)
+            if start != 0 or end != 0:
+                histograms = histograms.window(start, end)
+            return histograms
         f = gzip.open(histograms_file)
         original = json.load(f)
         f.close()
@@ -1584,13 +2776,27 @@ def load_histograms(histograms_file, start, end):
 
 def calculate_visual_progress(histograms):
     progress = []
-    first = histograms[0]["histogram"]
-    last = histograms[-1]["histogram"]
-    for index, histogram in enumerate(histograms):
-        p = calculate_frame_progress(histogram["histogram"], first, last)
-        file_name, ext = os.path.splitext(histogram["file"])
-        progress.append({"time": histogram["time"], "file": file_name, "progress": p})
-        logging.debug("{0:d}ms - {1:d}% Complete".format(histogram["time"], int(p)))
+    if isinstance(histograms, Histograms):
+        counts = histograms.counts
+        times = histograms.times
+        files = histograms.files
+    else:
+        counts = [histogram["histogram"] for histogram in histograms]
+        times = [histogram["time"] for histogram in histograms]
+        files = [histogram["file"] for histogram in histograms]
+    first = counts[0]
+    last = counts[-1]
+    try:
+        frames_progress = calculate_frames_progress(counts, first, last)
+    except ImportError:
+        frames_progress = [
+            calculate_frame_progress(histogram, first, last) for histogram in counts
+        ]
+    for index, time in enumerate(times):
+        p = frames_progress[index]
+        file_name, ext = os.path.splitext(files[index])
+        progress.append({"time": time, "file": file_name, "progress": p})
+        logging.debug("{0:d}ms - {1:d}% Complete".format(time, int(p)))
     return progress
 
 
@@ -1623,6 +2829,58 @@ def calculate_frame_progress(histogram, start, final):
     return math.floor(progress * 100)
 
 
+def histograms_to_array(histograms):
+    """Stack histograms into a (frames, 3, 256) array of r, g and b counts"""
+    import numpy as np
+
+    return np.array(
+        [
+            [histogram[channel] for channel in ["r", "g", "b"]]
+            for histogram in histograms
+        ],
+        dtype=np.int64,
+    ).reshape(len(histograms), 3, 256)
+
+
+def calculate_frames_progress(histograms, start, final):
+    """calculate_frame_progress for all of the frames at once.
+
+    The greedy matching walks the buckets in the same order, but each step
+    updates every frame and channel together so the results are identical.
+    """
+    import numpy as np
+
+    slop = 5  # allow for matching slight color variations
+    buckets = 256
+    if isinstance(histograms, np.ndarray):
+        histograms = histograms.astype(np.int64)
+        start = np.asarray(start, dtype=np.int64)
+        final = np.asarray(final, dtype=np.int64)
+    else:
+        histograms = histograms_to_array(histograms)
+        start = histograms_to_array([start])[0]
+        final = histograms_to_array([final])[0]
+    available = np.abs(histograms - start)
+    targets = np.abs(final - start)
+    matched = np.zeros(histograms.shape[:2], dtype=np.int64)
+    for i in np.flatnonzero(targets.any(axis=0)):
+        target = np.tile(targets[:, i], (histograms.shape[0], 1))
+        low = max(0, i - slop)
+        high = min(buckets, i + slop)
+        for j in range(low, high):
+            this_match = np.minimum(target, available[:, :, j])
+            available[:, :, j] -= this_match
+            matched += this_match
+            target -= this_match
+    total = int(targets.sum())
+    if not total:
+        return [100 for i in range(histograms.shape[0])]
+    return [
+        int(math.floor((float(frame_matched) / float(total)) * 100))
+        for frame_matched in matched.sum(axis=1)
+    ]
+
+
 def find_visually_complete(progress):
     time = 0
     for p in progress:
@@ -1646,46 +2904,26 @@ def calculate_speed_index(progress):
     return int(si)
 
 
-def calculate_contentful_speed_index(progress, directory):
-    # convert output comes out with lines that have this format:
-    # <number>: <rgb color> #<hex color> <gray color>
-    # This is CLI dependant and very fragile
-    matcher = re.compile(r"\d+: \S+ #[0-9A-F]+ (?:gray\((\d+)\)|(\d+)(?:))")
-
+def calculate_contentful_speed_index(progress, directory, frames=None):
     try:
-        dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), directory)
-        content = []
-        maxContent = 0
-        for p in progress[1:]:
-            # Full Path of the Current Frame
-            current_frame = os.path.join(dir, "ms_{0:06d}.png".format(p["time"]))
-            logging.debug("contentfulSpeedIndex: Current Image is %s" % current_frame)
-            # Takes full path of PNG frames to compute contentfulness value
-            command = "{0} {1} -canny 2x2+8%+8% -define histogram:unique-colors=true -format %c histogram:info:-".format(
-                image_magick["convert"], current_frame
-            )
-            output = subprocess.check_output(command, shell=True)
-            logging.debug("Output %s" % output)
-            # take the last line of the convert call output
-            lines = [
-                line.strip().decode("utf8")
-                for line in output.split(b"\n")
-                if line.strip()
+        if frames is None:
+            dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), directory)
+            frames = FrameStore.load(dir, "ms_", get_frame_memory())
+        current_frames = [frames.get(p["time"]) for p in progress[1:]]
+        if get_compare_engine() == "numpy":
+            jobs = [
+                frame.data if frame.data is not None else frame.file
+                for frame in current_frames
             ]
-            if len(lines) == 0:
-                logging.debug("Could not find the contentfulness value")
-                return None, None
-
-            # extract the value from the last line
-            match = [[v for v in el if v] for el in matcher.findall(lines[-1])]
-            if match == []:
-                logging.debug("Could not find the contentfulness value")
-                return None, None
-
-            value = int(match[0][0])
-            if value > maxContent:
-                maxContent = value
-            content.append(value)
+            content = map_frames(calculate_edge_count_job, jobs)
+        else:
+            content = [
+                calculate_edge_count_imagemagick(frame) for frame in current_frames
+            ]
+        if None in content:
+            logging.debug("Could not find the contentfulness value")
+            return None, None
+        maxContent = max(content)
 
         for i, value in enumerate(content):
             content[i] = (
@@ -1713,30 +2951,142 @@ def calculate_contentful_speed_index(progress, directory):
         return None, None
 
 
-def calculate_perceptual_speed_index(progress, directory):
-    from ssim import compute_ssim
-
+def calculate_edge_count_imagemagick(frame):
+    """Number of edge pixels in a frame, found by ImageMagick's Canny detector"""
+    logging.debug("contentfulSpeedIndex: Current Image is %s" % frame)
+    # The edge image is black and white so its mean is the fraction of edges
+    command = '{0} "{1}" -canny 2x2+8%+8% -format "%[fx:int(mean*w*h+0.5)]" info:'.format(
+        image_magick["convert"], frame_file(frame)
+    )
+    output = subprocess.check_output(command, shell=True, universal_newlines=True)
+    logging.debug("Output %s" % output)
+    if re.match(r"^\s*[0-9]+\s*$", output):
+        return int(output)
+    return None
+
+
+def calculate_edge_count_job(job):
+    """calculate_edge_count() of a frame (pixels or file), run in the workers"""
+    return calculate_edge_count(load_job_pixels(job))
+
+
+def calculate_edge_count(pixels, radius=2, sigma=2.0, threshold=0.08):
+    """Number of edge pixels in a frame.
+
+    This is an in-process port of the Canny detector behind ImageMagick's
+    '-canny 2x2+8%+8%' (CannyEdgeImage): a separable Gaussian blur with the
+    same kernel sampling, 2x2 gradients, non-maximum suppression along the
+    same 4 quantized directions (including the east/west fallback for
+    vertical gradients) and equal lower and upper thresholds of 8% of the
+    suppressed gradient range, which makes the hysteresis a plain threshold.
+    ImageMagick also reuses the first row of its gradient cache as the stack
+    for tracing edges and rounds to 16-bit quanta, so counts can differ
+    slightly, mostly along the top edge of the frame. The normalized content
+    values agree to within 0.05.
+    """
+    import numpy as np
+
+    height, width = pixels.shape[:2]
+    # Rec. 709 luma in 16-bit quanta, like the GRAY colorspace transform
+    gray = np.dot(pixels[:, :, :3].astype(np.float64), [0.212656, 0.715158, 0.072186])
+    gray *= 257.0
+    kernel = get_blur_kernel(radius, sigma)
+    padded = np.pad(gray, ((0, 0), (radius, radius)), mode="edge")
+    blurred = np.zeros((height, width))
+    for i, weight in enumerate(kernel):
+        end = i + width
+        blurred += weight * padded[:, i:end]
+    padded = np.pad(blurred, ((radius, radius), (0, 0)), mode="edge")
+    blurred = np.zeros((height, width))
+    for i, weight in enumerate(kernel):
+        end = i + height
+        blurred += weight * padded[i:end, :]
+
+    # Gradients over the 2x2 block to the bottom-right of each pixel
+    padded = np.pad(blurred, ((0, 1), (0, 1)), mode="edge")
+    top_left = padded[:-1, :-1]
+    top_right = padded[:-1, 1:]
+    bottom_left = padded[1:, :-1]
+    bottom_right = padded[1:, 1:]
+    dx = 0.5 * (top_right + bottom_right - top_left - bottom_left)
+    dy = 0.5 * (top_left + top_right - bottom_left - bottom_right)
+    magnitude = np.hypot(dx, dy)
+
+    # Quantize the direction: 0 = north/south, 1 = northwest/southeast,
+    # 2 = east/west, 3 = northeast/southwest
+    orientation = np.full((height, width), 2, dtype=np.int8)
+    sloped = np.abs(dx) > 1.0e-12
+    slope = np.zeros((height, width))
+    slope[sloped] = dy[sloped] / dx[sloped]
+    orientation[sloped & (slope < -2.41421356237)] = 0
+    orientation[sloped & (slope >= -2.41421356237) & (slope < -0.414213562373)] = 1
+    orientation[sloped & (slope > 2.41421356237)] = 0
+    orientation[sloped & (slope > 0.414213562373) & (slope <= 2.41421356237)] = 3
+
+    # Non-maximum suppression (the frame edges are extended)
+    padded = np.pad(magnitude, 1, mode="edge")
+    north = padded[:-2, 1:-1]
+    south = padded[2:, 1:-1]
+    west = padded[1:-1, :-2]
+    east = padded[1:-1, 2:]
+    alpha = np.choose(orientation, [north, padded[:-2, :-2], west, padded[2:, :-2]])
+    beta = np.choose(orientation, [south, padded[2:, 2:], east, padded[:-2, 2:]])
+    intensity = np.where((magnitude < alpha) | (magnitude < beta), 0.0, magnitude)
+
+    limit = threshold * (intensity.max() - intensity.min())
+    return int(np.count_nonzero(intensity >= limit))
+
+
+def get_blur_kernel(radius, sigma):
+    """1D Gaussian kernel, sampled the way ImageMagick builds its blur kernel"""
+    import numpy as np
+
+    rank = 3
+    width = 2 * radius + 1
+    v = int((width * rank - 1) / 2)
+    sigma *= rank
+    kernel = np.zeros(width)
+    for u in range(-v, v + 1):
+        kernel[int((u + v) / rank)] += math.exp(-float(u * u) / (2.0 * sigma * sigma))
+    return kernel / kernel.sum()
+
+
+def load_job_pixels(job):
+    """(height, width, 3) pixels of a worker job (pixels or image file)"""
+    import numpy as np
+
+    if hasattr(job, "shape"):
+        return job
+    return np.asarray(load_ssim_image(job))
+
+
+def calculate_perceptual_speed_index(progress, directory, frames=None):
     x = len(progress)
-    dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), directory)
-    first_paint_frame = os.path.join(dir, "ms_{0:06d}.png".format(progress[1]["time"]))
-    target_frame = os.path.join(dir, "ms_{0:06d}.png".format(progress[x - 1]["time"]))
-    ssim_1 = compute_ssim(first_paint_frame, target_frame)
-    per_si = float(progress[1]["time"])
-    last_ms = progress[1]["time"]
+    if frames is None:
+        dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), directory)
+        frames = FrameStore.load(dir, "ms_", get_frame_memory())
+    target_frame = frames.get(progress[x - 1]["time"])
     # Full Path of the Target Frame
     logging.debug("Target image for perSI is %s" % target_frame)
-    ssim = ssim_1
-    completeness_value = []
+    # The target is converted to grayscale and its Gaussian statistics are
+    # computed once per worker, the frames are then scored in parallel.
+    jobs = []
     for p in progress[1:]:
+        current_frame = frames.get(p["time"])
+        jobs.append(
+            current_frame.data if current_frame.data is not None else current_frame.file
+        )
+    target = target_frame.data if target_frame.data is not None else target_frame.file
+    scores = map_frames(calculate_ssim_job, jobs, init_ssim_target, (target,))
+    per_si = float(progress[1]["time"])
+    last_ms = progress[1]["time"]
+    ssim = scores[0]
+    completeness_value = []
+    for index, p in enumerate(progress[1:]):
         elapsed = p["time"] - last_ms
         # print '*******elapsed %f'%elapsed
-        # Full Path of the Current Frame
-        current_frame = os.path.join(dir, "ms_{0:06d}.png".format(p["time"]))
-        logging.debug("Current Image is %s" % current_frame)
-        # Takes full path of PNG frames to compute SSIM value
         per_si += elapsed * (1.0 - ssim)
-        ssim = compute_ssim(current_frame, target_frame)
-        gc.collect()
+        ssim = scores[index]
         last_ms = p["time"]
         completeness_value.append((p["time"], int(per_si)))
 
@@ -1749,31 +3099,141 @@ def calculate_perceptual_speed_index(progress, directory):
     return per_si, ", ".join(raw_progress_value)
 
 
-def calculate_hero_time(progress, directory, hero, viewport):
+def init_ssim_target(target):
+    """Pre-process the target frame for SSIM (once in every worker)"""
+    global ssim_target
+    from ssim import SSIM, get_gaussian_kernel
+
+    # The same kernel compute_ssim() uses
+    ssim_target = SSIM(load_ssim_image(target), get_gaussian_kernel(11, 1.5))
+
+
+def calculate_ssim_job(job):
+    """SSIM of a frame (pixels or file) against the pre-processed target"""
+    return ssim_target.ssim_value(load_ssim_image(job))
+
+
+def load_ssim_image(job):
+    from PIL import Image
+
+    if hasattr(job, "shape"):
+        return Image.fromarray(job)
+    with Image.open(job) as im:
+        return im.convert("RGB")
+
+
+def calculate_hero_times(progress, directory, heroes, viewport, frames=None):
+    """Time at which each hero element first matches the last frame.
+
+    Every frame is decoded once and compared with the target frame in memory.
+    The pixels that differ by more than a 10% fuzz are summed into an
+    integral image, so each hero rectangle costs four lookups. A hero is done
+    (and no longer checked) once fewer than 2% of its pixels differ, and the
+    frames stop being compared when every hero is done. This is the same
+    test that calculate_hero_time() does with ImageMagick masks."""
+    if get_compare_engine() != "numpy":
+        return [
+            calculate_hero_time(progress, directory, hero, viewport, frames)
+            for hero in heroes
+        ]
+    import numpy as np
+
+    times = [None for hero in heroes]
+    try:
+        if frames is None:
+            dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), directory)
+            frames = FrameStore.load(dir, "ms_", get_frame_memory())
+        target_frame = frames.get(progress[-1]["time"])
+        if target_frame is None:
+            return times
+        target = target_frame.pixels.astype(np.int16)
+        height, width = target.shape[:2]
+        scale = 1.0
+        if width != viewport["width"]:
+            scale = float(width) / float(viewport["width"])
+            logging.debug(
+                "Frames are %dpx wide but viewport was %dpx. Scaling by %f"
+                % (width, viewport["width"], scale)
+            )
+        # Hero rectangles (inclusive, like the drawn masks) clipped to the frame
+        rects = []
+        for hero in heroes:
+            logging.debug(
+                'Calculating render time for hero element "%s" at position [%d, %d, %d, %d]'
+                % (hero["name"], hero["x"], hero["y"], hero["width"], hero["height"])
+            )
+            hero_width = int(hero["width"] * scale)
+            hero_height = int(hero["height"] * scale)
+            hero_x = int(hero["x"] * scale)
+            hero_y = int(hero["y"] * scale)
+            rects.append(
+                {
+                    "left": min(max(hero_x, 0), width),
+                    "top": min(max(hero_y, 0), height),
+                    "right": min(max(hero_x + hero_width + 1, 0), width),
+                    "bottom": min(max(hero_y + hero_height + 1, 0), height),
+                    # Allow for small differences like scrollbars and overlaid
+                    # UI elements by allowing up to 2% of the pixels to differ
+                    "max_diff": math.ceil(hero_width * hero_height * 0.02),
+                }
+            )
+        threshold = get_fuzz_threshold(10)
+        pending = list(range(len(heroes)))
+        for p in progress:
+            current_frame = frames.get(p["time"])
+            if current_frame is None:
+                continue
+            pixels = current_frame.pixels
+            if pixels.shape != target.shape:
+                continue
+            # Only compare the area that the pending heroes cover
+            left = min(rects[i]["left"] for i in pending)
+            top = min(rects[i]["top"] for i in pending)
+            right = max(rects[i]["right"] for i in pending)
+            bottom = max(rects[i]["bottom"] for i in pending)
+            delta = np.abs(
+                pixels[top:bottom, left:right].astype(np.int16)
+                - target[top:bottom, left:right]
+            )
+            different = (delta > threshold).any(axis=2)
+            counts = np.zeros((bottom - top + 1, right - left + 1), dtype=np.int64)
+            counts[1:, 1:] = different.cumsum(axis=0).cumsum(axis=1)
+            for i in list(pending):
+                rect = rects[i]
+                x0 = rect["left"] - left
+                y0 = rect["top"] - top
+                x1 = rect["right"] - left
+                y1 = rect["bottom"] - top
+                different_pixels = (
+                    counts[y1, x1] - counts[y0, x1] - counts[y1, x0] + counts[y0, x0]
+                )
+                if different_pixels <= rect["max_diff"]:
+                    times[i] = p["time"]
+                    pending.remove(i)
+            if not pending:
+                break
+    except Exception as e:
+        logging.exception(e)
+    return times
+
+
+def calculate_hero_time(progress, directory, hero, viewport, frames=None):
     try:
         dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), directory)
+        if frames is None:
+            frames = FrameStore.load(dir, "ms_", get_frame_memory())
         n = len(progress)
-        target_frame = os.path.join(dir, "ms_{0:06d}".format(progress[n - 1]["time"]))
-
-        extension = None
-        if os.path.isfile(target_frame + ".png"):
-            extension = ".png"
-        elif os.path.isfile(target_frame + ".jpg"):
-            extension = ".jpg"
-        if extension is not None:
+        target_frame = frames.get(progress[n - 1]["time"])
+        if target_frame is not None:
             hero_width = int(hero["width"])
             hero_height = int(hero["height"])
             hero_x = int(hero["x"])
             hero_y = int(hero["y"])
-            target_frame = target_frame + extension
             logging.debug(
                 "Target image for hero %s is %s" % (hero["name"], target_frame)
             )
 
-            from PIL import Image
-
-            with Image.open(target_frame) as im:
-                width, height = im.size
+            width, height = target_frame.size
             if width != viewport["width"]:
                 scale = float(width) / float(viewport["width"])
                 logging.debug(
@@ -1810,7 +3270,10 @@ def calculate_hero_time(progress, directory, hero, viewport):
                 "hero_{0}_ms_{1:06d}.png".format(hero["name"], progress[n - 1]["time"]),
             )
             command = "{0} {1} {2} -alpha Off -compose CopyOpacity -composite {3}".format(
-                image_magick["convert"], target_frame, hero_mask, target_mask
+                image_magick["convert"],
+                frame_file(target_frame),
+                hero_mask,
+                target_mask,
             )
             subprocess.call(command, shell=True)
 
@@ -1826,20 +3289,15 @@ def calculate_hero_time(progress, directory, hero, viewport):
             max_pixel_diff = math.ceil(hero_width * hero_height * 0.02)
 
             for p in progress:
-                current_frame = os.path.join(dir, "ms_{0:06d}".format(p["time"]))
-                extension = None
-                if os.path.isfile(current_frame + ".png"):
-                    extension = ".png"
-                elif os.path.isfile(current_frame + ".jpg"):
-                    extension = ".jpg"
-                if extension is not None:
+                current_frame = frames.get(p["time"])
+                if current_frame is not None:
                     current_mask = os.path.join(
                         dir, "hero_{0}_ms_{1:06d}.png".format(hero["name"], p["time"])
                     )
                     # Apply the mask to the current frame
                     command = "{0} {1} {2} -alpha Off -compose CopyOpacity -composite {3}".format(
                         image_magick["convert"],
-                        current_frame + extension,
+                        frame_file(current_frame),
                         hero_mask,
                         current_mask,
                     )
@@ -1865,6 +3323,180 @@ def calculate_hero_time(progress, directory, hero, viewport):
         return None
 
 
+##########################################################################
+#   Tool and library capabilities
+##########################################################################
+
+
+class Capabilities(object):
+    """Persisted results of the tool and library probes.
+
+    Every entry is stored with a key made of the paths and modification times
+    of the files it depends on, so installing a different ffmpeg, ImageMagick
+    or Python module invalidates it automatically. Probes without a key (the
+    tool or module can't be found) or without a result are not persisted."""
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        if path is not None and os.path.isfile(path):
+            try:
+                with open(path, "r") as f:
+                    entries = json.load(f)
+                if isinstance(entries, dict):
+                    self.entries = entries
+            except BaseException:
+                logging.debug("Ignoring the unreadable capability cache %s", path)
+
+    def get(self, name, key, probe):
+        if key is not None:
+            entry = self.entries.get(name)
+            if entry is not None and entry.get("key") == key:
+                return entry.get("value")
+        value = probe()
+        if key is not None and value is not None:
+            self.entries[name] = {"key": key, "value": value}
+            self.save()
+        return value
+
+    def clear(self):
+        self.entries = {}
+        self.save()
+
+    def save(self):
+        if not self.path:
+            return
+        tmp = "{0}.{1:d}.tmp".format(self.path, os.getpid())
+        try:
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            with open(tmp, "w") as f:
+                json.dump(self.entries, f, indent=2, sort_keys=True)
+            if platform.system() == "Windows" and os.path.isfile(self.path):
+                os.remove(self.path)
+            os.rename(tmp, self.path)
+        except BaseException:
+            logging.debug("Unable to write the capability cache %s", self.path)
+            if os.path.isfile(tmp):
+                os.remove(tmp)
+
+
+def get_capabilities():
+    global capabilities
+    path = get_capabilities_file()
+    if capabilities is None or capabilities.path != path:
+        capabilities = Capabilities(path)
+    return capabilities
+
+
+def get_capabilities_file():
+    if options is not None and getattr(options, "capabilities", None) is not None:
+        return options.capabilities
+    cache = os.getenv("XDG_CACHE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".cache"
+    )
+    return os.path.join(cache, "visualmetrics", "capabilities.json")
+
+
+def find_executable(name):
+    try:
+        from shutil import which
+    except ImportError:
+        from distutils.spawn import find_executable as which
+    return which(name)
+
+
+def get_tool_key(command):
+    """[path, mtime] of the executable a command runs (None if it can't be found)"""
+    path = find_executable(command.strip().strip('"'))
+    if path is None:
+        return None
+    path = os.path.realpath(path)
+    try:
+        return [path, os.path.getmtime(path)]
+    except OSError:
+        return None
+
+
+def get_module_key(name):
+    """[path, mtime] of the file a module imports from (None if it can't be found)"""
+    path = None
+    try:
+        from importlib.util import find_spec
+
+        try:
+            spec = find_spec(name)
+            if spec is not None:
+                path = spec.origin
+        except (ImportError, ValueError):
+            path = None
+    except ImportError:
+        import imp
+
+        try:
+            path = imp.find_module(name)[1]
+        except ImportError:
+            path = None
+    if path is None or not os.path.exists(path):
+        return None
+    return [os.path.realpath(path), os.path.getmtime(path)]
+
+
+def has_module(name):
+    """Is the Python module available (the probe imports it)"""
+
+    def probe():
+        try:
+            __import__(name)
+            return True
+        except ImportError:
+            return False
+
+    return get_capabilities().get("module:" + name, get_module_key(name), probe)
+
+
+def get_hwaccels():
+    """The hardware decoders ffmpeg was built with"""
+    return get_capabilities().get("hwaccels", get_tool_key("ffmpeg"), probe_hwaccels)
+
+
+def probe_hwaccels():
+    try:
+        out = subprocess.check_output(
+            ["ffmpeg", "-hide_banner", "-hwaccels"],
+            stderr=subprocess.STDOUT,
+            universal_newlines=True,
+        )
+    except BaseException:
+        logging.debug("Error checking ffmpeg for hardware decoders")
+        return None
+    lines = [line.strip() for line in out.split("\n")]
+    if "Hardware acceleration methods:" not in lines:
+        return []
+    start = lines.index("Hardware acceleration methods:") + 1
+    return [line for line in lines[start:] if line]
+
+
+def has_image_magick():
+    """Are the ImageMagick convert and compare commands available"""
+    convert = get_tool_key(image_magick["convert"])
+    compare = get_tool_key(image_magick["compare"])
+    key = None
+    if convert is not None and compare is not None:
+        key = [convert, compare]
+    return get_capabilities().get(
+        "imagemagick",
+        key,
+        lambda: check_process(
+            "{0} -version".format(image_magick["convert"]), "ImageMagick"
+        )
+        and check_process(
+            "{0} -version".format(image_magick["compare"]), "ImageMagick"
+        ),
+    )
+
+
 ##########################################################################
 #   Check any dependencies
 ##########################################################################
@@ -1872,6 +3504,8 @@ def calculate_hero_time(progress, directory, hero, viewport):
 
 def check_config():
     ok = True
+    # Always re-probe, the results refresh the capability cache
+    get_capabilities().clear()
 
     print("ffmpeg:  ",)
     if get_decimate_filter() is not None:
@@ -1880,35 +3514,44 @@ def check_config():
         print("FAIL")
         ok = False
 
-    print("convert: ",)
-    if check_process("{0} -version".format(image_magick["convert"]), "ImageMagick"):
-        print("OK")
-    else:
-        print("FAIL")
-        ok = False
+    print("hwaccel: ",)
+    print(", ".join(get_hwaccels() or []) or "none")
 
-    print("compare: ",)
-    if check_process("{0} -version".format(image_magick["compare"]), "ImageMagick"):
-        print("OK")
-    else:
-        print("FAIL")
+    # Frames are compared with NumPy or, without it, with ImageMagick
+    has_numpy = has_module("numpy")
+    has_convert = check_process(
+        "{0} -version".format(image_magick["convert"]), "ImageMagick"
+    )
+    has_compare = check_process(
+        "{0} -version".format(image_magick["compare"]), "ImageMagick"
+    )
+    has_engine = has_numpy or (has_convert and has_compare)
+    for label, found, alternative in [
+        ("convert: ", has_convert, "NumPy"),
+        ("compare: ", has_compare, "NumPy"),
+        ("NumPy:   ", has_numpy, "ImageMagick"),
+    ]:
+        print(label,)
+        if found:
+            print("OK")
+        elif has_engine:
+            print("not found (using {0})".format(alternative))
+        else:
+            print("FAIL")
+    if not has_engine:
         ok = False
 
     print("Pillow:  ",)
-    try:
-        from PIL import Image, ImageDraw  # noqa
-
+    if has_module("PIL"):
         print("OK")
-    except BaseException:
+    else:
         print("FAIL")
         ok = False
 
     print("SSIM:    ",)
-    try:
-        from ssim import compute_ssim  # noqa
-
+    if has_module("ssim"):
         print("OK")
-    except BaseException:
+    else:
         print("FAIL")
         ok = False
 
@@ -1918,7 +3561,9 @@ def check_config():
 def check_process(command, output):
     ok = False
     try:
-        out = subprocess.check_output(command, stderr=subprocess.STDOUT, shell=True)
+        out = subprocess.check_output(
+            command, stderr=subprocess.STDOUT, shell=True, universal_newlines=True
+        )
         if out.find(output) > -1:
             ok = True
     except BaseException:
@@ -1931,12 +3576,9 @@ def check_process(command, output):
 ##########################################################################
 
 
-def main():
+def get_parser():
     import argparse
 
-    global options
-    global image_magick
-
     parser = argparse.ArgumentParser(
         description="Calculate visual performance metrics from a video.",
         prog="visualmetrics",
@@ -1947,12 +3589,13 @@ def main():
         "--check",
         action="store_true",
         default=False,
-        help="Check dependencies (ffmpeg, imagemagick, PIL, SSIM).",
+        help="Check dependencies (ffmpeg, imagemagick, PIL, NumPy, SSIM).",
     )
     parser.add_argument(
         "-v",
         "--verbose",
         action="count",
+        default=0,
         help="Increase verbosity (specify multiple times for more).",
     )
     parser.add_argument(
@@ -1976,7 +3619,8 @@ def main():
         "-g",
         "--histogram",
         help="Histogram file (as input if exists or as output if "
-        "histograms need to be calculated).",
+        "histograms need to be calculated). Files ending in .bin use a "
+        "memory-mapped binary format, other files are gzipped JSON.",
     )
     parser.add_argument(
         "-m",
@@ -2139,40 +3783,68 @@ def main():
         default=False,
         help="Set output format to JSON",
     )
+    parser.add_argument(
+        "--framememory",
+        type=int,
+        default=1024,
+        help="Memory (in MB) for decoded video frames before they are spilled "
+        "to a memory-mapped file (defaults to 1024).",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=multiprocessing.cpu_count(),
+        help="Number of processes for the per-frame work "
+        "(defaults to the number of cores).",
+    )
+    parser.add_argument(
+        "--imagemagick",
+        action="store_true",
+        default=False,
+        help="Compare frames with ImageMagick instead of the in-process NumPy engine.",
+    )
+    parser.add_argument(
+        "--hwdecode",
+        action="store_true",
+        default=False,
+        help="Decode the video with one of ffmpeg's hardware decoders when "
+        "there is one.",
+    )
+    parser.add_argument(
+        "--capabilities",
+        help="Cache file for the ffmpeg, ImageMagick and library probes "
+        "(defaults to ~/.cache/visualmetrics/capabilities.json, an empty "
+        "string disables the cache).",
+    )
+    parser.add_argument(
+        "--worker",
+        action="store_true",
+        default=False,
+        help="Keep running and analyze the jobs read from stdin, one JSON object "
+        'per line ({"id": ..., "video": ..., "options": {...}}), writing one JSON '
+        "result per line to stdout.",
+    )
+    parser.add_argument(
+        "--batch",
+        nargs="+",
+        help="Analyze several videos (paths or glob patterns) on a pool of "
+        "--workers processes. The metrics of every video are written to "
+        "--output and the per-video paths (--dir, --histogram, --progress, "
+        "--render, --screenshot, --herodata, --timeline) can use {name} (the "
+        "video name), {dir} (its directory) and {index}.",
+    )
+    parser.add_argument(
+        "--output",
+        default=os.path.join("{dir}", "{name}.json"),
+        help="JSON metrics file of each video in --batch mode "
+        "(defaults to {dir}/{name}.json).",
+    )
     parser.add_argument("--progress", help="Visual progress output file.")
     parser.add_argument("--herodata", help="Hero elements data file.")
+    return parser
 
-    options = parser.parse_args()
-
-    if (
-        not options.check
-        and not options.dir
-        and not options.video
-        and not options.histogram
-    ):
-        parser.error(
-            "A video, Directory of images or histograms file needs to be provided.\n\n"
-            "Use -h to see available options"
-        )
-
-    if options.perceptual or options.contentful:
-        if not options.video:
-            parser.error(
-                "A video file needs to be provided.\n\n"
-                "Use -h to see available options"
-            )
-
-    temp_dir = tempfile.mkdtemp(prefix="vis-")
-    colors_temp_dir = tempfile.mkdtemp(prefix="vis-color-")
-    directory = temp_dir
-    if options.dir is not None:
-        directory = options.dir
-    if options.histogram is not None:
-        histogram_file = options.histogram
-    else:
-        histogram_file = os.path.join(temp_dir, "histograms.json.gz")
 
-    # Set up logging
+def configure_logging(options):
     log_level = logging.CRITICAL
     if options.verbose == 1:
         log_level = logging.ERROR
@@ -2196,9 +3868,9 @@ def main():
             datefmt="%H:%M:%S",
         )
 
-    if options.multiple:
-        options.orange = True
 
+def find_image_magick():
+    """Locate the ImageMagick binaries (only needed on Windows)"""
     if platform.system() == "Windows":
         paths = [os.getenv("ProgramFiles"), os.getenv("ProgramFiles(x86)")]
         for path in paths:
@@ -2225,94 +3897,399 @@ def main():
                             image_magick["mogrify"] = mogrify
                             break
 
-    ok = False
+
+def run_analysis():
+    """Process the video and/or frames described by the global options.
+
+    Returns the list of metrics (None on failure)."""
+    global manifest
+
+    metrics = None
+    if options.multiple:
+        options.orange = True
+    temp_dir = tempfile.mkdtemp(prefix="vis-")
+    colors_temp_dir = tempfile.mkdtemp(prefix="vis-color-")
+    directory = temp_dir
+    manifest = None
+    if options.dir is not None:
+        directory = options.dir
+        manifest = StageManifest(
+            os.path.join(os.path.realpath(directory), "manifest.json")
+        )
+    if options.histogram is not None:
+        histogram_file = options.histogram
+    else:
+        histogram_file = os.path.join(temp_dir, "histograms.json.gz")
+        if has_module("numpy"):
+            histogram_file = os.path.join(temp_dir, "histograms.bin")
     try:
-        if not options.check:
-            if options.video:
-                orange_file = None
-                if options.orange:
-                    orange_file = os.path.join(
-                        os.path.dirname(os.path.realpath(__file__)), "orange.png"
-                    )
-                    if not os.path.isfile(orange_file):
-                        orange_file = os.path.join(colors_temp_dir, "orange.png")
-                        generate_orange_png(orange_file)
-                white_file = None
-                if options.white or options.startwhite or options.endwhite:
-                    white_file = os.path.join(
-                        os.path.dirname(os.path.realpath(__file__)), "white.png"
-                    )
-                    if not os.path.isfile(white_file):
-                        white_file = os.path.join(colors_temp_dir, "white.png")
-                        generate_white_png(white_file)
-                gray_file = None
-                if options.gray:
-                    gray_file = os.path.join(
-                        os.path.dirname(os.path.realpath(__file__)), "gray.png"
-                    )
-                    if not os.path.isfile(gray_file):
-                        gray_file = os.path.join(colors_temp_dir, "gray.png")
-                        generate_gray_png(gray_file)
-                video_to_frames(
-                    options.video,
-                    directory,
-                    options.force,
-                    orange_file,
-                    white_file,
-                    gray_file,
-                    options.multiple,
-                    options.viewport,
-                    options.viewporttime,
-                    options.full,
-                    options.timeline,
-                    options.trimend,
+        frames = None
+        if options.video:
+            orange_file = None
+            if options.orange:
+                orange_file = os.path.join(
+                    os.path.dirname(os.path.realpath(__file__)), "orange.png"
                 )
-            if not options.multiple:
-                if options.render is not None:
-                    render_video(directory, options.render)
-
-                # Calculate the histograms and visual metrics
-                calculate_histograms(directory, histogram_file, options.force)
-                metrics = calculate_visual_metrics(
-                    histogram_file,
-                    options.start,
-                    options.end,
-                    options.perceptual,
-                    options.contentful,
-                    directory,
-                    options.progress,
-                    options.herodata,
+                if not os.path.isfile(orange_file):
+                    orange_file = os.path.join(colors_temp_dir, "orange.png")
+                    generate_orange_png(orange_file)
+            white_file = None
+            if options.white or options.startwhite or options.endwhite:
+                white_file = os.path.join(
+                    os.path.dirname(os.path.realpath(__file__)), "white.png"
                 )
+                if not os.path.isfile(white_file):
+                    white_file = os.path.join(colors_temp_dir, "white.png")
+                    generate_white_png(white_file)
+            gray_file = None
+            if options.gray:
+                gray_file = os.path.join(
+                    os.path.dirname(os.path.realpath(__file__)), "gray.png"
+                )
+                if not os.path.isfile(gray_file):
+                    gray_file = os.path.join(colors_temp_dir, "gray.png")
+                    generate_gray_png(gray_file)
+            frames = video_to_frames(
+                options.video,
+                directory,
+                options.force,
+                orange_file,
+                white_file,
+                gray_file,
+                options.multiple,
+                options.viewport,
+                options.viewporttime,
+                options.full,
+                options.timeline,
+                options.trimend,
+            )
+        if frames is None and options.dir is not None and not options.multiple:
+            # The frames in --dir are current (or there is no video), every stage
+            # works from the same store of them
+            frames = FrameStore.load(
+                os.path.realpath(options.dir), "ms_", get_frame_memory()
+            )
+        if not options.multiple:
+            if options.render is not None:
+                render_video(directory, options.render, frames)
+
+            # Calculate the histograms and visual metrics
+            calculate_histograms(directory, histogram_file, options.force, frames)
+            metrics = calculate_visual_metrics(
+                histogram_file,
+                options.start,
+                options.end,
+                options.perceptual,
+                options.contentful,
+                directory,
+                options.progress,
+                options.herodata,
+                frames,
+            )
+
+            if options.screenshot is not None:
+                quality = 30
+                if options.quality is not None:
+                    quality = options.quality
+                save_screenshot(directory, options.screenshot, quality, frames)
+            # JPEG conversion
+            if options.dir is not None and options.quality is not None:
+                convert_to_jpeg(directory, options.quality, frames)
+
+    finally:
+        close_worker_pool()
+        shutil.rmtree(temp_dir, True)
+        shutil.rmtree(colors_temp_dir, True)
+        if color_cache is not None:
+            logging.debug(
+                "Colour classification cache: %d hits, %d misses, %d entries",
+                color_cache.hits,
+                color_cache.misses,
+                len(color_cache),
+            )
+    return metrics
 
-                if options.screenshot is not None:
-                    quality = 30
-                    if options.quality is not None:
-                        quality = options.quality
-                    save_screenshot(directory, options.screenshot, quality)
-                # JPEG conversion
-                if options.dir is not None and options.quality is not None:
-                    convert_to_jpeg(directory, options.quality)
 
+def get_json_metrics(metrics):
+    """The metrics keyed the way --json prints them"""
+    data = dict()
+    for metric in metrics:
+        data[metric["name"].replace(" ", "")] = metric["value"]
+    if videoRecordingStart is not None:
+        data["videoRecordingStart"] = videoRecordingStart
+    return data
+
+
+class Analyzer(object):
+    """Library entry point that keeps its own configuration and state.
+
+    The settings are the command line options by name (dest), for example:
+
+        analyzer = Analyzer(orange=True, perceptual=True, viewport=True)
+        metrics = analyzer.analyze("video.mp4", dir="frames", renderignore=5)
+
+    analyze() returns the metrics the way --json prints them (None if the
+    video could not be analyzed). One analyzer can process any number of
+    videos and analyzers can be used from several threads. The processing
+    stages still share the module globals, so analyses run one at a time and
+    each one gets a clean set of globals.
+    """
+
+    lock = threading.RLock()
+
+    def __init__(self, settings=None, **kwargs):
+        if settings is None:
+            settings = get_parser().parse_args([])
+        self.options = copy.copy(settings)
+        self.configure(self.options, kwargs)
+        self.image_magick = dict(image_magick)
+        self.compare_engine = "imagemagick" if self.options.imagemagick else None
+
+    def configure(self, settings, values):
+        for name, value in values.items():
+            if not hasattr(settings, name):
+                raise ValueError("Unknown visualmetrics option: " + name)
+            setattr(settings, name, value)
+
+    def analyze(self, video=None, **kwargs):
+        global options
+        global client_viewport
+        global image_magick
+        global compare_engine
+        global videoRecordingStart
+        global manifest
+
+        settings = copy.copy(self.options)
+        if video is not None:
+            settings.video = video
+        self.configure(settings, kwargs)
+        with Analyzer.lock:
+            saved = (
+                options,
+                client_viewport,
+                image_magick,
+                compare_engine,
+                videoRecordingStart,
+                manifest,
+            )
+            options = settings
+            client_viewport = None
+            image_magick = self.image_magick
+            compare_engine = self.compare_engine
+            videoRecordingStart = None
+            manifest = None
+            try:
+                metrics = run_analysis()
                 if metrics is not None:
-                    ok = True
-                    if options.json:
-                        data = dict()
-                        for metric in metrics:
-                            data[metric["name"].replace(" ", "")] = metric["value"]
-                        if "videoRecordingStart" in globals():
-                            data["videoRecordingStart"] = videoRecordingStart
-                        print(json.dumps(data))
-                    else:
-                        for metric in metrics:
-                            print("{0}: {1}".format(metric["name"], metric["value"]))
+                    return get_json_metrics(metrics)
+                return None
+            finally:
+                # Keep the engine that was detected for the next analysis
+                self.compare_engine = compare_engine
+                (
+                    options,
+                    client_viewport,
+                    image_magick,
+                    compare_engine,
+                    videoRecordingStart,
+                    manifest,
+                ) = saved
+
+
+def run_worker(analyzer, input_stream, output_stream):
+    """Analyze the newline-delimited JSON jobs of input_stream.
+
+    Every job is {"id": ..., "video": ..., "options": {...}} and gets one line
+    of output: {"id": ..., "metrics": {...}} or {"id": ..., "error": ...}.
+    A failed job does not stop the worker."""
+    for line in iter(input_stream.readline, ""):
+        line = line.strip()
+        if not line:
+            continue
+        result = {}
+        try:
+            job = json.loads(line)
+            result["id"] = job.get("id")
+            metrics = analyzer.analyze(job.get("video"), **job.get("options", {}))
+            if metrics is not None:
+                result["metrics"] = metrics
+            else:
+                result["error"] = "No metrics could be calculated"
+        except Exception as e:
+            logging.exception("Error processing job " + line)
+            result["error"] = str(e)
+        output_stream.write(json.dumps(result) + "\n")
+        output_stream.flush()
+
+
+BATCH_PATHS = [
+    "dir",
+    "histogram",
+    "progress",
+    "render",
+    "screenshot",
+    "herodata",
+    "timeline",
+    "output",
+]
+
+
+def get_batch_path_error(settings):
+    """Error message for --batch paths that every video would share (or None)"""
+    if len(settings.batch) > 1 or glob.has_magic(settings.batch[0]):
+        for name in BATCH_PATHS:
+            value = getattr(settings, name)
+            # {dir} alone is the same for all of the videos in a directory
+            if value is not None and not re.search(r"\{(name|index)[:!}]", value):
+                return "--{0} needs a {{name}} or {{index}} field in --batch mode".format(
+                    name
+                )
+    return None
+
+
+def get_batch_jobs(settings):
+    """One (video, options) job per video matched by the --batch patterns"""
+    videos = []
+    for pattern in settings.batch:
+        matches = sorted(glob.glob(pattern))
+        if not matches:
+            # Keep it so that the missing video is reported
+            matches = [pattern]
+        for video in matches:
+            if video not in videos:
+                videos.append(video)
+    jobs = []
+    for index, video in enumerate(videos):
+        fields = {
+            "name": os.path.splitext(os.path.basename(video))[0],
+            "dir": os.path.dirname(os.path.abspath(video)),
+            "index": index,
+        }
+        job = copy.copy(settings)
+        job.video = video
+        job.batch = None
+        # The videos are processed in parallel, not their frames
+        job.workers = 1
+        for name in BATCH_PATHS:
+            value = getattr(job, name)
+            if value is not None:
+                setattr(job, name, value.format(**fields))
+        jobs.append(job)
+    return jobs
+
+
+def run_batch_job(job):
+    """Analyze one video of a batch (in a pool process) and save its metrics"""
+    result = {"video": job.video, "output": job.output}
+    try:
+        metrics = Analyzer(job).analyze()
+        if metrics is not None:
+            with open(job.output, "w") as f:
+                f.write(json.dumps(metrics))
+        else:
+            result["error"] = "No metrics could be calculated"
+    except Exception as e:
+        logging.exception("Error processing " + job.video)
+        result["error"] = str(e)
+    return result
+
+
+def run_batch(jobs, output_stream):
+    """Analyze the batch jobs on a bounded pool of processes.
+
+    Each process runs the whole pipeline of one video at a time, so the
+    ffmpeg-bound extraction of some videos overlaps with the analysis of
+    others. A failing video only fails its own job. One JSON line per video
+    is written to output_stream, in the order of the jobs. Returns True when
+    every video was analyzed."""
+    ok = True
+    workers = min(get_workers(), len(jobs))
+    if workers > 1:
+        pool = multiprocessing.Pool(workers)
+        results = pool.imap(run_batch_job, jobs)
+    else:
+        pool = None
+        results = (run_batch_job(job) for job in jobs)
+    try:
+        for result in results:
+            if "error" in result:
+                ok = False
+            output_stream.write(json.dumps(result) + "\n")
+            output_stream.flush()
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return ok
+
+
+def main():
+    global options
+    global compare_engine
+
+    parser = get_parser()
+    options = parser.parse_args()
+
+    if options.batch:
+        if options.video or options.worker:
+            parser.error("--batch can not be combined with --video or --worker")
+        error = get_batch_path_error(options)
+        if error is not None:
+            parser.error(error)
+
+    if (
+        not options.check
+        and not options.worker
+        and not options.batch
+        and not options.dir
+        and not options.video
+        and not options.histogram
+    ):
+        parser.error(
+            "A video, Directory of images or histograms file needs to be provided.\n\n"
+            "Use -h to see available options"
+        )
+
+    if options.perceptual or options.contentful:
+        if not options.video and not options.worker and not options.batch:
+            parser.error(
+                "A video file needs to be provided.\n\n"
+                "Use -h to see available options"
+            )
+
+    configure_logging(options)
+
+    if options.imagemagick:
+        compare_engine = "imagemagick"
+
+    find_image_magick()
+
+    ok = False
+    try:
+        if options.worker:
+            import sys
+
+            run_worker(Analyzer(options), sys.stdin, sys.stdout)
+            ok = True
+        elif options.batch:
+            import sys
+
+            ok = run_batch(get_batch_jobs(options), sys.stdout)
+        elif not options.check:
+            metrics = run_analysis()
+            if metrics is not None:
+                ok = True
+                if options.json:
+                    print(json.dumps(get_json_metrics(metrics)))
+                else:
+                    for metric in metrics:
+                        print("{0}: {1}".format(metric["name"], metric["value"]))
         else:
             ok = check_config()
     except Exception as e:
         logging.exception(e)
         ok = False
 
-    # Clean up
-    shutil.rmtree(temp_dir)
     if ok:
         exit(0)
     else:
@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+"""
+SOCKS5 handshake flood for tsproxy.py.
+
+Run from the repository root (Python 3):
+
+    python tools/benchmark_tsproxy.py -n 5000 classic pipelined
+
+Every connection does the SOCKS5 greeting and CONNECT request through the
+proxy to a local listener and waits for the reply, with a fixed number of
+connections in flight. classic waits for the greeting reply before sending the
+CONNECT request, pipelined sends both in one write and split sends them a byte
+at a time.
+"""
+import argparse
+import os
+import re
+import selectors
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+
+TSPROXY = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "vendor", "tsproxy.py"
+)
+
+GREETING = b"\x05\x01\x00"
+
+
+def start_sink():
+    """A local server that accepts the proxied connections and closes them"""
+    sink = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sink.bind(("127.0.0.1", 0))
+    sink.listen(socket.SOMAXCONN)
+
+    def accept():
+        while True:
+            connection, address = sink.accept()
+            connection.close()
+
+    thread = threading.Thread(target=accept)
+    thread.daemon = True
+    thread.start()
+    return sink.getsockname()
+
+
+def start_proxy(path):
+    proxy = subprocess.Popen(
+        [sys.executable, path, "-p", "0"],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+    )
+    match = re.search(r"on ([^:]+):(\d+)", proxy.stdout.readline())
+    if match is None:
+        proxy.kill()
+        raise RuntimeError("tsproxy did not start")
+    return proxy, (match.group(1), int(match.group(2)))
+
+
+def stop_proxy(proxy):
+    proxy.send_signal(signal.SIGINT)
+    try:
+        proxy.wait(5)
+    except subprocess.TimeoutExpired:
+        proxy.kill()
+
+
+def cpu_time(pid):
+    """User and system CPU seconds used by a process (Linux only)"""
+    try:
+        with open("/proc/{0:d}/stat".format(pid)) as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+    except IOError:
+        return None
+    return (int(fields[11]) + int(fields[12])) / float(os.sysconf("SC_CLK_TCK"))
+
+
+class Handshake(object):
+    """One client connection working through the handshake"""
+
+    def __init__(self, proxy_address, request, mode):
+        self.mode = mode
+        self.started = time.time()
+        self.received = b""
+        self.socket = socket.create_connection(proxy_address)
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if mode == "classic":
+            self.pending = [(GREETING, 2), (request, 10)]
+        else:
+            self.pending = [(GREETING + request, 12)]
+        self.send_next()
+
+    def send_next(self):
+        data, self.expected = self.pending.pop(0)
+        if self.mode == "split":
+            for i in range(len(data)):
+                end = i + 1
+                self.socket.sendall(data[i:end])
+        else:
+            self.socket.sendall(data)
+
+    def on_readable(self):
+        """Returns the handshake latency once the CONNECT reply arrived"""
+        data = self.socket.recv(4096)
+        if not data:
+            raise RuntimeError("Proxy closed the connection during the handshake")
+        self.received += data
+        if len(self.received) < self.expected:
+            return None
+        reply = self.received[-10:] if self.expected > 2 else self.received
+        if self.received[0:2] != b"\x05\x00" or reply[0:2] != b"\x05\x00":
+            raise RuntimeError("Handshake failed: {0!r}".format(self.received))
+        self.received = b""
+        if self.pending:
+            self.send_next()
+            return None
+        return time.time() - self.started
+
+
+def flood(proxy_address, target, mode, count, concurrency):
+    request = b"\x05\x01\x00\x01" + socket.inet_aton(target[0])
+    request += struct.pack(">H", target[1])
+    selector = selectors.DefaultSelector()
+    latencies = []
+    started = 0
+
+    def open_connection():
+        handshake = Handshake(proxy_address, request, mode)
+        selector.register(handshake.socket, selectors.EVENT_READ, handshake)
+
+    start = time.time()
+    while started < min(concurrency, count):
+        open_connection()
+        started += 1
+    while len(latencies) < count:
+        ready = selector.select(10)
+        if not ready:
+            raise RuntimeError(
+                "Handshakes stalled after {0:d} connections".format(len(latencies))
+            )
+        for key, events in ready:
+            latency = key.data.on_readable()
+            if latency is not None:
+                latencies.append(latency)
+                selector.unregister(key.fileobj)
+                key.fileobj.close()
+                if started < count:
+                    open_connection()
+                    started += 1
+    elapsed = time.time() - start
+    selector.close()
+    latencies.sort()
+    return elapsed, latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark tsproxy SOCKS5 handshakes under a flood of connections."
+    )
+    parser.add_argument(
+        "modes",
+        nargs="*",
+        help="Handshake modes: classic, pipelined, split (defaults to all of them).",
+    )
+    parser.add_argument(
+        "-n", "--connections", type=int, default=2000, help="Connections per mode."
+    )
+    parser.add_argument(
+        "-c", "--concurrency", type=int, default=100, help="Connections in flight."
+    )
+    parser.add_argument("--proxy", default=TSPROXY, help="The tsproxy.py to benchmark.")
+    options = parser.parse_args()
+    modes = options.modes or ["classic", "pipelined", "split"]
+    for mode in modes:
+        if mode not in ["classic", "pipelined", "split"]:
+            parser.error("Unknown mode " + mode)
+
+    target = start_sink()
+    for mode in modes:
+        proxy, proxy_address = start_proxy(options.proxy)
+        try:
+            cpu_start = cpu_time(proxy.pid)
+            elapsed, latencies = flood(
+                proxy_address, target, mode, options.connections, options.concurrency,
+            )
+            cpu_end = cpu_time(proxy.pid)
+        finally:
+            stop_proxy(proxy)
+        cpu = ""
+        if cpu_start is not None and cpu_end is not None:
+            cpu = ", proxy CPU {0:.2f}ms per handshake".format(
+                (cpu_end - cpu_start) * 1000.0 / len(latencies)
+            )
+        print(
+            "{0}: {1:d} handshakes in {2:.2f}s ({3:.0f}/s), latency median "
+            "{4:.1f}ms p95 {5:.1f}ms{6}".format(
+                mode,
+                len(latencies),
+                elapsed,
+                len(latencies) / elapsed,
+                latencies[len(latencies) // 2] * 1000.0,
+                latencies[int(len(latencies) * 0.95)] * 1000.0,
+                cpu,
+            )
+        )
+
+
+if "__main__" == __name__:
+    main()
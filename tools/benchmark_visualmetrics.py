@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+"""
+Micro-benchmarks for the hot paths of visualmetrics.py.
+
+Run from the repository root:
+
+    python tools/benchmark_visualmetrics.py histogram timeline
+
+Every benchmark checks that the compared implementations return the same
+result before it reports their timings.
+"""
+import argparse
+import gzip
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from browsertime import visualmetrics  # noqa: E402
+
+RESOLUTIONS = {"thumbnail": (400, 225), "full": (1920, 1080)}
+
+
+def synthetic_frame(width, height, seed=0):
+    """A page-like frame: white background, flat blocks and a noisy image"""
+    import numpy as np
+
+    rng = np.random.RandomState(seed)
+    pixels = np.full((height, width, 3), 255, dtype=np.uint8)
+    for i in range(20):
+        x = rng.randint(0, width - width // 8)
+        y = rng.randint(0, height - height // 8)
+        right = x + width // 8
+        bottom = y + height // 8
+        pixels[y:bottom, x:right] = rng.randint(0, 256, 3)
+    top = height // 2
+    left = width // 3
+    pixels[top:, left:] = rng.randint(0, 256, pixels[top:, left:].shape)
+    return pixels
+
+
+def best_time(function, repeat):
+    best = None
+    result = None
+    for i in range(repeat):
+        start = time.time()
+        result = function()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+
+def benchmark_histogram(repeat):
+    for name in ["thumbnail", "full"]:
+        width, height = RESOLUTIONS[name]
+        store = visualmetrics.FrameStore(None, "ms_")
+        frame = store.add(0, pixels=synthetic_frame(width, height))
+        getcolors, expected = best_time(
+            lambda: visualmetrics.calculate_image_histogram_getcolors(frame), repeat
+        )
+        vectorized, actual = best_time(
+            lambda: visualmetrics.calculate_image_histogram(frame), repeat
+        )
+        if actual != expected:
+            raise AssertionError("Histograms differ at {0} resolution".format(name))
+        print(
+            "histogram {0} ({1}x{2}): getcolors {3:.1f}ms, vectorized {4:.1f}ms "
+            "({5:.1f}x)".format(
+                name,
+                width,
+                height,
+                getcolors * 1000,
+                vectorized * 1000,
+                getcolors / vectorized,
+            )
+        )
+
+
+def synthetic_trace(path, events, navigate_at):
+    """A gzipped Chrome trace with the first navigation after a fraction of the
+    events (never when navigate_at is None)"""
+    navigate = None if navigate_at is None else int(events * navigate_at)
+    event = (
+        '{{"pid": 1, "tid": 7, "ts": {0:d}, "ph": "X", "cat": '
+        '"disabled-by-default-devtools.timeline", "name": "{1}", "dur": 5, '
+        '"args": {{"data": {{"frame": "0x1f2e3d", "url": "https://example.com/"}}}}}}'
+    )
+    lines = []
+    for i in range(events):
+        name = "Paint" if i % 50 == 0 else "FunctionCall"
+        if i == navigate:
+            name = "ResourceSendRequest"
+        lines.append(event.format(1000 + i * 10, name))
+    trace = '{"metadata": {"source": "synthetic"}, "traceEvents": [\n'
+    trace += ",\n".join(lines) + "\n]}\n"
+    with gzip.open(path, "wb") as f:
+        f.write(trace.encode("utf-8"))
+
+
+def load_timeline_offset(timeline_file):
+    """get_timeline_offset with the whole trace loaded by json.load"""
+    with gzip.open(timeline_file, "rb") as f:
+        timeline = json.loads(f.read().decode("utf-8"))
+    last_paint = None
+    first_navigate = None
+    for timeline_event in timeline["traceEvents"]:
+        paint_time = visualmetrics.get_timeline_event_paint_time(timeline_event)
+        if paint_time is not None:
+            last_paint = paint_time
+        first_navigate = visualmetrics.get_timeline_event_navigate_time(timeline_event)
+        if first_navigate is not None:
+            break
+    if last_paint is not None and first_navigate is not None:
+        if first_navigate > last_paint:
+            return int(round(first_navigate - last_paint))
+    return 0
+
+
+def peak_memory(function):
+    """Peak of the Python allocations while running function (in MB)"""
+    try:
+        import tracemalloc
+    except ImportError:
+        return None
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1] / (1024.0 * 1024.0)
+    finally:
+        tracemalloc.stop()
+
+
+def benchmark_timeline(repeat, events=300000):
+    directory = tempfile.mkdtemp()
+    try:
+        for name, navigate_at in [("early navigation", 0.02), ("no navigation", None)]:
+            path = os.path.join(directory, "trace.json.gz")
+            synthetic_trace(path, events, navigate_at)
+            loaded, expected = best_time(lambda: load_timeline_offset(path), repeat)
+            streamed, actual = best_time(
+                lambda: visualmetrics.get_timeline_offset(path), repeat
+            )
+            if actual != expected:
+                raise AssertionError("Timeline offsets differ for " + name)
+            loaded_memory = peak_memory(lambda: load_timeline_offset(path))
+            streamed_memory = peak_memory(
+                lambda: visualmetrics.get_timeline_offset(path)
+            )
+            memory = ""
+            if loaded_memory is not None:
+                memory = ", peak {0:.0f}MB / {1:.0f}MB".format(
+                    loaded_memory, streamed_memory
+                )
+            print(
+                "timeline {0} ({1:d} events, {2:.1f}MB gzipped): json.load "
+                "{3:.0f}ms, streamed {4:.0f}ms ({5:.1f}x){6}".format(
+                    name,
+                    events,
+                    os.path.getsize(path) / (1024.0 * 1024.0),
+                    loaded * 1000,
+                    streamed * 1000,
+                    loaded / streamed,
+                    memory,
+                )
+            )
+    finally:
+        shutil.rmtree(directory)
+
+
+BENCHMARKS = {"histogram": benchmark_histogram, "timeline": benchmark_timeline}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the visualmetrics.py hot paths."
+    )
+    parser.add_argument(
+        "benchmarks",
+        nargs="*",
+        help="Benchmarks to run: {0} (defaults to all of them).".format(
+            ", ".join(sorted(BENCHMARKS.keys()))
+        ),
+    )
+    parser.add_argument(
+        "-r", "--repeat", type=int, default=5, help="Best of how many runs."
+    )
+    options = parser.parse_args()
+    for name in options.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error("Unknown benchmark " + name)
+    for name in options.benchmarks or sorted(BENCHMARKS.keys()):
+        BENCHMARKS[name](options.repeat)
+
+
+if "__main__" == __name__:
+    main()
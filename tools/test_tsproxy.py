@@ -0,0 +1,633 @@
+import os
+import select
+import socket
+import struct
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "vendor")
+)
+import tsproxy  # noqa: E402
+
+PACKET = tsproxy.PACKET_SIZE
+
+
+def as_bytes(data):
+    """The contents of a bytearray or memoryview, bytes() of a view is its repr on Python 2"""
+    return bytes(bytearray(data))
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class Peer(object):
+    """Records the messages a pipe delivers to a connection"""
+
+    def __init__(self, connection_id, delivered):
+        self.connection_id = connection_id
+        self.delivered = delivered
+
+    def handle_message(self, message):
+        self.delivered.append(
+            (self.connection_id, len(message["data"]), message["time"])
+        )
+
+    def UpdateWriter(self):
+        pass
+
+
+class TsproxyTestCase(unittest.TestCase):
+    """Runs tsproxy's module state on a fake clock with recording peers"""
+
+    def setUp(self):
+        self.saved = (tsproxy.current_time, tsproxy.connections, tsproxy.event_loop)
+        self.clock = FakeClock()
+        tsproxy.current_time = self.clock
+        tsproxy.connections = {}
+        tsproxy.event_loop = None
+        self.delivered = []
+
+    def tearDown(self):
+        tsproxy.current_time, tsproxy.connections, tsproxy.event_loop = self.saved
+
+    def add_connection(self, connection_id):
+        tsproxy.connections[connection_id] = {
+            "client": Peer(connection_id, self.delivered)
+        }
+
+    def send(self, pipe, connection_id, size):
+        pipe.SendMessage(
+            {"message": "data", "connection": connection_id, "data": b"x" * size}
+        )
+
+
+class Pipe(object):
+    """Records the messages sent through a pipe"""
+
+    def __init__(self):
+        self.messages = []
+
+    def SendMessage(self, message, main_thread=True):
+        self.messages.append(message)
+
+
+class TestSocks5Handshake(TsproxyTestCase):
+    """Feeds handshakes to a Socks5Connection over a local TCP connection"""
+
+    GREETING = b"\x05\x01\x00"
+    IPV4 = b"\x01" + socket.inet_aton("127.0.0.1") + struct.pack(">H", 8080)
+
+    def setUp(self):
+        TsproxyTestCase.setUp(self)
+        self.saved_pipe = (tsproxy.out_pipe, tsproxy.dns_cache)
+        tsproxy.out_pipe = Pipe()
+        tsproxy.dns_cache = {}
+        if tsproxy.asyncio is not None:
+            tsproxy.event_loop = tsproxy.asyncio.SelectorEventLoop()
+        # The connection sets TCP options so it needs a TCP socket, not a socketpair()
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(1)
+        self.client = socket.create_connection(listener.getsockname())
+        self.client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        server = listener.accept()[0]
+        listener.close()
+        self.client.settimeout(5)
+        self.connection = tsproxy.Socks5Connection(server, 1)
+        tsproxy.connections[1] = {"client": self.connection}
+
+    def tearDown(self):
+        self.connection.close()
+        self.client.close()
+        if tsproxy.event_loop is not None:
+            tsproxy.event_loop.close()
+        tsproxy.out_pipe, tsproxy.dns_cache = self.saved_pipe
+        TsproxyTestCase.tearDown(self)
+
+    def write(self, data):
+        self.client.sendall(data)
+        select.select([self.connection.socket], [], [], 5)
+        self.connection.handle_read()
+
+    def read(self, size):
+        data = b""
+        while len(data) < size:
+            chunk = self.client.recv(size - len(data))
+            if not chunk:
+                break
+            data += chunk
+        return data
+
+    def messages(self):
+        return [message["message"] for message in tsproxy.out_pipe.messages]
+
+    def assertClosed(self):
+        self.assertEqual(self.connection.state, self.connection.STATE_ERROR)
+        self.assertEqual(self.client.recv(100), b"")
+
+    def test_classic(self):
+        self.write(self.GREETING)
+        self.assertEqual(self.read(2), b"\x05\x00")
+        self.write(b"\x05\x01\x00" + self.IPV4)
+        self.assertEqual(self.connection.state, self.connection.STATE_CONNECTING)
+        self.assertEqual(self.connection.ip, "127.0.0.1")
+        self.assertEqual(self.connection.port, 8080)
+        self.assertEqual(self.messages(), ["connect"])
+        self.assertEqual(tsproxy.out_pipe.messages[0]["port"], 8080)
+
+    def test_split(self):
+        for byte in bytearray(self.GREETING + b"\x05\x01\x00" + self.IPV4):
+            self.assertEqual(self.messages(), [])
+            self.write(bytes(bytearray([byte])))
+        self.assertEqual(self.read(2), b"\x05\x00")
+        self.assertEqual(self.connection.ip, "127.0.0.1")
+        self.assertEqual(self.connection.port, 8080)
+        self.assertEqual(self.messages(), ["connect"])
+
+    def test_pipelined_with_early_data(self):
+        self.write(self.GREETING + b"\x05\x01\x00" + self.IPV4 + b"GET / HTTP/1.1")
+        self.assertEqual(self.read(2), b"\x05\x00")
+        self.assertEqual(self.messages(), ["connect"])
+        self.write(b"\r\n")
+        # The data that arrived with the request is held until the connection is made
+        self.assertEqual(self.messages(), ["connect"])
+        self.connection.handle_message({"message": "connected", "success": True})
+        self.assertEqual(self.read(10), b"\x05\x00\x00" + self.IPV4)
+        self.assertEqual(self.messages(), ["connect", "data"])
+        self.assertEqual(tsproxy.out_pipe.messages[1]["data"], b"GET / HTTP/1.1\r\n")
+        self.assertIsNone(self.connection.handshake)
+        # After that the data is passed straight through
+        self.write(b"Host: example")
+        self.assertEqual(tsproxy.out_pipe.messages[2]["data"], b"Host: example")
+
+    def test_domain(self):
+        self.write(self.GREETING)
+        self.write(b"\x05\x01\x00\x03\x0bexample.com\x01\xbb")
+        self.assertEqual(self.connection.state, self.connection.STATE_RESOLVING)
+        self.assertEqual(self.messages(), ["resolve"])
+        message = tsproxy.out_pipe.messages[0]
+        self.assertEqual((message["hostname"], message["port"]), ("example.com", 443))
+
+    def test_domain_cached(self):
+        addresses = [("cached",)]
+        tsproxy.dns_cache["example.com"] = {
+            "addresses": addresses,
+            "localhost": False,
+            "expires": 10.0,
+        }
+        self.write(self.GREETING + b"\x05\x01\x00\x03\x0bexample.com\x01\xbb")
+        self.assertEqual(self.messages(), ["connect"])
+        self.assertEqual(tsproxy.out_pipe.messages[0]["addresses"], addresses)
+
+    def test_domain_cache_expired(self):
+        tsproxy.dns_cache["example.com"] = {
+            "addresses": [("cached",)],
+            "localhost": False,
+            "expires": 10.0,
+        }
+        self.clock.now = 10.0
+        self.write(self.GREETING + b"\x05\x01\x00\x03\x0bexample.com\x01\xbb")
+        self.assertEqual(self.messages(), ["resolve"])
+        self.assertNotIn("example.com", tsproxy.dns_cache)
+
+    def test_domain_cache_expires_with_resolver(self):
+        saved_resolver = tsproxy.resolver
+        tsproxy.resolver = tsproxy.DNSResolver(5)
+        try:
+            self.write(self.GREETING + b"\x05\x01\x00\x03\x0bexample.com\x01\xbb")
+            self.clock.now = 1.0
+            addresses = [("resolved",)]
+            self.connection.handle_message(
+                {"message": "resolved", "addresses": addresses, "localhost": False}
+            )
+        finally:
+            tsproxy.resolver = saved_resolver
+        self.assertEqual(self.messages(), ["resolve", "connect"])
+        self.assertEqual(
+            tsproxy.dns_cache["example.com"],
+            {"addresses": addresses, "localhost": False, "expires": 6.0},
+        )
+
+    def test_ipv6(self):
+        address = b"\x00" * 15 + b"\x01"
+        self.write(self.GREETING + b"\x05\x01\x00\x04" + address + b"\x00\x50")
+        self.assertEqual(self.connection.ip, "0000:0000:0000:0000:0000:0000:0000:0001")
+        self.assertEqual(self.connection.port, 80)
+        self.assertEqual(
+            self.connection.requested_address, b"\x04" + address + b"\x00\x50"
+        )
+        self.assertEqual(self.messages(), ["connect"])
+
+    def test_unsupported_version(self):
+        self.write(b"\x04\x01\x00\x50")
+        self.assertClosed()
+        self.assertEqual(self.messages(), [])
+
+    def test_unsupported_authentication(self):
+        self.write(b"\x05\x01\x02")
+        self.assertEqual(self.read(2), b"\x05\xff")
+        self.assertClosed()
+
+    def test_unsupported_command(self):
+        # BIND
+        self.write(self.GREETING + b"\x05\x02\x00" + self.IPV4)
+        self.assertEqual(self.read(12), b"\x05\x00" + b"\x05\x07\x00" + self.IPV4)
+        self.assertClosed()
+        self.assertEqual(self.messages(), [])
+
+    def test_unsupported_address_type(self):
+        self.write(self.GREETING + b"\x05\x01\x00\x05\x00")
+        self.assertEqual(
+            self.read(12), b"\x05\x00" + b"\x05\x08\x00" + b"\x01" + b"\x00" * 6
+        )
+        self.assertClosed()
+
+    def test_invalid_port(self):
+        self.write(self.GREETING + b"\x05\x01\x00\x01\x7f\x00\x00\x01\x00\x00")
+        self.assertEqual(
+            self.read(12), b"\x05\x00\x05\x01\x00\x01\x7f\x00\x00\x01\x00\x00"
+        )
+        self.assertClosed()
+
+
+class TestFairShaper(TsproxyTestCase):
+    def make_pipe(self, kbps=PACKET * 8 / 1000.0, latency=0):
+        # The default of one packet per second makes every tick release at most one packet
+        return tsproxy.TSPipe(
+            tsproxy.TSPipe.PIPE_IN, latency, kbps, tsproxy.TSPipe.SHAPER_FAIR
+        )
+
+    def test_round_robin(self):
+        pipe = self.make_pipe()
+        self.add_connection(1)
+        self.add_connection(2)
+        self.send(pipe, 1, 3 * PACKET)
+        self.send(pipe, 2, PACKET)
+        self.assertEqual(pipe.tick(), 1.0)
+        # The messages moved from the shared queue into the flows
+        self.assertTrue(pipe.queue.empty())
+        self.assertTrue(pipe.HasQueuedMessages())
+        self.assertEqual(sorted(pipe.flows), [1, 2])
+        for second in range(1, 5):
+            self.clock.now = float(second)
+            pipe.tick()
+        # Connection 2 gets its packet after the first one of connection 1 instead of after all three
+        self.assertEqual(
+            [connection for connection, size, sent in self.delivered], [1, 2, 1, 1]
+        )
+        self.assertTrue(
+            all(size == PACKET for connection, size, sent in self.delivered)
+        )
+        self.assertEqual(pipe.flows, {})
+        self.assertFalse(pipe.HasQueuedMessages())
+
+    def test_deficit(self):
+        pipe = self.make_pipe()
+        self.add_connection(1)
+        self.add_connection(2)
+        # Connection 1 sends small messages, several of them fit in its quantum
+        for i in range(4):
+            self.send(pipe, 1, PACKET // 4)
+        self.send(pipe, 2, PACKET)
+        pipe.tick()
+        self.clock.now = 1.0
+        pipe.tick()
+        self.assertEqual(self.delivered, [(1, PACKET // 4, 0.0)] * 4)
+        self.assertEqual(pipe.flows[2].deficit, PACKET)
+        self.assertEqual(pipe.available_bytes, 0)
+        self.clock.now = 2.0
+        pipe.tick()
+        self.assertEqual(self.delivered[-1], (2, PACKET, 0.0))
+        self.assertEqual(pipe.flows, {})
+
+    def test_bandwidth_carry_over(self):
+        pipe = self.make_pipe()
+        self.add_connection(1)
+        self.send(pipe, 1, PACKET)
+        self.assertEqual(pipe.tick(), 1.0)
+        # Half a packet accumulated, it is kept for the next tick
+        self.clock.now = 0.5
+        self.assertEqual(pipe.tick(), 0.5)
+        self.assertEqual(pipe.available_bytes, PACKET / 2.0)
+        self.assertEqual(self.delivered, [])
+        self.clock.now = 1.0
+        self.assertIsNone(pipe.tick())
+        self.assertEqual(self.delivered, [(1, PACKET, 0.0)])
+        # Nothing accumulates while the pipe is idle
+        self.assertEqual(pipe.available_bytes, 0)
+        self.clock.now = 10.0
+        self.send(pipe, 1, PACKET)
+        self.assertEqual(pipe.tick(), 1.0)
+
+    def test_ordering(self):
+        pipe = self.make_pipe(kbps=10000000, latency=1.0)
+        self.add_connection(1)
+        self.add_connection(2)
+        self.send(pipe, 1, 100)
+        self.assertEqual(pipe.tick(), 1.0)
+        # Lowering the latency doesn't let a later message overtake the one in flight
+        pipe.latency = 0
+        self.clock.now = 0.5
+        self.send(pipe, 1, 200)
+        self.send(pipe, 2, 300)
+        pipe.tick()
+        self.assertEqual(pipe.flows[1].queue[1]["time"], 1.0)
+        # The other connection isn't held up by it
+        self.clock.now = 0.6
+        pipe.tick()
+        self.assertEqual(self.delivered, [(2, 300, 0.5)])
+        # Bandwidth only accumulates once the messages arrive
+        self.clock.now = 1.0
+        self.assertEqual(pipe.tick(), 100 / (10000000 * 125.0))
+        self.clock.now = 1.001
+        self.assertIsNone(pipe.tick())
+        self.assertEqual(self.delivered[1:], [(1, 100, 1.0), (1, 200, 1.0)])
+
+
+class TestSendBuffer(unittest.TestCase):
+    def test_consume(self):
+        buffer = tsproxy.SendBuffer()
+        buffer.append(b"abcd")
+        buffer.append(b"")
+        buffer.append(b"efg")
+        buffer.append(bytearray(b"hij"))
+        self.assertEqual(len(buffer), 10)
+        self.assertEqual(len(buffer.chunks), 3)
+        # Part of the first chunk only moves the offset
+        buffer.consume(1)
+        self.assertEqual(as_bytes(buffer.peek()), b"bcdefghij")
+        self.assertEqual(buffer.offset, 1)
+        # Across the end of a chunk into the middle of the next one
+        buffer.consume(4)
+        self.assertEqual(len(buffer), 5)
+        self.assertEqual(len(buffer.chunks), 2)
+        self.assertEqual(buffer.offset, 1)
+        self.assertEqual(as_bytes(buffer.peek()), b"fghij")
+        # Exactly to the end of a chunk
+        buffer.consume(2)
+        self.assertEqual(len(buffer.chunks), 1)
+        self.assertEqual(buffer.offset, 0)
+        self.assertEqual(as_bytes(buffer.peek()), b"hij")
+        buffer.consume(3)
+        self.assertEqual(len(buffer), 0)
+        self.assertEqual(len(buffer.chunks), 0)
+
+    def test_peek_gathers_small_chunks(self):
+        size = tsproxy.SendBuffer.GATHER_SIZE
+        buffer = tsproxy.SendBuffer()
+        chunks = [bytes(bytearray([i])) * (size // 4) for i in range(6)]
+        for chunk in chunks:
+            buffer.append(chunk)
+        # Whole chunks are gathered until there is at least GATHER_SIZE
+        self.assertEqual(as_bytes(buffer.peek()), b"".join(chunks[0:4]))
+        buffer.consume(10)
+        data = buffer.peek()
+        self.assertEqual(len(data), size // 4 * 5 - 10)
+        self.assertEqual(as_bytes(data), b"".join(chunks[0:5])[10:])
+
+    def test_peek_large_chunk(self):
+        size = tsproxy.SendBuffer.GATHER_SIZE
+        buffer = tsproxy.SendBuffer()
+        large = bytearray(b"a" * (size + 10))
+        buffer.append(large)
+        buffer.append(b"small")
+        # A chunk that is big enough on its own is sent from a view, without copying
+        data = buffer.peek()
+        self.assertEqual(len(data), len(large))
+        large[0:1] = b"b"
+        self.assertEqual(as_bytes(data[0:2]), b"ba")
+        buffer.consume(len(large) - 2)
+        self.assertEqual(as_bytes(buffer.peek()), b"aasmall")
+
+
+class TestSplitMessage(unittest.TestCase):
+    def test_split(self):
+        pipe = tsproxy.TSPipe(tsproxy.TSPipe.PIPE_IN, 0, 0)
+        payload = bytearray(b"0123456789")
+        message = {
+            "message": "data",
+            "connection": 1,
+            "data": payload,
+            "size": 10.0,
+            "time": 1.0,
+        }
+        first = pipe.SplitMessage(message, 4)
+        second = pipe.SplitMessage(message, 4)
+        self.assertEqual(as_bytes(first["data"]), b"0123")
+        self.assertEqual(as_bytes(second["data"]), b"4567")
+        self.assertEqual(as_bytes(message["data"]), b"89")
+        self.assertEqual(
+            [first["size"], second["size"], message["size"]], [4.0, 4.0, 2.0]
+        )
+        self.assertEqual([first["time"], second["time"]], [1.0, 1.0])
+        # The parts are views of the original data, not copies
+        payload[:] = b"abcdefghij"
+        self.assertEqual(
+            [as_bytes(part["data"]) for part in [first, second, message]],
+            [b"abcd", b"efgh", b"ij"],
+        )
+
+
+class TimedPeer(Peer):
+    """A peer that also notes when the last message was delivered"""
+
+    delivered_at = None
+
+    def handle_message(self, message):
+        Peer.handle_message(self, message)
+        self.delivered_at = tsproxy.current_time()
+
+
+@unittest.skipIf(tsproxy.asyncio is None, "asyncio is not available")
+class TestPipeTimers(TsproxyTestCase):
+    """The pipes scheduling their own ticks on a real event loop"""
+
+    def setUp(self):
+        TsproxyTestCase.setUp(self)
+        tsproxy.event_loop = tsproxy.asyncio.SelectorEventLoop()
+        tsproxy.current_time = tsproxy.event_loop.time
+        self.peer = TimedPeer(1, self.delivered)
+        tsproxy.connections[1] = {"client": self.peer}
+
+    def tearDown(self):
+        tsproxy.event_loop.close()
+        tsproxy.flush_pipes = False
+        TsproxyTestCase.tearDown(self)
+
+    def run_until_delivered(self, count, timeout=5):
+        loop = tsproxy.event_loop
+
+        def check():
+            if len(self.delivered) >= count:
+                loop.stop()
+            else:
+                loop.call_later(0.001, check)
+
+        loop.call_soon(check)
+        timer = loop.call_later(timeout, loop.stop)
+        loop.run_forever()
+        timer.cancel()
+
+    def test_latency(self):
+        pipe = tsproxy.TSPipe(tsproxy.TSPipe.PIPE_IN, 0.05, 0)
+        start = tsproxy.event_loop.time()
+        self.send(pipe, 1, 100)
+        self.send(pipe, 1, 200)
+        self.run_until_delivered(2)
+        self.assertEqual(
+            [size for connection, size, sent in self.delivered], [100, 200]
+        )
+        for connection, size, sent in self.delivered:
+            self.assertAlmostEqual(sent, start + 0.05, delta=0.01)
+        # Released at the deadline of the timer, not before it
+        self.assertGreaterEqual(self.peer.delivered_at, self.delivered[-1][2])
+        self.assertLess(self.peer.delivered_at - start, 0.5)
+        self.assertIsNone(pipe.timer)
+
+    def test_bandwidth(self):
+        # 10 packets per second
+        pipe = tsproxy.TSPipe(tsproxy.TSPipe.PIPE_IN, 0, PACKET * 8 / 100.0)
+        start = tsproxy.event_loop.time()
+        self.send(pipe, 1, 3 * PACKET)
+        self.run_until_delivered(3)
+        self.assertEqual(
+            [size for connection, size, sent in self.delivered], [PACKET] * 3
+        )
+        self.assertAlmostEqual(self.peer.delivered_at - start, 0.3, delta=0.1)
+
+    def test_flush_cancels_timer(self):
+        pipe = tsproxy.TSPipe(tsproxy.TSPipe.PIPE_IN, 0.1, 0)
+        ticks = []
+        tick = pipe.tick
+
+        def counted_tick():
+            ticks.append(tsproxy.current_time())
+            return tick()
+
+        pipe.tick = counted_tick
+        self.send(pipe, 1, 100)
+        self.run_until_delivered(0)
+        self.assertEqual(len(ticks), 1)
+        self.assertIsNotNone(pipe.timer)
+        # A flush ticks the pipe straight away and the pending tick must not run after it
+        tsproxy.flush_pipes = True
+        pipe.OnTimer()
+        tsproxy.flush_pipes = False
+        self.assertEqual(len(self.delivered), 1)
+        self.assertIsNone(pipe.timer)
+        self.run_until_delivered(2, 0.3)
+        self.assertEqual(len(ticks), 2)
+        self.assertIsNone(pipe.timer)
+
+
+class Wakeup(object):
+    def Wake(self):
+        pass
+
+
+class TestDNSResolver(TsproxyTestCase):
+    """DNSResolver with getaddrinfo replaced by a stub that counts the lookups"""
+
+    ADDRESSES = [(socket.AF_INET, socket.SOCK_STREAM, 6, "", ("10.0.0.1", 443))]
+
+    def setUp(self):
+        TsproxyTestCase.setUp(self)
+        self.saved_resolver = (socket.getaddrinfo, tsproxy.wakeup)
+        socket.getaddrinfo = self.getaddrinfo
+        tsproxy.wakeup = Wakeup()
+        self.lookups = []
+        self.release = threading.Event()
+        self.release.set()
+        self.pipe = Pipe()
+        self.resolver = tsproxy.DNSResolver(60)
+
+    def tearDown(self):
+        self.release.set()
+        socket.getaddrinfo, tsproxy.wakeup = self.saved_resolver
+        TsproxyTestCase.tearDown(self)
+
+    def getaddrinfo(self, hostname, port):
+        self.lookups.append((hostname, port))
+        self.release.wait(5)
+        if hostname == "missing.example":
+            raise socket.gaierror("Name or service not known")
+        return self.ADDRESSES
+
+    def resolve(self, client_id, hostname="example.com"):
+        self.resolver.Resolve(client_id, hostname, 443, False, self.pipe)
+
+    def wait_for(self, count):
+        deadline = time.time() + 5
+        while len(self.pipe.messages) < count and time.time() < deadline:
+            time.sleep(0.001)
+        self.assertEqual(len(self.pipe.messages), count)
+
+    def test_coalescing(self):
+        self.release.clear()
+        for client_id in range(30):
+            self.resolve(client_id)
+        self.release.set()
+        self.wait_for(30)
+        self.assertEqual(self.lookups, [("example.com", 443)])
+        self.assertEqual(
+            sorted(message["connection"] for message in self.pipe.messages),
+            list(range(30)),
+        )
+        self.assertTrue(
+            all(
+                message["addresses"] == self.ADDRESSES for message in self.pipe.messages
+            )
+        )
+        self.assertEqual(self.resolver.threads, 1)
+        self.assertEqual(tsproxy.background_activity_count, 0)
+        # Answered from the cache straight away
+        self.resolve(30)
+        self.assertEqual(len(self.pipe.messages), 31)
+        self.assertEqual(len(self.lookups), 1)
+
+    def test_ttl(self):
+        self.resolve(1)
+        self.wait_for(1)
+        self.clock.now = 59.0
+        self.resolve(2)
+        self.assertEqual(len(self.pipe.messages), 2)
+        self.clock.now = 60.0
+        self.resolve(3)
+        self.wait_for(3)
+        self.assertEqual(len(self.lookups), 2)
+
+    def test_no_cache(self):
+        self.resolver = tsproxy.DNSResolver(0)
+        self.resolve(1)
+        self.wait_for(1)
+        self.resolve(2)
+        self.wait_for(2)
+        self.assertEqual(len(self.lookups), 2)
+
+    def test_flush(self):
+        self.resolve(1)
+        self.wait_for(1)
+        self.resolver.Flush()
+        self.resolve(2)
+        self.wait_for(2)
+        self.assertEqual(len(self.lookups), 2)
+
+    def test_failure_not_cached(self):
+        self.resolve(1, "missing.example")
+        self.wait_for(1)
+        self.assertEqual(self.pipe.messages[0]["addresses"], ())
+        self.resolve(2, "missing.example")
+        self.wait_for(2)
+        self.assertEqual(len(self.lookups), 2)
+
+
+if "__main__" == __name__:
+    unittest.main()